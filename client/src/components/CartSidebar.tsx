@@ -76,12 +76,12 @@ const CartSidebar = ({ isOpen, onClose, cartItems, onRemoveItem, onClearCart }:
     setIsProcessing(true);
 
     try {
-      // Use the first available item for checkout
-      const firstItem = availableItems[0];
+      // Check out every available item in a single Stripe session
+      const itemNames = availableItems.map(item => item.name);
       
-      console.log('Creating checkout session for:', firstItem.name);
+      console.log('Creating checkout session for:', itemNames.join(', '));
       
-      const checkoutUrl = await createCheckoutSession(token, firstItem.name);
+      const checkoutUrl = await createCheckoutSession(token, itemNames);
       
       console.log('Checkout URL received:', checkoutUrl);
       
@@ -115,7 +115,7 @@ const CartSidebar = ({ isOpen, onClose, cartItems, onRemoveItem, onClearCart }:
       
       toast({
         title: "Redirecting to Checkout",
-        description: `Opening checkout for ${firstItem.name} in a new tab...`,
+        description: `Opening checkout for ${itemNames.join(', ')} in a new tab...`,
       });
       
     } catch (error) {
@@ -6,7 +6,7 @@ interface CheckoutResponse {
 
 export const createCheckoutSession = async (
   token: string,
-  toolId: string
+  toolNames: string[]
 ): Promise<string> => {
   const response = await fetch(`${API_BASE_URL}/checkout/`, {
     method: 'POST',
@@ -14,7 +14,7 @@ export const createCheckoutSession = async (
       'Content-Type': 'application/json',
       Authorization: `Bearer ${token}`
     },
-    body: JSON.stringify({ tool_id: toolId })
+    body: JSON.stringify({ items: toolNames.map((name) => ({ tool_name: name })) })
   });
 
   if (!response.ok) {
@@ -20,6 +20,9 @@ DEBUG = os.environ.get('DEBUG', 'True') == 'True'
 
 ALLOWED_HOSTS = ['*']
 
+# API-only processes drop the admin, sessions and messages stack
+API_ONLY = os.environ.get('API_ONLY', 'False') == 'True'
+
 # Application definition
 INSTALLED_APPS = [
     'django.contrib.admin',
@@ -35,15 +38,37 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'payments.middleware.ServerTimingMiddleware',
+    'payments.profiling.ProfilingMiddleware',
+    'payments.middleware.CompressionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'payments.middleware.PathScopedMiddleware',
+]
+
+# Run by PathScopedMiddleware for every path except API_PATH_PREFIXES, which authenticate
+# with bearer tokens and skip sessions, CSRF, messages and frame options
+SITE_MIDDLEWARE = [
+    'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
+API_PATH_PREFIXES = ['/api/', '/metrics', '/healthz', '/readyz']
+
+# The admin checks look for its middleware in MIDDLEWARE; it runs from SITE_MIDDLEWARE
+SILENCED_SYSTEM_CHECKS = ['admin.E408', 'admin.E409', 'admin.E410']
+
+if API_ONLY:
+    INSTALLED_APPS = [app for app in INSTALLED_APPS if app not in (
+        'django.contrib.admin',
+        'django.contrib.sessions',
+        'django.contrib.messages',
+        'django.contrib.staticfiles',
+    )]
+    SITE_MIDDLEWARE = []
 
 ROOT_URLCONF = 'crisp_backend.urls'
 
@@ -84,6 +109,22 @@ else:
         }
     }
 
+# Subscriptions and payments are sharded by user across extra databases given as
+# SHARD_DATABASES="shard_b=postgres://...,shard_c=postgres://...". Everything else
+# stays on `default`.
+for entry in os.environ.get('SHARD_DATABASES', '').split(','):
+    if '=' in entry:
+        import dj_database_url
+        alias, url = entry.split('=', 1)
+        DATABASES[alias.strip()] = dj_database_url.parse(url.strip())
+
+# Databases on the consistent-hash ring (default: all of them). While `rebalance_shards`
+# moves users after a ring change, SHARDS_PREVIOUS lists the ring they are moving from.
+SHARDS = [alias for alias in os.environ.get('SHARDS', ','.join(DATABASES)).split(',') if alias]
+SHARDS_PREVIOUS = [alias for alias in os.environ.get('SHARDS_PREVIOUS', '').split(',') if alias]
+SHARD_VIRTUAL_NODES = int(os.environ.get('SHARD_VIRTUAL_NODES', 64))
+DATABASE_ROUTERS = ['payments.sharding.ShardRouter']
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -117,7 +158,6 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework_simplejwt.authentication.JWTAuthentication',
-        'rest_framework.authentication.SessionAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
@@ -143,6 +183,90 @@ CORS_ALLOW_CREDENTIALS = True
 STRIPE_SECRET_KEY = os.environ.get('STRIPE_SECRET_KEY')
 STRIPE_PUBLISHABLE_KEY = os.environ.get('STRIPE_PUBLISHABLE_KEY')
 STRIPE_WEBHOOK_SECRET = os.environ.get('STRIPE_WEBHOOK_SECRET')
+STRIPE_DISPATCH_BATCH_SIZE = int(os.environ.get('STRIPE_DISPATCH_BATCH_SIZE', 50))
+# reap_checkouts looks at unpaid checkouts older than this. Stripe sessions last at most
+# 24 hours and Stripe retries webhook events for up to 3 days, so by then a paid session's
+# completed event has been delivered or given up on.
+CHECKOUT_SESSION_TTL_HOURS = float(os.environ.get('CHECKOUT_SESSION_TTL_HOURS', 96))
+
+# Service-to-service tokens, "name:token,name:token" (used by tool backends)
+SERVICE_API_TOKENS = dict(
+    entry.split(':', 1) for entry in os.environ.get('SERVICE_API_TOKENS', '').split(',') if ':' in entry
+)
+BULK_CHECK_MAX_ITEMS = int(os.environ.get('BULK_CHECK_MAX_ITEMS', 5000))
+BULK_CHECK_STREAM_THRESHOLD = int(os.environ.get('BULK_CHECK_STREAM_THRESHOLD', 500))
+
+# Usage metering settings (see payments/metering.py)
+USAGE_MAX_BATCH = int(os.environ.get('USAGE_MAX_BATCH', 1000))
+# Events buffered in memory per process before record_usage answers 429
+USAGE_BUFFER_CAPACITY = int(os.environ.get('USAGE_BUFFER_CAPACITY', 50000))
+USAGE_FLUSH_SIZE = int(os.environ.get('USAGE_FLUSH_SIZE', 5000))
+USAGE_FLUSH_INTERVAL = float(os.environ.get('USAGE_FLUSH_INTERVAL', 1.0))
+# Directory for the append-only usage log; unset keeps buffered events in memory only
+USAGE_LOG_DIR = os.environ.get('USAGE_LOG_DIR', '')
+
+# One cache shared by every gunicorn worker, so dropping a cached entitlement token or tool
+# catalog reaches all of them. On PostgreSQL it is a table (start_production.sh runs
+# createcachetable); elsewhere it is per-process memory, which is only shared under runserver.
+# Set both CACHE_BACKEND and CACHE_LOCATION to use another, e.g. Redis.
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', (
+            'django.core.cache.backends.db.DatabaseCache'
+            if DATABASES['default']['ENGINE'] == 'django.db.backends.postgresql'
+            else 'django.core.cache.backends.locmem.LocMemCache'
+        )),
+        'LOCATION': os.environ.get('CACHE_LOCATION', (
+            'django_cache' if DATABASES['default']['ENGINE'] == 'django.db.backends.postgresql' else ''
+        )),
+    },
+}
+
+# Entitlement token settings (RS256 private key in PEM form)
+ENTITLEMENT_SIGNING_KEY = os.environ.get('ENTITLEMENT_SIGNING_KEY', '').replace('\\n', '\n')
+ENTITLEMENT_TOKEN_LIFETIME = int(os.environ.get('ENTITLEMENT_TOKEN_LIFETIME', 300))
+ENTITLEMENT_TOKEN_ISSUER = os.environ.get('ENTITLEMENT_TOKEN_ISSUER', 'https://marketplace.crispai.ca')
+
+# Entitlement change streams (see payments/events.py). On PostgreSQL changes reach streams in
+# every process through LISTEN/NOTIFY; elsewhere only those in the publishing process, and the
+# others see them at their next heartbeat.
+EVENTS_BACKEND = os.environ.get('EVENTS_BACKEND', (
+    'payments.events.PostgresNotifyBackend' if DATABASES['default']['ENGINE'] == 'django.db.backends.postgresql'
+    else 'payments.events.LocalBackend'
+))
+# How long a ticket from /api/entitlements/stream/ticket/ can open a stream (seconds)
+ENTITLEMENT_STREAM_TICKET_SECONDS = int(os.environ.get('ENTITLEMENT_STREAM_TICKET_SECONDS', 60))
+EVENT_STREAM_HEARTBEAT_SECONDS = float(os.environ.get('EVENT_STREAM_HEARTBEAT_SECONDS', 15))
+# Streams are closed after this long and EventSource reconnects, so workers can be recycled
+EVENT_STREAM_MAX_SECONDS = float(os.environ.get('EVENT_STREAM_MAX_SECONDS', 3600))
+
+# Billing archive settings (see payments/archive.py and the archive_billing command)
+BILLING_ARCHIVE_ROOT = os.environ.get('BILLING_ARCHIVE_ROOT', os.path.join(BASE_DIR, 'archive'))
+BILLING_RETENTION_DAYS = int(os.environ.get('BILLING_RETENTION_DAYS', 365))
+
+# API responses smaller than this (bytes) are sent uncompressed
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+# Upper bound on how long a worker serves a cached tool catalog (seconds)
+CATALOG_CACHE_SECONDS = int(os.environ.get('CATALOG_CACHE_SECONDS', 300))
+
+# Cold-start budget enforced by the profile_startup test (milliseconds)
+STARTUP_BUDGET_MS = float(os.environ.get('STARTUP_BUDGET_MS', 2500))
+
+# Request profiling (see payments/profiling.py). Sample rates are "view:rate,view:rate",
+# e.g. "create_checkout:0.01,login:0.01,stripe_webhook:0.05"
+PROFILE_SAMPLE_RATES = {
+    view: float(rate) for view, _, rate in
+    (entry.partition(':') for entry in os.environ.get('PROFILE_SAMPLE_RATES', '').split(',') if ':' in entry)
+}
+# Keep a profile of every request slower than this (milliseconds, 0 disables)
+PROFILE_SLOW_MS = float(os.environ.get('PROFILE_SLOW_MS', 0))
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', 5))
+PROFILE_MAX_STORED = int(os.environ.get('PROFILE_MAX_STORED', 500))
+# How long a token from the profile_token command is accepted (seconds)
+PROFILE_TOKEN_MAX_AGE = int(os.environ.get('PROFILE_TOKEN_MAX_AGE', 3600))
+
+# Metrics settings (bearer token required on /metrics when set)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
 
 # Email settings
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
@@ -151,4 +275,17 @@ EMAIL_PORT = int(os.environ.get('EMAIL_PORT', 587))
 EMAIL_USE_TLS = True
 EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD')
-DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL', 'noreply@crispai.ca')
\ No newline at end of file
+DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL', 'noreply@crispai.ca')
+# send_expiry_reminders warns about plans ending within this many days
+EXPIRY_REMINDER_DAYS = float(os.environ.get('EXPIRY_REMINDER_DAYS', 7))
+
+# Idempotency-Key responses are replayed for this long (see payments/idempotency.py)
+IDEMPOTENCY_TTL_HOURS = float(os.environ.get('IDEMPOTENCY_TTL_HOURS', 24))
+# How long a retry waits on the first request with its key before answering 409
+IDEMPOTENCY_WAIT_SECONDS = float(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', 10))
+# A key whose first request has run this long is presumed dead and taken over
+IDEMPOTENCY_LOCK_SECONDS = float(os.environ.get('IDEMPOTENCY_LOCK_SECONDS', 120))
+
+# Per-process cache of nginx auth_request decisions (see payments/auth_request.py)
+AUTH_REQUEST_CACHE_SECONDS = float(os.environ.get('AUTH_REQUEST_CACHE_SECONDS', 5))
+AUTH_REQUEST_CACHE_SIZE = int(os.environ.get('AUTH_REQUEST_CACHE_SIZE', 100000))
\ No newline at end of file
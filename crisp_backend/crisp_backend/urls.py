@@ -1,10 +1,18 @@
 """
 URL configuration for crisp_backend project.
 """
-from django.contrib import admin
+from django.apps import apps
 from django.urls import path, include
+from payments.views import healthz, readyz, metrics
 
 urlpatterns = [
-    path('admin/', admin.site.urls),
     path('api/', include('payments.urls')),
-]
\ No newline at end of file
+    path('metrics', metrics, name='metrics'),
+    path('healthz', healthz, name='healthz'),
+    path('readyz', readyz, name='readyz'),
+]
+
+if apps.is_installed('django.contrib.admin'):
+    from django.contrib import admin
+
+    urlpatterns.insert(0, path('admin/', admin.site.urls))
\ No newline at end of file
@@ -0,0 +1,99 @@
+"""
+Gunicorn settings for production (see start_production.sh).
+
+Workers run the ASGI app under uvicorn. The app is imported once in the
+master before forking so workers share its memory copy-on-write.
+
+Because of that preload, HUP forks new workers from the master's copy of
+the old code: it rereads this file, but never loads a deploy. To deploy new
+code without dropping requests, migrate, then start a new master beside the
+old one and retire the old one:
+
+    kill -USR2 $(cat gunicorn.pid)    # new master and workers on the new code, pid in gunicorn.pid.2
+    kill -TERM $(cat gunicorn.pid)    # once /readyz answers: the old master drains its workers and exits,
+                                      # and the new one takes over gunicorn.pid
+    kill -TERM $(cat gunicorn.pid.2)  # instead of the line above, to roll back
+
+The new master keeps the old one's command line and environment. To change
+those, restart the whole server. Other signals:
+
+    kill -HUP  $(cat gunicorn.pid)   # recycle workers on the same code, e.g. after a leak
+    kill -TERM $(cat gunicorn.pid)   # graceful shutdown
+"""
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import tempfile
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+worker_class = 'uvicorn_worker.UvicornWorker'
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+
+preload_app = True
+
+# Recycle workers periodically so slow leaks never accumulate; jitter keeps
+# them from all restarting at once.
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 2000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 200))
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+
+pidfile = os.environ.get('GUNICORN_PIDFILE', 'gunicorn.pid')
+accesslog = '-'
+errorlog = '-'
+
+# Workers write their metrics to files here so /metrics can add them all up. Set
+# before the app is preloaded, since prometheus_client reads it on import.
+os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), f"crisp-metrics-{os.environ.get('PORT', '8000')}"),
+)
+
+
+def on_starting(server):
+    # Start from empty metrics, except in the new master of a binary upgrade (which
+    # gunicorn starts with GUNICORN_PID set), so counts carry over the deploy
+    path = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    if 'GUNICORN_PID' not in os.environ:
+        shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+
+
+def when_ready(server):
+    # Entitlement tokens must verify against the JWKS served by any worker, so the
+    # signing key (or DEBUG's throwaway one) is loaded here and inherited by all
+    if server.cfg.preload_app:
+        from payments.entitlements import signing_key
+        signing_key()
+    elif server.cfg.workers > 1 and not os.environ.get('ENTITLEMENT_SIGNING_KEY'):
+        raise RuntimeError('ENTITLEMENT_SIGNING_KEY must be set to run several workers without preload_app')
+
+
+def post_fork(server, worker):
+    # Never share a database socket opened in the master across processes
+    from django.db import connections
+    connections.close_all()
+
+
+def post_worker_init(worker):
+    # uvicorn stops gracefully on TERM or INT, then raises the signal again. Exit
+    # normally instead of dying of it, so worker_exit still runs.
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: sys.exit(0))
+
+
+def child_exit(server, worker):
+    # Keep a recycled worker's counts without keeping its files
+    from payments.metrics import archive_process
+    archive_process(worker.pid)
+
+
+def worker_exit(server, worker):
+    # Store buffered usage and run queued Stripe calls before a recycled or stopped worker goes
+    from payments.metering import usage_dispatcher
+    from payments.tasks import stripe_dispatcher
+    for dispatcher in (usage_dispatcher, stripe_dispatcher):
+        dispatcher.shutdown(timeout=server.cfg.graceful_timeout / 2)
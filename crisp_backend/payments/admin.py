@@ -1,10 +1,31 @@
-from django.contrib import admin
-from .models import UserProfile, Tool, Subscription, Payment
+from datetime import timedelta
+
+from django.contrib import admin, messages
+from django.contrib.admin.views.main import ChangeList
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Case, DurationField, F, Q, Value, When
+from django.db.models.functions import Coalesce, Now
+from django.http import QueryDict
+from django.utils import timezone
+from django.utils.html import format_html
+
+from . import profiling
+from .models import UserProfile, Tool, Subscription, Payment, RequestProfile
+from .sharding import all_shards, fan_out
+from .signals import notify_entitlements_changed
+from .tasks import stripe_dispatcher
+
+# Calendar months vary, so SQL-side extensions use the average month length
+PLAN_EXTENSIONS = {
+    plan: timedelta(days=round(plan.value * 365 / 12)) for plan in Subscription.Plan if plan.value
+}
 
 
 @admin.register(UserProfile)
 class UserProfileAdmin(admin.ModelAdmin):
     list_display = ['user', 'phone', 'is_verified', 'created_at']
+    list_select_related = ['user']
     list_filter = ['is_verified', 'created_at']
     search_fields = ['user__username', 'user__email', 'phone']
 
@@ -16,19 +37,176 @@ class ToolAdmin(admin.ModelAdmin):
     search_fields = ['name', 'description']
 
 
+def selected_shard(request):
+    """Shard picked in the changelist, also carried over to change and delete pages"""
+    shard = request.GET.get('shard') or QueryDict(request.GET.get('_changelist_filters', '')).get('shard')
+    shards = all_shards()
+    if shard in shards:
+        return shard
+    return DEFAULT_DB_ALIAS if DEFAULT_DB_ALIAS in shards else shards[0]
+
+
+class ShardFilter(admin.SimpleListFilter):
+    """Pick the shard to browse; each choice shows how many rows match the current search there"""
+    title = 'shard'
+    parameter_name = 'shard'
+
+    def lookups(self, request, model_admin):
+        shards = all_shards()
+        return [(shard, shard) for shard in shards] if len(shards) > 1 else []
+
+    def queryset(self, request, queryset):
+        return queryset  # ShardedModelAdmin.get_queryset already picked the database
+
+    def choices(self, changelist):
+        queryset = changelist.queryset.select_related(None).prefetch_related(None).order_by()
+        counts = fan_out(lambda shard: queryset.using(shard).count(), [shard for shard, _ in self.lookup_choices])
+        for shard, count in counts.items():
+            yield {
+                'selected': changelist.queryset.db == shard,
+                'query_string': changelist.get_query_string({self.parameter_name: shard}),
+                'display': f'{shard} ({count})',
+            }
+
+
+class ShardedModelAdmin(admin.ModelAdmin):
+    """Browse a sharded model one shard at a time
+
+    Users and tools live on `default`, so on other shards related rows are
+    prefetched instead of joined, and searches match users and tools first.
+    """
+    # (field on this model, global model, field searched on it)
+    shard_search_fields = []
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request).using(selected_shard(request))
+        if queryset.db != DEFAULT_DB_ALIAS:
+            queryset = queryset.prefetch_related(*self.list_select_related)
+        return queryset
+
+    def get_list_select_related(self, request):
+        return self.list_select_related if selected_shard(request) == DEFAULT_DB_ALIAS else []
+
+    def get_search_results(self, request, queryset, search_term):
+        if queryset.db == DEFAULT_DB_ALIAS or not search_term:
+            return super().get_search_results(request, queryset, search_term)
+        condition = Q(pk__in=[])
+        for field, model, lookup in self.shard_search_fields:
+            matches = model.objects.filter(**{f'{lookup}__icontains': search_term}).values_list('pk', flat=True)
+            condition |= Q(**{f'{field}__in': list(matches)})
+        return queryset.filter(condition), False
+
+
 @admin.register(Subscription)
-class SubscriptionAdmin(admin.ModelAdmin):
+class SubscriptionAdmin(ShardedModelAdmin):
     list_display = ['user', 'tool', 'plan', 'status', 'start_date', 'end_date']
-    list_filter = ['status', 'plan', 'start_date', 'end_date']
+    list_select_related = ['user', 'tool']
+    list_filter = [ShardFilter, 'status', 'plan', 'start_date', 'end_date']
     search_fields = ['user__username', 'tool__name']
+    shard_search_fields = [('user_id', User, 'username'), ('tool_id', Tool, 'name')]
+    actions = ['cancel_subscriptions', 'extend_subscriptions', 'reactivate_subscriptions']
     
     def is_active(self, obj):
         return obj.is_active()
     is_active.boolean = True
 
+    def bulk_update(self, request, queryset, message, **changes):
+        """Apply `changes` to the whole selection with one UPDATE and notify affected users"""
+        with transaction.atomic(using=queryset.db):
+            user_ids = set(queryset.values_list('user_id', flat=True))
+            updated = queryset.update(updated_at=timezone.now(), **changes)
+            transaction.on_commit(
+                lambda: notify_entitlements_changed(user_ids, sender=Subscription), using=queryset.db,
+            )
+        self.message_user(request, message % {'count': updated})
+        return updated
+
+    @admin.action(description='Cancel selected subscriptions')
+    def cancel_subscriptions(self, request, queryset):
+        # Expire the Stripe sessions of checkouts that were never paid
+        open_sessions = list(Payment.objects.using(queryset.db).filter(
+            subscription__in=queryset, status='pending'
+        ).exclude(stripe_payment_intent_id='').values_list('stripe_payment_intent_id', flat=True).distinct())
+        self.bulk_update(request, queryset, '%(count)d subscriptions canceled.', status=Subscription.Status.CANCELED)
+        if open_sessions:
+            stripe_dispatcher.enqueue_many([('expire_session', session_id) for session_id in open_sessions])
+
+    @admin.action(description='Extend selected subscriptions by one plan length')
+    def extend_subscriptions(self, request, queryset):
+        extension = Case(
+            *[When(plan=plan, then=Value(length)) for plan, length in PLAN_EXTENSIONS.items()],
+            default=Value(PLAN_EXTENSIONS[Subscription.Plan.ONE_MONTH]),
+            output_field=DurationField(),
+        )
+        self.bulk_update(
+            request, queryset, '%(count)d subscriptions extended.',
+            end_date=Coalesce(F('end_date'), Now()) + extension,
+        )
+
+    @admin.action(description='Reactivate selected canceled or expired subscriptions')
+    def reactivate_subscriptions(self, request, queryset):
+        # Inactive rows are checkouts that were never paid; activating them would give the plan away
+        reactivatable = [Subscription.Status.CANCELED, Subscription.Status.EXPIRED]
+        skipped = queryset.exclude(status__in=reactivatable).count()
+        self.bulk_update(request, queryset.filter(status__in=reactivatable), '%(count)d subscriptions reactivated.',
+                         status=Subscription.Status.ACTIVE)
+        if skipped:
+            self.message_user(request, f'{skipped} subscriptions skipped: only canceled or expired ones can be '
+                                       'reactivated.', messages.WARNING)
+
 
 @admin.register(Payment)
-class PaymentAdmin(admin.ModelAdmin):
+class PaymentAdmin(ShardedModelAdmin):
     list_display = ['user', 'subscription', 'amount', 'currency', 'status', 'created_at']
-    list_filter = ['status', 'currency', 'created_at']
-    search_fields = ['user__username', 'subscription__tool__name']
\ No newline at end of file
+    list_select_related = ['user', 'subscription__user', 'subscription__tool']
+    list_filter = [ShardFilter, 'status', 'currency', 'created_at']
+    search_fields = ['user__username', 'subscription__tool__name']
+    shard_search_fields = [('user_id', User, 'username'), ('subscription__tool_id', Tool, 'name')]
+
+
+class ProfiledViewFilter(admin.SimpleListFilter):
+    """The endpoints whose latency we watch, without a DISTINCT over every stored view"""
+    title = 'view'
+    parameter_name = 'view'
+    views = ['create_checkout', 'login', 'stripe_webhook']
+
+    def lookups(self, request, model_admin):
+        return [(view, view) for view in self.views]
+
+    def queryset(self, request, queryset):
+        return queryset.filter(view=self.value()) if self.value() else queryset
+
+
+class RequestProfileChangeList(ChangeList):
+    def get_queryset(self, request, exclude_parameters=None):
+        # Stacks can run to hundreds of kilobytes and only the change page draws them
+        return super().get_queryset(request, exclude_parameters).defer('stacks')
+
+
+@admin.register(RequestProfile)
+class RequestProfileAdmin(admin.ModelAdmin):
+    """Slowest profiled requests first; each opens as a flame graph"""
+    list_display = ['path', 'view', 'method', 'status_code', 'duration', 'samples', 'trigger', 'created_at']
+    list_filter = [ProfiledViewFilter, 'trigger']
+    ordering = ['-duration_ms']
+    show_full_result_count = False
+    readonly_fields = ['flame_graph']
+    fields = ['view', 'method', 'path', 'status_code', 'duration_ms', 'trigger', 'samples', 'created_at',
+              'flame_graph', 'stacks']
+
+    def get_changelist(self, request, **kwargs):
+        return RequestProfileChangeList
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    @admin.display(description='Duration', ordering='duration_ms')
+    def duration(self, obj):
+        return f'{obj.duration_ms:.0f} ms'
+
+    @admin.display(description='Flame graph')
+    def flame_graph(self, obj):
+        return format_html('<div style="overflow-x: auto">{}</div>', profiling.flame_graph(obj.stacks))
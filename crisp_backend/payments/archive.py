@@ -0,0 +1,185 @@
+"""
+Cold storage for billing rows moved out of the live tables.
+
+Rows are written as gzip-compressed NDJSON, partitioned by the month they
+were created in:
+
+    <BILLING_ARCHIVE_ROOT>/<kind>/<YYYY>/<MM>/[<shard>-]<first_pk>-<last_pk>.ndjson.gz
+
+Each file has a `.json` manifest beside it holding the SHA-256 of the
+compressed bytes, the row count and the user IDs it contains. Every user
+also has an index file listing the partitions that hold their rows:
+
+    <BILLING_ARCHIVE_ROOT>/<kind>/users/<user_id % 1000>/<user_id>.idx
+
+so reading one user's history opens only those partitions, a page at a
+time, rather than every manifest in the archive.
+"""
+import base64
+import gzip
+import hashlib
+import json
+import os
+import shutil
+from itertools import islice
+from pathlib import Path
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.dateparse import parse_datetime
+
+
+class ArchiveVerificationError(Exception):
+    pass
+
+
+def _root():
+    return Path(settings.BILLING_ARCHIVE_ROOT)
+
+
+def write_partition(kind, rows, shard=None):
+    """Write rows (dicts with 'id', 'user_id' and 'created_at') to one partition file
+
+    Primary keys are only unique per database, so rows from a shard other
+    than `default` get the shard alias in their file name.
+
+    Returns the path once the file has been read back and its checksum and row
+    count verified; raises ArchiveVerificationError otherwise.
+    """
+    created = rows[0]['created_at']
+    directory = _root() / kind / f'{created:%Y}' / f'{created:%m}'
+    directory.mkdir(parents=True, exist_ok=True)
+    prefix = f'{shard}-' if shard and shard != DEFAULT_DB_ALIAS else ''
+    path = directory / f"{prefix}{rows[0]['id']}-{rows[-1]['id']}.ndjson.gz"
+
+    encoder = DjangoJSONEncoder()
+    payload = gzip.compress(''.join(encoder.encode(row) + '\n' for row in rows).encode(), mtime=0)
+    checksum = hashlib.sha256(payload).hexdigest()
+
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'wb') as fh:
+        fh.write(payload)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp_path, path)
+
+    manifest = {
+        'sha256': checksum,
+        'rows': len(rows),
+        'user_ids': sorted({row['user_id'] for row in rows}),
+    }
+    manifest_path(path).write_text(json.dumps(manifest))
+
+    verify_partition(path)
+    _add_to_index(kind, path, manifest['user_ids'])
+    return path
+
+
+def manifest_path(path):
+    return path.with_name(path.name[:-len('.ndjson.gz')] + '.json')
+
+
+def verify_partition(path):
+    """Re-read a partition and check it against its manifest"""
+    manifest = json.loads(manifest_path(path).read_text())
+    payload = path.read_bytes()
+    if hashlib.sha256(payload).hexdigest() != manifest['sha256']:
+        raise ArchiveVerificationError(f'Checksum mismatch for {path}')
+    if gzip.decompress(payload).count(b'\n') != manifest['rows']:
+        raise ArchiveVerificationError(f'Row count mismatch for {path}')
+    return manifest
+
+
+def _index_path(kind, user_id):
+    return _root() / kind / 'users' / f'{user_id % 1000:03d}' / f'{user_id}.idx'
+
+
+def _add_to_index(kind, path, user_ids):
+    """List the partition at `path` in each user's index file"""
+    relative = path.relative_to(_root() / kind).as_posix()
+    for user_id in user_ids:
+        index_path = _index_path(kind, user_id)
+        index_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(index_path, 'a') as fh:
+            fh.write(relative + '\n')
+
+
+def rebuild_index(kind):
+    """Rewrite every user's index file for `kind` from the manifests; returns the partition count"""
+    base = _root() / kind
+    shutil.rmtree(base / 'users', ignore_errors=True)
+    paths = sorted(base.glob('[0-9]*/[0-9]*/*.ndjson.gz'))
+    for path in paths:
+        _add_to_index(kind, path, json.loads(manifest_path(path).read_text())['user_ids'])
+    return len(paths)
+
+
+def partition_key(relative):
+    """Sort key for a partition path relative to its kind: oldest month, then lowest primary key
+
+    Raises ValueError for paths write_partition does not produce.
+    """
+    year, month, name = relative.split('/')
+    if not name.endswith('.ndjson.gz'):
+        raise ValueError(f'not a partition: {relative}')
+    *shard, first_pk, _ = name[:-len('.ndjson.gz')].rsplit('-', 2)
+    return int(year), int(month), int(first_pk), ''.join(shard)
+
+
+def partitions_for(kind, user_id):
+    """Paths, relative to the kind's directory, of the partitions holding the user's rows, oldest first"""
+    try:
+        listed = _index_path(kind, user_id).read_text().split()
+    except FileNotFoundError:
+        return []
+    # A partition rewritten by a rerun is listed again
+    return sorted(set(listed), key=partition_key)
+
+
+def _iter_rows(kind, user_id, after=None):
+    """Yield (partition, row) for the user's archived rows, starting past the `after` position"""
+    start, last_pk = after or (None, None)
+    partitions = partitions_for(kind, user_id)
+    if start is not None:
+        partitions = [relative for relative in partitions if partition_key(relative) >= partition_key(start)]
+    for relative in partitions:
+        with gzip.open(_root() / kind / relative, 'rt') as fh:
+            for line in fh:
+                row = json.loads(line)
+                if row['user_id'] != user_id or (relative == start and row['id'] <= last_pk):
+                    continue
+                for field in ('created_at', 'updated_at', 'start_date', 'end_date', 'occurred_at'):
+                    if row.get(field):
+                        row[field] = parse_datetime(row[field])
+                yield relative, row
+
+
+def iter_archived(kind, user_id):
+    """Yield archived rows of `kind` belonging to one user, oldest partition first"""
+    for _, row in _iter_rows(kind, user_id):
+        yield row
+
+
+def encode_cursor(relative, pk):
+    return base64.urlsafe_b64encode(json.dumps([relative, pk]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """(partition, id) from a cursor; raises ValueError if it was not made by encode_cursor"""
+    try:
+        relative, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        partition_key(relative)
+    except (AttributeError, TypeError, ValueError, UnicodeDecodeError):
+        raise ValueError('invalid cursor')
+    if not isinstance(pk, int):
+        raise ValueError('invalid cursor')
+    return relative, pk
+
+
+def page(kind, user_id, after=None, limit=50):
+    """Up to `limit` archived rows past the decoded cursor `after`, oldest first, and the next cursor or None"""
+    rows = list(islice(_iter_rows(kind, user_id, after), limit + 1))
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return [row for _, row in rows], encode_cursor(rows[-1][0], rows[-1][1]['id']) if more else None
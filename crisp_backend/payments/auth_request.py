@@ -0,0 +1,97 @@
+"""
+Access decisions for nginx auth_request subrequests.
+
+Each tool sits behind nginx, which asks the auth_request view whether the
+bearer token on an incoming request may use that tool before proxying it.
+This happens for every asset the tool serves. So the view skips DRF, and
+each decision is kept in a per-process dict for
+AUTH_REQUEST_CACHE_SECONDS. A hit is a dict lookup, with no signature
+check and no queries.
+
+Decisions are keyed by the raw token and the tool. The token string stands
+in for its jti: a string is only cached after it verified, and an entry
+never outlives the token's exp. entitlements_changed drops a user's
+decisions in this process at once. Other workers catch up within the TTL,
+as they do for the cached catalog.
+"""
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models import Q
+from django.dispatch import receiver
+from django.utils import timezone
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .models import Tool, Subscription
+from .signals import entitlements_changed
+
+# (raw token, tool) -> (monotonic deadline, user_id, generation, (user_id, role) or None)
+_decisions = {}
+# user_id -> bumped on every entitlements_changed, which retires the user's cached decisions
+_generations = {}
+
+
+def clear():
+    _decisions.clear()
+
+
+def _tool_id(tool):
+    """Tool ID from an ID or a case-insensitive name, or None"""
+    if tool.isdigit():
+        return int(tool)
+    return Tool.objects.filter(name__iexact=tool).values_list('pk', flat=True).first()
+
+
+def _lookup(user_id, tool):
+    user = User.objects.filter(pk=user_id, is_active=True).values_list('pk', 'userprofile__role').first()
+    tool_id = _tool_id(tool) if user else None
+    if tool_id is None:
+        return None
+    has_access = Subscription.objects.for_user(user_id).filter(
+        Q(end_date__isnull=True) | Q(end_date__gt=timezone.now()),
+        tool_id=tool_id, status=Subscription.Status.ACTIVE,
+    ).exists()
+    return (user_id, user[1] or 'user') if has_access else None
+
+
+def _evict(now):
+    for key, entry in _decisions.copy().items():
+        if entry[0] <= now:
+            _decisions.pop(key, None)
+    if len(_decisions) >= settings.AUTH_REQUEST_CACHE_SIZE:
+        _decisions.clear()
+
+
+def access_decision(raw_token, tool):
+    """(user_id, role) when the access token may use `tool` (an ID or name), else None"""
+    key = (raw_token, tool)
+    now = time.monotonic()
+    entry = _decisions.get(key)
+    if entry is not None:
+        deadline, user_id, generation, decision = entry
+        if deadline > now and _generations.get(user_id, 0) == generation:
+            return decision
+
+    try:
+        token = AccessToken(raw_token)
+        user_id = int(token[api_settings.USER_ID_CLAIM])
+    except (TokenError, KeyError, ValueError):
+        return None
+    # Read before the queries, so a change that lands during them retires this decision
+    generation = _generations.get(user_id, 0)
+    decision = _lookup(user_id, tool)
+
+    ttl = min(settings.AUTH_REQUEST_CACHE_SECONDS, token['exp'] - time.time())
+    if ttl > 0:
+        if len(_decisions) >= settings.AUTH_REQUEST_CACHE_SIZE:
+            _evict(now)
+        _decisions[key] = (now + ttl, user_id, generation, decision)
+    return decision
+
+
+@receiver(entitlements_changed)
+def retire_decisions(sender, user_id, **kwargs):
+    _generations[user_id] = _generations.get(user_id, 0) + 1
@@ -0,0 +1,49 @@
+import hmac
+
+from django.conf import settings
+from rest_framework import authentication, exceptions, permissions
+
+
+class ServiceClient:
+    """Request principal for trusted backend services (tools, agent dashboard)"""
+    is_authenticated = True
+    is_anonymous = False
+    is_active = True
+    is_staff = False
+    pk = id = None
+
+    def __init__(self, name):
+        self.name = name
+        self.username = f'service:{name}'
+
+    def __str__(self):
+        return self.username
+
+
+class ServiceTokenAuthentication(authentication.BaseAuthentication):
+    """Authenticate `Authorization: Service <token>` against SERVICE_API_TOKENS"""
+    keyword = 'Service'
+
+    def authenticate(self, request):
+        header = authentication.get_authorization_header(request).split()
+        if not header or header[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(header) != 2:
+            raise exceptions.AuthenticationFailed('Invalid service token header')
+
+        # Bytes: compare_digest refuses str holding anything but ASCII
+        presented = header[1]
+        for name, token in settings.SERVICE_API_TOKENS.items():
+            if hmac.compare_digest(presented, token.encode()):
+                return ServiceClient(name), token
+        raise exceptions.AuthenticationFailed('Invalid service token')
+
+    def authenticate_header(self, request):
+        return self.keyword
+
+
+class IsService(permissions.BasePermission):
+    """Allow only requests authenticated with a service token"""
+
+    def has_permission(self, request, view):
+        return isinstance(request.user, ServiceClient)
@@ -0,0 +1,171 @@
+"""
+The public tool catalog, rendered and compressed once per change.
+
+list_tools serves the stored bytes for whichever encoding the client
+accepts, so a request costs a cache read instead of a query, a render and
+a compression pass.
+
+The catalog itself is declared in a YAML or JSON file and applied by the
+sync_catalog command: tools are matched by name, the whole diff is
+written in one transaction with bulk inserts and updates, tools missing
+from the file are deactivated rather than deleted, and catalog_changed
+fires once after commit.
+"""
+import json
+import os
+from dataclasses import dataclass, field
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from .compression import precompress
+from .models import Tool
+from .serializers import ToolSerializer
+from .signals import catalog_changed
+
+CACHE_KEY = 'tool-catalog'
+
+# Tool fields a catalog file may set, with their defaults for new tools. A field an entry
+# leaves out keeps its stored value on an existing tool.
+CATALOG_FIELDS = {'description': '', 'price': None, 'price_id': '', 'is_active': True}
+
+
+def catalog_variants():
+    """{encoding: bytes} of the active-tool list"""
+    variants = cache.get(CACHE_KEY)
+    if variants is None:
+        tools = Tool.objects.filter(is_active=True)
+        variants = precompress(JSONRenderer().render(ToolSerializer(tools, many=True).data))
+        # catalog_changed clears the shared cache for every worker, even when
+        # sync_catalog sends it from its own process. A local cache only hears
+        # about changes made in this process, so the timeout bounds the rest.
+        cache.set(CACHE_KEY, variants, settings.CATALOG_CACHE_SECONDS)
+    return variants
+
+
+@receiver(catalog_changed)
+def invalidate_catalog(sender, **kwargs):
+    cache.delete(CACHE_KEY)
+
+
+@receiver(post_save, sender=Tool)
+@receiver(post_delete, sender=Tool)
+def tool_changed(sender, **kwargs):
+    catalog_changed.send(sender=sender)
+
+
+class CatalogError(ValueError):
+    pass
+
+
+def load_catalog(path):
+    """[{name, price, and whichever other CATALOG_FIELDS are given}] from a catalog file, validated"""
+    with open(path, encoding='utf-8') as f:
+        if os.path.splitext(path)[1].lower() in ('.yaml', '.yml'):
+            try:
+                import yaml
+            except ImportError:
+                raise CatalogError('Reading YAML catalogs needs the PyYAML package')
+            try:
+                data = yaml.safe_load(f)
+            except yaml.YAMLError as e:
+                mark = getattr(e, 'problem_mark', None)
+                where = f' at line {mark.line + 1}, column {mark.column + 1}' if mark else ''
+                raise CatalogError(f"Invalid YAML{where}: {getattr(e, 'problem', None) or e}")
+        else:
+            data = json.load(f)
+
+    entries = data.get('tools') if isinstance(data, dict) else data
+    if not isinstance(entries, list):
+        raise CatalogError('A catalog is a list of tools, or a mapping with a "tools" list')
+
+    tools, names = [], set()
+    for position, entry in enumerate(entries, 1):
+        if not isinstance(entry, dict) or not str(entry.get('name') or '').strip():
+            raise CatalogError(f'Tool #{position} needs a name')
+        unknown = set(entry) - set(CATALOG_FIELDS) - {'name'}
+        if unknown:
+            raise CatalogError(f"Tool #{position} has unknown fields: {', '.join(sorted(unknown))}")
+        tool = {**entry, 'name': str(entry['name']).strip()}
+        if tool['name'] in names:
+            raise CatalogError(f"Tool {tool['name']!r} appears more than once")
+        names.add(tool['name'])
+        try:
+            price = Decimal(str(tool.get('price')))
+        except (InvalidOperation, ValueError):
+            price = None
+        # Decimal accepts NaN and Infinity, which a price column can't store
+        if price is None or not price.is_finite():
+            raise CatalogError(f"Tool {tool['name']!r} needs a numeric price")
+        tool['price'] = price.quantize(Decimal('0.01'))
+        if tool['price'] < 0:
+            raise CatalogError(f"Tool {tool['name']!r} has a negative price")
+        if not all(isinstance(tool.get(name, ''), str) for name in ('description', 'price_id')):
+            raise CatalogError(f"Tool {tool['name']!r}: description and price_id must be text")
+        if not isinstance(tool.get('is_active', True), bool):
+            raise CatalogError(f"Tool {tool['name']!r}: is_active must be true or false")
+        tools.append(tool)
+    return tools
+
+
+@dataclass
+class CatalogDiff:
+    create: list = field(default_factory=list)
+    update: list = field(default_factory=list)
+    deactivate: list = field(default_factory=list)
+    unchanged: int = 0
+
+    @property
+    def changed(self):
+        return bool(self.create or self.update or self.deactivate)
+
+
+def diff_catalog(entries, prune=True, update=True):
+    """Compare catalog entries with the stored tools in one query
+
+    With update=False, tools that are already stored are left as they are
+    and only missing ones are created.
+    """
+    stored = {}
+    for tool in Tool.objects.only('name', *CATALOG_FIELDS).order_by('pk'):
+        if tool.name in stored:
+            raise CatalogError(f'Several stored tools are named {tool.name!r}; merge them before syncing')
+        stored[tool.name] = tool
+
+    diff = CatalogDiff()
+    for entry in entries:
+        tool = stored.pop(entry['name'], None)
+        if tool is None:
+            diff.create.append(Tool(**{**CATALOG_FIELDS, **entry}))
+            continue
+        changed = [name for name in CATALOG_FIELDS if name in entry and getattr(tool, name) != entry[name]]
+        if changed and update:
+            for name in changed:
+                setattr(tool, name, entry[name])
+            diff.update.append(tool)
+        else:
+            diff.unchanged += 1
+    if prune:
+        diff.deactivate = [tool for tool in stored.values() if tool.is_active]
+    return diff
+
+
+def apply_catalog(diff):
+    """Write a diff in one transaction and announce it once after commit"""
+    if not diff.changed:
+        return
+    now = timezone.now()
+    with transaction.atomic():
+        Tool.objects.bulk_create(diff.create)
+        for tool in diff.update:
+            tool.updated_at = now
+        Tool.objects.bulk_update(diff.update, [*CATALOG_FIELDS, 'updated_at'])
+        Tool.objects.filter(pk__in=[tool.pk for tool in diff.deactivate]).update(is_active=False, updated_at=now)
+        # Bulk writes bypass the model signals, so the caches hear about the whole push once
+        transaction.on_commit(lambda: catalog_changed.send(sender=Tool))
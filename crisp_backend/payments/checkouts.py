@@ -0,0 +1,73 @@
+"""
+Clean-up of checkouts that were never paid.
+
+create_checkout stores an inactive Subscription and a pending Payment per
+tool before sending the buyer to Stripe. When the session expires unpaid
+those rows would stay forever, inflating the (user, tool, status) scans and
+my_subscriptions. They are deleted when Stripe reports
+checkout.session.expired, and the reap_checkouts command sweeps up any
+whose event never arrived.
+
+Only subscriptions that are still inactive, and have no succeeded payment,
+are deleted, so a session completed in the meantime keeps its rows. The
+sweep also asks Stripe about each session first, at a limited rate, and
+leaves any that are not expired. A session paid near its deadline whose completed event is
+still being retried keeps its rows for that event to activate.
+"""
+import logging
+
+from django.db import transaction
+
+from .metrics import timed
+from .models import Subscription, Payment
+from .utils import get_stripe
+
+logger = logging.getLogger(__name__)
+
+
+def abandoned(queryset):
+    """Subscriptions in `queryset` that were never activated or paid for"""
+    return queryset.filter(status=Subscription.Status.INACTIVE).exclude(payment__status='succeeded')
+
+
+def delete_subscriptions(shard, subscription_ids):
+    """Delete the still-abandoned subset of `subscription_ids` and their payments
+
+    Returns (subscriptions, payments) deleted.
+    """
+    subscriptions = abandoned(Subscription.objects.using(shard).filter(pk__in=subscription_ids))
+    with transaction.atomic(using=shard):
+        ids = list(subscriptions.select_for_update().values_list('pk', flat=True))
+        if not ids:
+            return 0, 0
+        _, deleted = Subscription.objects.using(shard).filter(pk__in=ids).delete()
+    return deleted.get(Subscription._meta.label, 0), deleted.get(Payment._meta.label, 0)
+
+
+def reap_session(shard, session_id):
+    """Delete the unpaid rows created for one expired checkout session"""
+    ids = Payment.objects.using(shard).filter(
+        stripe_payment_intent_id=session_id, status='pending',
+    ).values_list('subscription_id', flat=True)
+    return delete_subscriptions(shard, ids)
+
+
+def confirmed_expired(session_ids, limiter=None):
+    """The subset of `session_ids` that Stripe reports expired; sessions it cannot look up are left out
+
+    With a RateLimiter, lookups are spaced to its rate.
+    """
+    stripe = get_stripe()
+    expired = set()
+    for session_id in session_ids:
+        if limiter:
+            limiter.wait()
+        try:
+            with timed('stripe'):
+                session = stripe.checkout.Session.retrieve(session_id)
+        except stripe.StripeError as e:
+            logger.warning('Could not look up checkout session %s: %s', session_id, e)
+            continue
+        if session.status == 'expired':
+            expired.add(session_id)
+    return expired
@@ -0,0 +1,114 @@
+"""
+Content-Encoding negotiation for API responses.
+
+Brotli is used when the `brotli` package is installed and the client
+accepts it, gzip otherwise. Dynamic responses are compressed per request at
+a fast setting by CompressionMiddleware. Payloads that are identical for
+every client, such as the tool catalog, are compressed once at the highest
+setting with precompress() and served from those stored bytes.
+
+Responses that carry a secret, such as a token, are marked with
+never_compress and go out uncompressed. If an attacker can get their own
+text reflected next to a secret, a compressed body shrinks whenever that
+text matches part of the secret, so its length leaks the secret (BREACH).
+"""
+import gzip
+import zlib
+from functools import wraps
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - gzip only
+    brotli = None
+
+# Per-request levels favour CPU; one-off precompression favours size
+FAST_LEVELS = {'br': 4, 'gzip': 6}
+BEST_LEVELS = {'br': 11, 'gzip': 9}
+
+
+def supported_encodings():
+    """Encodings we can produce, most preferred first"""
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def never_compress(view):
+    """Keep CompressionMiddleware off a view's responses; use on views that return secrets"""
+    @wraps(view)
+    def wrapped(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        response.never_compress = True
+        return response
+    return wrapped
+
+
+def negotiate(accept_encoding):
+    """Pick the best encoding allowed by an Accept-Encoding header, or None for identity"""
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        coding, _, params = part.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if coding:
+            accepted[coding.strip().lower()] = quality
+    wildcard = accepted.get('*', 0.0)
+    candidates = [
+        (accepted.get(encoding, wildcard), -index, encoding)
+        for index, encoding in enumerate(supported_encodings())
+    ]
+    quality, _, encoding = max(candidates)
+    return encoding if quality > 0 else None
+
+
+def compress(data, encoding, level=None):
+    level = FAST_LEVELS[encoding] if level is None else level
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def compress_stream(chunks, encoding):
+    """Compress an iterable of byte chunks, flushing after each so clients see progress"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=FAST_LEVELS['br'])
+        for chunk in chunks:
+            data = compressor.process(chunk) + compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+        return
+    compressor = zlib.compressobj(FAST_LEVELS['gzip'], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def precompress(body):
+    """{encoding: bytes} for a payload served many times, identity included"""
+    variants = {'identity': body}
+    if len(body) >= settings.COMPRESSION_MIN_SIZE:
+        for encoding in supported_encodings():
+            variants[encoding] = compress(body, encoding, BEST_LEVELS[encoding])
+    return variants
+
+
+def precompressed_response(request, variants, content_type='application/json'):
+    """Serve the stored variant the client accepts, without compressing anything"""
+    encoding = negotiate(request.META.get('HTTP_ACCEPT_ENCODING'))
+    if encoding not in variants:
+        encoding = 'identity'
+    response = HttpResponse(variants[encoding], content_type=content_type)
+    if encoding != 'identity':
+        response['Content-Encoding'] = encoding
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
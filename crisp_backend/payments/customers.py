@@ -0,0 +1,40 @@
+"""
+One Stripe Customer per user.
+
+Checkout sessions are opened for the user's Customer rather than a bare
+email, so repeat buyers see their saved cards and payments reconcile by
+customer ID. The Customer is created on the first checkout (or by the
+backfill_stripe_customers command) with an idempotency key derived from
+the user, so concurrent first checkouts or a re-run backfill get the same
+Customer back from Stripe instead of creating duplicates.
+"""
+from .metrics import timed
+from .models import UserProfile
+from .utils import get_stripe
+
+
+def idempotency_key(user_id):
+    return f'customer-user-{user_id}'
+
+
+def create_customer(user_id, email):
+    """Create (or, on a retry, fetch back) the Stripe Customer for a user; returns its ID"""
+    with timed('stripe'):
+        customer = get_stripe().Customer.create(
+            email=email,
+            metadata={'user_id': str(user_id)},
+            idempotency_key=idempotency_key(user_id),
+        )
+    return customer.id
+
+
+def stripe_customer_id(user):
+    """The user's Stripe Customer ID, creating the Customer on first use"""
+    customer_id = UserProfile.objects.filter(user=user).values_list('stripe_customer_id', flat=True).first()
+    if customer_id:
+        return customer_id
+
+    customer_id = create_customer(user.pk, user.email)
+    if not UserProfile.objects.filter(user=user).update(stripe_customer_id=customer_id):
+        UserProfile.objects.create(user=user, stripe_customer_id=customer_id)
+    return customer_id
@@ -0,0 +1,144 @@
+"""
+Short-lived signed entitlement tokens that tools can verify offline.
+
+Tokens are RS256 JWTs carrying the user's active tool IDs; tools verify them
+against the public key published at the JWKS endpoint instead of calling
+back into check_subscription on every page view.
+"""
+import base64
+import hashlib
+import json
+import logging
+from datetime import timedelta
+from functools import lru_cache
+
+import jwt
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.core.signals import setting_changed
+from django.db.models import Q
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Subscription
+from .signals import entitlements_changed
+
+logger = logging.getLogger(__name__)
+
+ALGORITHM = 'RS256'
+STREAM_TICKET_SALT = 'payments.entitlement_stream'
+
+
+def _b64(number):
+    raw = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+@lru_cache(maxsize=1)
+def signing_key():
+    """Load the RSA private key, or generate a throwaway one in DEBUG"""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    pem = settings.ENTITLEMENT_SIGNING_KEY
+    if pem:
+        return serialization.load_pem_private_key(pem.encode(), password=None)
+    if not settings.DEBUG:
+        raise RuntimeError('ENTITLEMENT_SIGNING_KEY must be set when DEBUG is off')
+    # Only processes forked after this call share the key; gunicorn.conf.py loads it in the master
+    logger.warning('ENTITLEMENT_SIGNING_KEY not set; using a throwaway key')
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+@lru_cache(maxsize=1)
+def public_jwk():
+    numbers = signing_key().public_key().public_numbers()
+    jwk = {'e': _b64(numbers.e), 'kty': 'RSA', 'n': _b64(numbers.n)}
+    # RFC 7638 thumbprint as the key id, so rotated keys get distinct kids
+    thumbprint = hashlib.sha256(json.dumps(jwk, separators=(',', ':'), sort_keys=True).encode()).digest()
+    jwk.update(kid=base64.urlsafe_b64encode(thumbprint).rstrip(b'=').decode(), alg=ALGORITHM, use='sig')
+    return jwk
+
+
+def jwks():
+    return {'keys': [public_jwk()]}
+
+
+def _cache_key(user_id):
+    return f'entitlement-token:{user_id}'
+
+
+def active_entitlements(user, now=None):
+    """(sorted active tool IDs, end of the first plan to lapse or None) in one query"""
+    now = now or timezone.now()
+    active = Subscription.objects.for_user(user).filter(
+        Q(end_date__isnull=True) | Q(end_date__gt=now),
+        status=Subscription.Status.ACTIVE,
+    ).values_list('tool_id', 'end_date')
+
+    tool_ids = sorted({tool_id for tool_id, _ in active})
+    end_dates = [end_date for _, end_date in active if end_date is not None]
+    return tool_ids, min(end_dates) if end_dates else None
+
+
+def issue_token(user):
+    """Return (token, expires_at) for the user's current entitlements, reusing a cached token"""
+    cached = cache.get(_cache_key(user.pk))
+    if cached:
+        return cached
+
+    now = timezone.now()
+    tool_ids, earliest_end = active_entitlements(user, now)
+
+    expires_at = now + timedelta(seconds=settings.ENTITLEMENT_TOKEN_LIFETIME)
+    if earliest_end is not None and earliest_end < expires_at:
+        expires_at = earliest_end
+
+    claims = {
+        'iss': settings.ENTITLEMENT_TOKEN_ISSUER,
+        'sub': str(user.pk),
+        'iat': int(now.timestamp()),
+        'exp': int(expires_at.timestamp()),
+        'tools': tool_ids,
+        'earliest_end': int(earliest_end.timestamp()) if earliest_end else None,
+    }
+    token = jwt.encode(claims, signing_key(), algorithm=ALGORITHM, headers={'kid': public_jwk()['kid']})
+
+    # Re-sign a little before expiry rather than hand out nearly-dead tokens
+    ttl = int((expires_at - now).total_seconds() * 0.8)
+    if ttl > 0:
+        cache.set(_cache_key(user.pk), (token, expires_at), ttl)
+    return token, expires_at
+
+
+def issue_stream_ticket(user):
+    """A ticket that opens the user's entitlement stream for ENTITLEMENT_STREAM_TICKET_SECONDS
+
+    EventSource can't send headers, so the ticket goes in the stream URL and
+    lands in access logs. Unlike an access token, it is good for nothing else.
+    """
+    return signing.TimestampSigner(salt=STREAM_TICKET_SALT).sign(str(user.pk))
+
+
+def stream_ticket_user_id(ticket):
+    """The user ID a stream ticket was issued to, or None when it is forged or expired"""
+    try:
+        user_id = signing.TimestampSigner(salt=STREAM_TICKET_SALT).unsign(
+            ticket, max_age=settings.ENTITLEMENT_STREAM_TICKET_SECONDS,
+        )
+    except signing.BadSignature:
+        return None
+    return int(user_id)
+
+
+@receiver(entitlements_changed)
+def invalidate_token(sender, user_id, **kwargs):
+    cache.delete(_cache_key(user_id))
+
+
+@receiver(setting_changed)
+def reset_signing_key(setting, **kwargs):
+    if setting == 'ENTITLEMENT_SIGNING_KEY':
+        signing_key.cache_clear()
+        public_jwk.cache_clear()
@@ -0,0 +1,162 @@
+"""
+Push notifications of entitlement changes to connected clients.
+
+Every entitlements_changed signal is published through the hub. Streams
+opened by entitlement_stream subscribe to their user's changes and wake
+up to send the new state instead of the client polling for it.
+
+Delivery across processes goes through EVENTS_BACKEND:
+
+- LocalBackend reaches only streams connected to the publishing process.
+  Streams in other processes see the change when they reread the state at
+  their next heartbeat.
+- PostgresNotifyBackend sends each change with NOTIFY on the `default`
+  database. Every process LISTENs on a dedicated connection and wakes its
+  own streams. It is the default on PostgreSQL. Each change costs the
+  publishing request one query on its `default` connection.
+"""
+import asyncio
+import logging
+import select
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .signals import entitlements_changed
+
+logger = logging.getLogger(__name__)
+
+
+class LocalBackend:
+    """Deliver changes only to streams connected to this process"""
+
+    def start(self, deliver):
+        self.deliver = deliver
+
+    def publish(self, user_id):
+        self.deliver(user_id)
+
+
+class PostgresNotifyBackend:
+    """Deliver changes to every process through LISTEN/NOTIFY on the `default` database"""
+    channel = 'entitlements_changed'
+    reconnect_delay = 5
+
+    def start(self, deliver):
+        self.deliver = deliver
+        threading.Thread(target=self._listen, name='entitlements-listener', daemon=True).start()
+
+    def publish(self, user_id):
+        with connections[DEFAULT_DB_ALIAS].cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, %s)', [self.channel, str(user_id)])
+
+    def _listen(self):
+        wrapper = connections[DEFAULT_DB_ALIAS]
+        while True:
+            try:
+                conn = wrapper.Database.connect(**wrapper.get_connection_params())
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(f'LISTEN {self.channel}')
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self.deliver(int(conn.notifies.pop(0).payload))
+            except Exception:
+                logger.exception('Entitlement listener lost its connection; reconnecting')
+                time.sleep(self.reconnect_delay)
+
+
+class Listener:
+    """One open stream waiting for its user's entitlements to change"""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.loop = asyncio.get_running_loop()
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        # Called from whichever thread published; changes coalesce until the stream wakes
+        try:
+            self.loop.call_soon_threadsafe(self.changed.set)
+        except RuntimeError:
+            pass  # the stream's event loop has closed
+
+    async def wait(self, timeout):
+        """True if a change arrived within `timeout` seconds"""
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+        except TimeoutError:
+            return False
+        self.changed.clear()
+        return True
+
+
+class Hub:
+    def __init__(self):
+        self._listeners = defaultdict(set)
+        self._lock = threading.Lock()
+        self._backend = None
+
+    @property
+    def backend(self):
+        with self._lock:
+            if self._backend is None:
+                self._backend = import_string(settings.EVENTS_BACKEND)()
+                self._backend.start(self.deliver)
+            return self._backend
+
+    def subscribe(self, user_id):
+        """Must be called from the stream's event loop"""
+        listener = Listener(user_id)
+        self.backend  # start listening for other processes before the first wait
+        with self._lock:
+            self._listeners[user_id].add(listener)
+        return listener
+
+    def unsubscribe(self, listener):
+        with self._lock:
+            listeners = self._listeners.get(listener.user_id)
+            if listeners is not None:
+                listeners.discard(listener)
+                if not listeners:
+                    del self._listeners[listener.user_id]
+
+    def publish(self, user_id):
+        self.backend.publish(user_id)
+
+    def deliver(self, user_id):
+        with self._lock:
+            listeners = list(self._listeners.get(user_id, ()))
+        for listener in listeners:
+            listener.notify()
+
+    def reset(self):
+        with self._lock:
+            self._backend = None
+
+
+hub = Hub()
+
+
+@receiver(entitlements_changed)
+def publish_change(sender, user_id, **kwargs):
+    try:
+        hub.publish(user_id)
+    except Exception:
+        # A lost push must not fail the billing change; streams resend the state on reconnect
+        logger.exception('Could not publish entitlement change for user %s', user_id)
+
+
+@receiver(setting_changed)
+def reset_backend(setting, **kwargs):
+    if setting == 'EVENTS_BACKEND':
+        hub.reset()
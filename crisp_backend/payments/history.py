@@ -0,0 +1,109 @@
+"""
+A user's payment history, newest first, read a page at a time.
+
+Pages are keyed on (created_at, id) rather than offsets, so each page is
+one index range scan however deep the client has scrolled, and rows
+inserted meanwhile do not shift later pages. The cursor handed back is
+the key of the last row served.
+
+Rows are flattened from a single values() query joining payments to
+their subscriptions. On `default` the tool name is joined in as well.
+Tools do not live on the other shards, so their names come from a
+second query for just the page's tools.
+"""
+import base64
+import json
+
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncMonth
+from django.utils.dateparse import parse_datetime
+
+from .models import Tool, Subscription, Payment
+
+MAX_PAGE_SIZE = 100
+
+FIELDS = [
+    'id', 'amount', 'currency', 'status', 'created_at', 'updated_at',
+    'subscription_id', 'subscription__tool_id', 'subscription__plan', 'subscription__status',
+]
+
+
+def encode_cursor(row):
+    key = json.dumps([row['created_at'].isoformat(), row['id']])
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """(created_at, id) from a cursor; raises ValueError if it was not made by encode_cursor"""
+    try:
+        created_at, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        created_at = parse_datetime(created_at)
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise ValueError('invalid cursor')
+    if created_at is None or not isinstance(pk, int):
+        raise ValueError('invalid cursor')
+    return created_at, pk
+
+
+def payments_for(user, status=None, since=None, until=None):
+    """The user's payments on their shard, filtered by status and a [since, until) window"""
+    queryset = Payment.objects.for_user(user)
+    if status:
+        queryset = queryset.filter(status=status)
+    if since:
+        queryset = queryset.filter(created_at__gte=since)
+    if until:
+        queryset = queryset.filter(created_at__lt=until)
+    return queryset
+
+
+def flatten(row, tool_names):
+    return {
+        'id': row['id'],
+        'amount': str(row['amount']),
+        'currency': row['currency'],
+        'status': row['status'],
+        'created_at': row['created_at'],
+        'updated_at': row['updated_at'],
+        'subscription_id': row['subscription_id'],
+        'tool_id': row['subscription__tool_id'],
+        'tool': tool_names.get(row['subscription__tool_id']),
+        'plan': Subscription.Plan(row['subscription__plan']).slug,
+        'subscription_status': Subscription.Status(row['subscription__status']).slug,
+    }
+
+
+def page(queryset, after=None, limit=50):
+    """Up to `limit` flattened rows past `after` (a decoded cursor), and the cursor for the next page or None"""
+    if after:
+        created_at, pk = after
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+
+    joined = queryset.db == DEFAULT_DB_ALIAS
+    fields = FIELDS + ['subscription__tool__name'] if joined else FIELDS
+    rows = list(queryset.order_by('-created_at', '-id').values(*fields)[:limit + 1])
+    more = len(rows) > limit
+    rows = rows[:limit]
+
+    if joined:
+        tool_names = {row['subscription__tool_id']: row['subscription__tool__name'] for row in rows}
+    else:
+        tool_names = dict(Tool.objects.filter(
+            pk__in={row['subscription__tool_id'] for row in rows},
+        ).values_list('id', 'name')) if rows else {}
+    return [flatten(row, tool_names) for row in rows], encode_cursor(rows[-1]) if more else None
+
+
+def monthly_totals(queryset):
+    """Amount and count per calendar month and currency, newest month first, summed in SQL
+
+    Amounts are strings, as DRF serializers render decimals.
+    """
+    return [
+        {'month': row['month'].strftime('%Y-%m'), 'currency': row['currency'],
+         'total': f"{row['total']:.2f}", 'count': row['count']}
+        for row in queryset.annotate(month=TruncMonth('created_at')).values('month', 'currency').annotate(
+            total=Sum('amount'), count=Count('id'),
+        ).order_by('-month', 'currency')
+    ]
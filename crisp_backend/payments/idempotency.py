@@ -0,0 +1,152 @@
+"""
+Idempotency-Key support for POST endpoints with side effects.
+
+Clients on flaky networks retry create_checkout, cancel_subscription and
+register. Without a key every retry calls Stripe, writes rows and sends
+email again. With the same Idempotency-Key header on each retry, the first
+request claims the key by inserting an IdempotencyKey row, runs the view
+and stores its response on the row and in the cache. A retry that arrives
+while the first request is still running polls the row until the response
+is stored. A retry that arrives later gets the stored response from the
+cache (or from the row, in another process) without running the view. In
+both cases the response carries an Idempotent-Replayed header.
+
+Keys are per user; anonymous requests share one scope. A key is bound to
+the method, path and body it was first sent with, and reusing it for a
+different request is a 422. 5xx, 409 and 429 responses are not stored, so
+their retry runs again. A claim whose request died is taken over after
+IDEMPOTENCY_LOCK_SECONDS. Rows expire after IDEMPOTENCY_TTL_HOURS, and
+purge_idempotency_keys deletes them.
+"""
+import functools
+import hashlib
+import json
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+# Responses a retry should not get back: the request may well succeed next time
+UNSTORED_STATUSES = {409, 429}
+
+
+class InFlight(Exception):
+    """The key's first request is still running after the wait"""
+
+
+def _cache_key(user_id, key):
+    return f'idempotency:{user_id or 0}:{hashlib.sha256(key.encode()).hexdigest()}'
+
+
+def fingerprint(request):
+    digest = hashlib.sha256(f'{request.method} {request.path}\n'.encode())
+    digest.update(request.body)
+    return digest.hexdigest()
+
+
+def claim(user_id, key, digest):
+    """Claim the key for this request
+
+    Returns (pk, None) once the key is ours, or (None, (fingerprint, status_code,
+    body)) with the stored response of an earlier request. Raises InFlight
+    when that request is still running after IDEMPOTENCY_WAIT_SECONDS.
+    """
+    deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT_SECONDS
+    delay = 0.05
+    while True:
+        now = timezone.now()
+        expires_at = now + timedelta(hours=settings.IDEMPOTENCY_TTL_HOURS)
+        try:
+            with transaction.atomic():
+                record = IdempotencyKey.objects.create(user_id=user_id, key=key, fingerprint=digest,
+                                                       locked_at=now, expires_at=expires_at)
+            return record.pk, None
+        except IntegrityError:
+            pass
+
+        row = IdempotencyKey.objects.filter(user_id=user_id, key=key).values_list(
+            'pk', 'fingerprint', 'status_code', 'body', 'locked_at', 'expires_at',
+        ).first()
+        if row is None:
+            continue  # released or purged meanwhile
+        pk, stored_digest, status_code, body, locked_at, stored_expiry = row
+
+        abandoned = status_code is None and locked_at <= now - timedelta(seconds=settings.IDEMPOTENCY_LOCK_SECONDS)
+        if stored_expiry <= now or abandoned:
+            # Conditional on locked_at, so only one of several retries takes it over
+            if IdempotencyKey.objects.filter(pk=pk, locked_at=locked_at).update(
+                fingerprint=digest, status_code=None, body='', locked_at=now, expires_at=expires_at,
+            ):
+                return pk, None
+            continue
+        if status_code is not None or stored_digest != digest:
+            return None, (stored_digest, status_code, body)
+        if time.monotonic() >= deadline:
+            raise InFlight
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+
+def replay(digest, stored):
+    """The stored response, or a 422 when the key was first used for another request"""
+    stored_digest, status_code, body = stored
+    if stored_digest != digest:
+        return Response({"detail": f"{HEADER} was already used for a different request"}, status=422)
+    return Response(json.loads(body) if body else None, status=status_code,
+                    headers={"Idempotent-Replayed": "true"})
+
+
+def store(pk, user_id, key, digest, response):
+    body = JSONRenderer().render(response.data).decode() if response.data is not None else ''
+    IdempotencyKey.objects.filter(pk=pk).update(status_code=response.status_code, body=body)
+    cache.set(_cache_key(user_id, key), (digest, response.status_code, body),
+              settings.IDEMPOTENCY_TTL_HOURS * 3600)
+
+
+def release(pk):
+    """Give the key up so the next retry runs the view again"""
+    IdempotencyKey.objects.filter(pk=pk).delete()
+
+
+def idempotent(view):
+    """Run `view` once per Idempotency-Key and user; goes below @api_view and @permission_classes"""
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if key is None:
+            return view(request, *args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return Response({"detail": f"{HEADER} must be 1 to {MAX_KEY_LENGTH} characters"}, status=400)
+
+        user_id = request.user.pk
+        digest = fingerprint(request)
+        stored = cache.get(_cache_key(user_id, key))
+        if stored is not None:
+            return replay(digest, stored)
+        try:
+            pk, stored = claim(user_id, key, digest)
+        except InFlight:
+            return Response({"detail": f"A request with this {HEADER} is still in progress"}, status=409)
+        if stored is not None:
+            return replay(digest, stored)
+
+        try:
+            response = view(request, *args, **kwargs)
+        except BaseException:
+            release(pk)
+            raise
+        if response.status_code >= 500 or response.status_code in UNSTORED_STATUSES:
+            release(pk)
+        else:
+            store(pk, user_id, key, digest, response)
+        return response
+    return wrapper
@@ -0,0 +1,118 @@
+from datetime import timedelta
+from itertools import groupby
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from payments.archive import rebuild_index, write_partition
+from payments.models import Tool, Subscription, Payment, UsageEvent
+from payments.sharding import all_shards
+
+# Tool names are filled in from `default`, since shards cannot join to tools
+PAYMENT_FIELDS = [
+    'id', 'user_id', 'subscription_id', 'subscription__tool_id',
+    'amount', 'currency', 'status', 'stripe_payment_intent_id', 'created_at', 'updated_at',
+]
+USAGE_FIELDS = [
+    'id', 'user_id', 'tool_id', 'subscription_id', 'quantity', 'occurred_at', 'event_id', 'created_at',
+]
+SUBSCRIPTION_FIELDS = [
+    'id', 'user_id', 'tool_id', 'plan', 'status', 'stripe_subscription_id',
+    'email', 'start_date', 'end_date', 'created_at', 'updated_at',
+]
+
+
+class Command(BaseCommand):
+    help = 'Move payments, usage events and dead subscriptions older than the retention window into compressed archive files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.BILLING_RETENTION_DAYS,
+                            help='Retention window in days (default: BILLING_RETENTION_DAYS)')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Rows written and deleted per batch')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report how many rows would be archived')
+        parser.add_argument('--reindex', action='store_true',
+                            help='Rebuild the per-user index files from the manifests, then exit')
+
+    def handle(self, *args, **options):
+        if options['reindex']:
+            for kind in ('payments', 'usage', 'subscriptions'):
+                self.stdout.write(f'Indexed {rebuild_index(kind)} {kind} partitions')
+            return
+
+        cutoff = timezone.now() - timedelta(days=options['days'])
+
+        self.tool_names = dict(Tool.objects.values_list('id', 'name'))
+        counts = {'payments': 0, 'usage': 0, 'subscriptions': 0}
+        for shard in all_shards():
+            payments = Payment.objects.using(shard).filter(created_at__lt=cutoff)
+            # Events not yet in an hourly rollup stay until rollup_usage has counted them
+            usage = UsageEvent.objects.using(shard).filter(created_at__lt=cutoff, rolled_up=True)
+            # Not active any more, nothing recent about them, and no payments or usage
+            # left behind (deleting a subscription would cascade to both).
+            subscriptions = Subscription.objects.using(shard).filter(
+                updated_at__lt=cutoff,
+                payment__isnull=True,
+                usageevent__isnull=True,
+            ).exclude(
+                status=Subscription.Status.ACTIVE, end_date__isnull=True,
+            ).exclude(
+                status=Subscription.Status.ACTIVE, end_date__gte=cutoff,
+            )
+
+            if options['dry_run']:
+                counts['payments'] += payments.count()
+                counts['usage'] += usage.count()
+                counts['subscriptions'] += subscriptions.count()
+                continue
+
+            counts['payments'] += self.archive('payments', payments, PAYMENT_FIELDS, options['chunk_size'])
+            counts['usage'] += self.archive('usage', usage, USAGE_FIELDS, options['chunk_size'])
+            counts['subscriptions'] += self.archive(
+                'subscriptions', subscriptions, SUBSCRIPTION_FIELDS, options['chunk_size'],
+            )
+
+        if options['dry_run']:
+            self.stdout.write(f"Would archive {counts['payments']} payments, {counts['usage']} usage events "
+                              f"and {counts['subscriptions']} subscriptions")
+            return
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {counts['payments']} payments, {counts['usage']} usage events "
+            f"and {counts['subscriptions']} subscriptions "
+            f'older than {cutoff:%Y-%m-%d}'
+        ))
+
+    def export(self, model, row):
+        """Flatten related-field keys and write subscription enums as their API slugs"""
+        row = {key.replace('subscription__', '').replace('__', '_'): value for key, value in row.items()}
+        row['tool_name'] = self.tool_names.get(row['tool_id'])
+        if model is Subscription:
+            row['plan'] = Subscription.Plan(row['plan']).slug
+            row['status'] = Subscription.Status(row['status']).slug
+        return row
+
+    def archive(self, kind, queryset, fields, chunk_size):
+        """Walk `queryset` in primary-key order, archiving and deleting one chunk at a time"""
+        total = 0
+        last_pk = 0
+        while True:
+            rows = list(queryset.filter(pk__gt=last_pk).order_by('pk').values(*fields)[:chunk_size])
+            if not rows:
+                return total
+            last_pk = rows[-1]['id']
+
+            for _, month_rows in groupby(
+                sorted(rows, key=lambda row: (row['created_at'].strftime('%Y%m'), row['id'])),
+                key=lambda row: row['created_at'].strftime('%Y%m'),
+            ):
+                month_rows = [self.export(queryset.model, row) for row in month_rows]
+                path = write_partition(kind, month_rows, shard=queryset.db)
+                # write_partition only returns after the checksum was verified
+                with transaction.atomic(using=queryset.db):
+                    queryset.model.objects.using(queryset.db).filter(pk__in=[row['id'] for row in month_rows]).delete()
+                total += len(month_rows)
+                self.stdout.write(f'  {kind}: {len(month_rows)} rows -> {path}')
@@ -0,0 +1,64 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from payments.customers import create_customer
+from payments.models import UserProfile
+from payments.utils import RateLimiter, get_stripe
+
+
+class Command(BaseCommand):
+    help = 'Create a Stripe Customer for every user profile that has none yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Profiles read and updated per batch')
+        parser.add_argument('--workers', type=int, default=8,
+                            help='Concurrent Stripe requests')
+        # Stripe allows 100 requests per second in live mode, shared with checkout traffic
+        parser.add_argument('--rate', type=float, default=25,
+                            help='Most Customer creations per second (default: 25)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report how many profiles have no Customer')
+
+    def handle(self, *args, **options):
+        # Concurrent checkouts may fill in a Customer meanwhile; those rows are left alone
+        pending = UserProfile.objects.filter(stripe_customer_id='')
+        if options['dry_run']:
+            self.stdout.write(f'{pending.count()} profiles have no Stripe Customer')
+            return
+
+        limiter = RateLimiter(options['rate'])
+        stripe = get_stripe()
+
+        def create(row):
+            profile_id, user_id, email = row
+            limiter.wait()
+            try:
+                return UserProfile(pk=profile_id, stripe_customer_id=create_customer(user_id, email))
+            except stripe.StripeError as e:
+                self.stderr.write(f'  user {user_id}: {e}')
+                return None
+
+        created = failed = 0
+        last_pk = 0
+        with ThreadPoolExecutor(max_workers=options['workers'], thread_name_prefix='backfill') as pool:
+            while True:
+                rows = list(pending.filter(pk__gt=last_pk).order_by('pk').values_list(
+                    'pk', 'user_id', 'user__email',
+                )[:options['batch_size']])
+                if not rows:
+                    break
+                last_pk = rows[-1][0]
+
+                profiles = [profile for profile in pool.map(create, rows) if profile is not None]
+                pending.bulk_update(profiles, ['stripe_customer_id'])
+                created += len(profiles)
+                failed += len(rows) - len(profiles)
+                self.stdout.write(f'  {created} customers created')
+
+        message = f'Created {created} Stripe customers'
+        if failed:
+            self.stdout.write(self.style.WARNING(f'{message}; {failed} failed and can be retried by running again'))
+        else:
+            self.stdout.write(self.style.SUCCESS(message))
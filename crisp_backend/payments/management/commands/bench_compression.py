@@ -0,0 +1,75 @@
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from payments.compression import (
+    BEST_LEVELS, FAST_LEVELS, compress, precompress, precompressed_response, supported_encodings,
+)
+
+
+class Command(BaseCommand):
+    help = 'Compare CPU time against bytes saved for each encoding on representative API payloads'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=50,
+                            help='Tools in the catalog payload and subscriptions in the list payload')
+        parser.add_argument('--iterations', type=int, default=200,
+                            help='Timed runs per encoding and level')
+
+    def payloads(self, rows):
+        now = timezone.now()
+        catalog = [{
+            'id': i,
+            'name': f'Tool {i}',
+            'description': f'AI-powered assistant number {i} for analytics, writing and support workflows.',
+            'price': str(Decimal('19.99')),
+            'is_active': True,
+            'created_at': now.isoformat(),
+            'updated_at': now.isoformat(),
+        } for i in range(rows)]
+        subscriptions = [{
+            'id': i,
+            'tool': f'Tool {i}',
+            'tool_id': i,
+            'status': 'active',
+            'plan': '12-month',
+            'created_at': now.isoformat(),
+            'updated_at': now.isoformat(),
+            'end_date': (now + timedelta(days=365)).isoformat(),
+        } for i in range(rows)]
+        renderer = JSONRenderer()
+        return {'tool catalog': renderer.render(catalog), 'my_subscriptions': renderer.render(subscriptions)}
+
+    def timed(self, func, iterations):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            result = func()
+        return result, (time.perf_counter() - start) / iterations
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        self.stdout.write(f"{'payload':<18}{'encoding':<10}{'level':>6}{'bytes':>9}{'saved':>8}{'us/op':>10}{'MB/s':>9}")
+        for name, body in self.payloads(options['rows']).items():
+            self.stdout.write(f"{name:<18}{'identity':<10}{'':>6}{len(body):>9}{'0%':>8}{'':>10}{'':>9}")
+            for encoding in supported_encodings():
+                for level in sorted({FAST_LEVELS[encoding], BEST_LEVELS[encoding]}):
+                    compressed, seconds = self.timed(lambda: compress(body, encoding, level), iterations)
+                    saved = 1 - len(compressed) / len(body)
+                    self.stdout.write(
+                        f'{name:<18}{encoding:<10}{level:>6}{len(compressed):>9}{saved:>8.0%}'
+                        f'{seconds * 1e6:>10.0f}{len(body) / seconds / 1e6:>9.1f}'
+                    )
+
+        # What a precompressed catalog costs per request once it is cached
+        variants = precompress(self.payloads(options['rows'])['tool catalog'])
+        request = RequestFactory().get('/api/tools/', HTTP_ACCEPT_ENCODING=', '.join(supported_encodings()))
+        response, seconds = self.timed(lambda: precompressed_response(request, variants), iterations)
+        self.stdout.write(self.style.SUCCESS(
+            f"Precompressed catalog: {response['Content-Encoding']} {len(response.content)} bytes "
+            f'served in {seconds * 1e6:.0f} us/request'
+        ))
@@ -0,0 +1,113 @@
+import statistics
+import time
+import uuid
+from contextlib import ExitStack
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.handlers.base import BaseHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+from django.test import RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import AccessToken
+
+from payments.models import Tool, Subscription
+
+SCOPED = 'payments.middleware.PathScopedMiddleware'
+TIMING = 'payments.middleware.ServerTimingMiddleware'
+
+
+def full_stack():
+    """The flat stack every request went through before SITE_MIDDLEWARE was path-scoped"""
+    return [path for path in settings.MIDDLEWARE if path != SCOPED] + settings.SITE_MIDDLEWARE
+
+
+class Command(BaseCommand):
+    help = ('Compare per-request middleware overhead of the full stack and the path-scoped API stack, '
+            'and check the cost of metrics on check_subscription')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='/api/tools/', help='Path to request (default: /api/tools/)')
+        parser.add_argument('--iterations', type=int, default=2000, help='Timed requests per stack')
+        parser.add_argument('--metrics-budget', type=float, default=0.02,
+                            help='Fail if metrics slow check_subscription by more than this fraction (default: 0.02)')
+
+    def handler(self, middleware):
+        with override_settings(MIDDLEWARE=middleware):
+            handler = BaseHandler()
+            handler.load_middleware()
+        return handler
+
+    def timed(self, handler, request, iterations):
+        handler.get_response(request)  # warm caches and connections
+        with CaptureQueriesContext(connection) as queries:
+            handler.get_response(request)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            handler.get_response(request)
+        return (time.perf_counter() - start) / iterations, len(queries)
+
+    def handle(self, *args, **options):
+        # A browser that has visited the admin sends its session cookie to the API too
+        request = RequestFactory().get(options['path'], HTTP_COOKIE='sessionid=benchmark; csrftoken=benchmark')
+        stacks = {'full': full_stack(), 'scoped': settings.MIDDLEWARE}
+
+        self.stdout.write(f"GET {options['path']}, {options['iterations']} requests per stack")
+        self.stdout.write(f"{'stack':<8}{'middleware':>12}{'us/request':>12}{'queries':>9}")
+        results = {}
+        for name, middleware in stacks.items():
+            seconds, queries = self.timed(self.handler(middleware), request, options['iterations'])
+            results[name] = seconds
+            self.stdout.write(f'{name:<8}{len(middleware):>12}{seconds * 1e6:>12.0f}{queries:>9}')
+
+        saved = results['full'] - results['scoped']
+        self.stdout.write(self.style.SUCCESS(
+            f'Path-scoped stack saves {saved * 1e6:.0f} us per request ({saved / results["full"]:.0%})'
+        ))
+
+        with_metrics, without = self.metrics_overhead(options['iterations'])
+        overhead = with_metrics / without - 1
+        self.stdout.write(
+            f'check_subscription: {without * 1e6:.0f} us without metrics, {with_metrics * 1e6:.0f} us with '
+            f'({overhead:+.1%})'
+        )
+        if overhead > options['metrics_budget']:
+            raise CommandError(f"Metrics add {overhead:.1%} to check_subscription, "
+                               f"over the {options['metrics_budget']:.0%} budget")
+
+    def metrics_overhead(self, iterations):
+        """Median seconds per check_subscription request with and without ServerTimingMiddleware
+
+        The user, tool and subscription it checks are rolled back afterwards.
+        """
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(transaction.atomic(using=alias))
+            name = f'bench-{uuid.uuid4().hex}'
+            user = User.objects.create_user(name, f'{name}@example.com')
+            tool = Tool.objects.create(name=name, description='', price=Decimal('9.99'))
+            Subscription.objects.create(user=user, tool=tool, plan=Subscription.Plan.ONE_MONTH,
+                                        status=Subscription.Status.ACTIVE, end_date=timezone.now() + timedelta(days=30))
+            request = RequestFactory().get(reverse('check_subscription'), {'tool_name': name},
+                                           HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+            handlers = {
+                'with': self.handler(settings.MIDDLEWARE),
+                'without': self.handler([path for path in settings.MIDDLEWARE if path != TIMING]),
+            }
+            samples = {key: [] for key in handlers}
+            for handler in handlers.values():
+                handler.get_response(request)  # warm caches and connections
+            # Alternate request by request, so drift in machine load hits both sides alike
+            for _ in range(iterations):
+                for key, handler in handlers.items():
+                    start = time.perf_counter()
+                    handler.get_response(request)
+                    samples[key].append(time.perf_counter() - start)
+            for alias in connections:
+                transaction.set_rollback(True, using=alias)
+        return statistics.median(samples['with']), statistics.median(samples['without'])
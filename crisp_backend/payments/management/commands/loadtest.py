@@ -0,0 +1,103 @@
+import http.client
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _client(args):
+    """Hammer one keep-alive connection until the deadline; return latencies in seconds"""
+    port, path, deadline = args
+    latencies = []
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    while time.time() < deadline:
+        start = time.perf_counter()
+        try:
+            conn.request('GET', path)
+            conn.getresponse().read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+            continue
+        latencies.append(time.perf_counter() - start)
+    conn.close()
+    return latencies
+
+
+class Command(BaseCommand):
+    help = 'Measure throughput of the production gunicorn entrypoint across worker counts'
+
+    def add_arguments(self, parser):
+        cores = os.cpu_count() or 1
+        default_workers = sorted({1, *(2 ** i for i in range(1, cores.bit_length()) if 2 ** i <= cores), cores})
+        parser.add_argument('--workers', default=','.join(map(str, default_workers)),
+                            help='Comma-separated worker counts to try (default: powers of two up to the core count)')
+        parser.add_argument('--clients', type=int, default=16, help='Concurrent client connections')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds of load per worker count')
+        parser.add_argument('--path', default='/healthz', help='Path to request (default: /healthz)')
+
+    def handle(self, *args, **options):
+        worker_counts = [int(count) for count in options['workers'].split(',')]
+        self.stdout.write(f'{os.cpu_count()} CPUs, {options["clients"]} clients, '
+                          f'{options["duration"]:.0f}s per run, GET {options["path"]}')
+        self.stdout.write(f'{"workers":>8}{"req/s":>12}{"p50 ms":>10}{"p99 ms":>10}{"speedup":>10}')
+
+        baseline = None
+        for workers in worker_counts:
+            rate, p50, p99 = self.run(workers, options)
+            baseline = baseline or rate
+            self.stdout.write(f'{workers:>8}{rate:>12.0f}{p50:>10.1f}{p99:>10.1f}{rate / baseline:>9.2f}x')
+
+    def run(self, workers, options):
+        port = _free_port()
+        with tempfile.TemporaryDirectory() as tmp:
+            server = subprocess.Popen(
+                [sys.executable, '-m', 'gunicorn', 'crisp_backend.asgi:application',
+                 '-c', 'gunicorn.conf.py', '--workers', str(workers), '--bind', f'127.0.0.1:{port}',
+                 '--pid', os.path.join(tmp, 'gunicorn.pid'), '--access-logfile', os.devnull,
+                 '--max-requests', '0'],
+                cwd=settings.BASE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                # Keep out of the metrics of a server running on this host
+                env={**os.environ, 'PROMETHEUS_MULTIPROC_DIR': os.path.join(tmp, 'metrics')},
+            )
+            try:
+                self.wait_ready(port, server)
+                deadline = time.time() + options['duration']
+                with multiprocessing.Pool(options['clients']) as pool:
+                    results = pool.map(_client, [(port, options['path'], deadline)] * options['clients'])
+            finally:
+                server.terminate()
+                server.wait(timeout=30)
+
+        latencies = sorted(latency for result in results for latency in result)
+        if not latencies:
+            raise CommandError(f'No successful requests with {workers} workers')
+        rate = len(latencies) / options['duration']
+        return rate, latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000
+
+    def wait_ready(self, port, server, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if server.poll() is not None:
+                raise CommandError('gunicorn exited during startup')
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+                conn.request('GET', '/readyz')
+                if conn.getresponse().status == 200:
+                    return
+            except OSError:
+                pass
+            time.sleep(0.2)
+        raise CommandError('gunicorn did not become ready')
@@ -0,0 +1,83 @@
+import json
+import os
+import re
+import subprocess
+import sys
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Runs in a fresh interpreter: build the WSGI app and serve one request
+CHILD = """
+import json, os, sys, time
+from wsgiref.util import setup_testing_defaults
+
+start = time.perf_counter()
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'crisp_backend.settings')
+from django.core.wsgi import get_wsgi_application
+application = get_wsgi_application()
+ready = time.perf_counter()
+
+environ = {'PATH_INFO': sys.argv[1], 'HTTP_HOST': 'localhost'}
+setup_testing_defaults(environ)
+status = []
+b''.join(application(environ, lambda s, headers, exc_info=None: status.append(s)))
+done = time.perf_counter()
+
+print(json.dumps({
+    'setup_ms': (ready - start) * 1000,
+    'first_request_ms': (done - ready) * 1000,
+    'status': status[0],
+    'modules': sorted(sys.modules),
+}))
+"""
+
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$')
+
+
+class Command(BaseCommand):
+    help = 'Report import-time breakdown and time-to-first-request for a cold process'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='/metrics', help='Path of the first request (default: /metrics)')
+        parser.add_argument('--top', type=int, default=15, help='Number of packages to list')
+        parser.add_argument('--budget-ms', type=float, default=None,
+                            help='Fail if imports plus the first request take longer than this')
+        parser.add_argument('--forbid', action='append', default=[], metavar='MODULE',
+                            help='Fail if MODULE was imported by startup and the first request')
+
+    def handle(self, *args, **options):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'crisp_backend.settings'))
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', CHILD, options['path']],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True,
+        )
+        if result.returncode != 0:
+            raise CommandError(f'Startup probe failed:\n{result.stderr[-4000:]}')
+        report = json.loads(result.stdout.strip().splitlines()[-1])
+
+        # Self times add up without double counting nested imports
+        self_us = defaultdict(int)
+        for line in result.stderr.splitlines():
+            match = IMPORTTIME_LINE.match(line)
+            if match:
+                self_us[match.group(4).split('.')[0]] += int(match.group(1))
+        import_ms = sum(self_us.values()) / 1000
+
+        self.stdout.write(f'{"package":<32}{"self ms":>10}')
+        for package, micros in sorted(self_us.items(), key=lambda item: -item[1])[:options['top']]:
+            self.stdout.write(f'{package:<32}{micros / 1000:>10.1f}')
+        self.stdout.write('')
+        self.stdout.write(f'Imports:            {import_ms:.1f} ms')
+        self.stdout.write(f'django.setup():     {report["setup_ms"]:.1f} ms')
+        self.stdout.write(f'First request:      {report["first_request_ms"]:.1f} ms ({options["path"]} -> {report["status"]})')
+
+        total_ms = report['setup_ms'] + report['first_request_ms']
+        self.stdout.write(f'Time to first byte: {total_ms:.1f} ms')
+
+        if options['budget_ms'] is not None and total_ms > options['budget_ms']:
+            raise CommandError(f'Cold start took {total_ms:.1f} ms, budget is {options["budget_ms"]:.0f} ms')
+        loaded = sorted(set(options['forbid']) & set(report['modules']))
+        if loaded:
+            raise CommandError(f'Imported at startup: {", ".join(loaded)}')
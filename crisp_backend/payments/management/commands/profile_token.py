@@ -0,0 +1,13 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from payments.profiling import make_token
+
+
+class Command(BaseCommand):
+    help = 'Print a signed X-Profile-Request header value that makes the server profile a request'
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'X-Profile-Request: {make_token()}')
+        self.stderr.write(f'Valid for {settings.PROFILE_TOKEN_MAX_AGE} seconds; '
+                          'profiles appear under Request profiles in the admin.')
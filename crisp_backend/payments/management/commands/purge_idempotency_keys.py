@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from payments.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    help = 'Delete stored Idempotency-Key responses past IDEMPOTENCY_TTL_HOURS'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Rows deleted per statement')
+
+    def handle(self, *args, **options):
+        expired = IdempotencyKey.objects.filter(expires_at__lte=timezone.now())
+        deleted = 0
+        while True:
+            ids = list(expired.values_list('pk', flat=True)[:options['chunk_size']])
+            if not ids:
+                break
+            # Re-checked, since a retry may have taken a key over meanwhile
+            deleted += expired.filter(pk__in=ids).delete()[0]
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} expired idempotency keys'))
@@ -0,0 +1,66 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from payments.checkouts import abandoned, confirmed_expired, delete_subscriptions
+from payments.models import Subscription, Payment
+from payments.sharding import all_shards
+from payments.utils import RateLimiter
+
+
+class Command(BaseCommand):
+    help = 'Delete the inactive subscriptions and pending payments of checkouts Stripe confirms expired'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=float, default=settings.CHECKOUT_SESSION_TTL_HOURS,
+                            help='Check checkouts started longer ago than this (default: CHECKOUT_SESSION_TTL_HOURS)')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Subscriptions deleted per statement')
+        parser.add_argument('--rate', type=float, default=25,
+                            help='Maximum Stripe session lookups per second (default: 25)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report how many checkouts would be reaped')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(hours=options['hours'])
+        counts = {'subscriptions': 0, 'payments': 0, 'kept': 0}
+        limiter = RateLimiter(options['rate'])
+        for shard in all_shards():
+            stale = abandoned(Subscription.objects.using(shard).filter(created_at__lt=cutoff))
+            if options['dry_run']:
+                counts['subscriptions'] += stale.count()
+                continue
+
+            # Walk in primary-key order so each chunk query starts where the last one stopped
+            last_pk = 0
+            while True:
+                ids = list(stale.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:options['chunk_size']])
+                if not ids:
+                    break
+                last_pk = ids[-1]
+                # Only sessions Stripe confirms expired; one paid late may still have its event in retry
+                sessions = dict(Payment.objects.using(shard).filter(subscription_id__in=ids).values_list(
+                    'subscription_id', 'stripe_payment_intent_id',
+                ))
+                expired = confirmed_expired({session for session in sessions.values() if session}, limiter)
+                reap = [pk for pk in ids if sessions.get(pk) in expired]
+                counts['kept'] += len(ids) - len(reap)
+                subscriptions, payments = delete_subscriptions(shard, reap)
+                counts['subscriptions'] += subscriptions
+                counts['payments'] += payments
+                self.stdout.write(f'  {shard}: {subscriptions} subscriptions, {payments} payments')
+
+        if options['dry_run']:
+            self.stdout.write(f"Would check {counts['subscriptions']} abandoned checkouts older than "
+                              f'{cutoff:%Y-%m-%d %H:%M} with Stripe')
+            return
+        message = (f"Reaped {counts['subscriptions']} subscriptions and {counts['payments']} payments "
+                   f'from checkouts started before {cutoff:%Y-%m-%d %H:%M}')
+        if counts['kept']:
+            self.stdout.write(self.style.WARNING(
+                f"{message}; kept {counts['kept']} whose Stripe session is not confirmed expired"
+            ))
+        else:
+            self.stdout.write(self.style.SUCCESS(message))
@@ -0,0 +1,54 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from payments.models import Subscription
+from payments.sharding import all_shards, move_user, ring
+
+
+class Command(BaseCommand):
+    help = 'Move users whose arc of the shard ring changed hands onto their new shard, one user at a time'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='User IDs read from a shard per query')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report how many users would move')
+
+    def user_ids(self, shard, batch_size):
+        """Every user with rows on `shard`, walked in user-id order"""
+        last_id = 0
+        while True:
+            batch = list(
+                Subscription.objects.using(shard).filter(user_id__gt=last_id)
+                .order_by('user_id').values_list('user_id', flat=True).distinct()[:batch_size]
+            )
+            if not batch:
+                return
+            yield from batch
+            last_id = batch[-1]
+
+    def handle(self, *args, **options):
+        users = subscriptions = 0
+        for source in all_shards():
+            moving = 0
+            for user_id in self.user_ids(source, options['batch_size']):
+                target = ring().node_for(user_id)
+                if target == source:
+                    continue
+                moving += 1
+                if not options['dry_run']:
+                    moved = move_user(user_id, source, target)
+                    subscriptions += moved
+                    if options['verbosity'] > 1:
+                        self.stdout.write(f'  user {user_id}: {moved} subscriptions {source} -> {target}')
+            if moving:
+                self.stdout.write(f'{source}: {moving} users to move')
+            users += moving
+
+        if options['dry_run']:
+            self.stdout.write(f'Would move {users} users')
+            return
+
+        self.stdout.write(self.style.SUCCESS(f'Moved {users} users ({subscriptions} subscriptions)'))
+        if settings.SHARDS_PREVIOUS:
+            self.stdout.write('Every user is on the current ring; SHARDS_PREVIOUS can be unset.')
@@ -0,0 +1,42 @@
+import os
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from payments.metering import read_segment, store_usage
+
+
+class Command(BaseCommand):
+    help = 'Store usage events left in USAGE_LOG_DIR by workers that stopped before flushing them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=300,
+                            help='Only replay segments not written to for this many seconds')
+        parser.add_argument('--batch-size', type=int, default=settings.USAGE_FLUSH_SIZE,
+                            help='Events inserted per bulk insert')
+
+    def handle(self, *args, **options):
+        if not settings.USAGE_LOG_DIR:
+            raise CommandError('USAGE_LOG_DIR is not set')
+        directory = Path(settings.USAGE_LOG_DIR)
+        cutoff = time.time() - options['older_than']
+        segments = events = 0
+        for path in sorted(directory.glob('*.ndjson')):
+            if path.stat().st_mtime > cutoff:
+                continue  # probably still being written by a live worker
+            batch = []
+            for event in read_segment(path):
+                batch.append(event)
+                if len(batch) >= options['batch_size']:
+                    store_usage(batch)
+                    events += len(batch)
+                    batch = []
+            if batch:
+                store_usage(batch)
+                events += len(batch)
+            # Already-stored events were skipped, so the segment is fully stored now
+            os.remove(path)
+            segments += 1
+        self.stdout.write(self.style.SUCCESS(f'Replayed {events} usage events from {segments} segments'))
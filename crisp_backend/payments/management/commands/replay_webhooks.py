@@ -0,0 +1,137 @@
+import http.client
+import json
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.urls import reverse
+
+from payments.synthetic import cleanup, schedule, seed_checkouts, sign, verify
+from payments.utils import RateLimiter
+
+
+class Command(BaseCommand):
+    help = 'Replay signed synthetic Stripe checkout events against stripe_webhook and check the final states'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sessions', type=int, default=1000,
+                            help='Synthetic checkouts to seed, one user each')
+        parser.add_argument('--rate', type=float, default=100,
+                            help='Target events per second (default: 100)')
+        parser.add_argument('--concurrency', type=int, default=8,
+                            help='Events in flight at once')
+        parser.add_argument('--duplicates', type=float, default=0.1,
+                            help='Share of events delivered a second time (default: 0.1)')
+        parser.add_argument('--out-of-order', type=float, default=0.1,
+                            help='Share of events delivered after later ones (default: 0.1)')
+        parser.add_argument('--expire-ratio', type=float, default=0.2,
+                            help='Share of checkouts that expire instead of completing (default: 0.2)')
+        parser.add_argument('--url',
+                            help='Full webhook URL of a server sharing this database; '
+                                 'without it events are sent to the app in-process')
+        parser.add_argument('--seed', type=int, help='Random seed, for a repeatable schedule')
+        parser.add_argument('--keep', action='store_true',
+                            help='Leave the synthetic users and checkouts in place afterwards')
+
+    def handle(self, *args, **options):
+        secret = settings.STRIPE_WEBHOOK_SECRET
+        if not secret:
+            raise CommandError('STRIPE_WEBHOOK_SECRET must be set to sign the events')
+
+        rng = random.Random(options['seed'])
+        tool, checkouts = seed_checkouts(options['sessions'], rng, options['expire_ratio'])
+        try:
+            events, duplicated, reordered = schedule(checkouts, rng, options['duplicates'], options['out_of_order'])
+            self.stdout.write(f'Replaying {len(events)} events for {len(checkouts)} checkouts '
+                              f'({duplicated} duplicates, {reordered} out of order) '
+                              f'at {options["rate"]:g}/s with concurrency {options["concurrency"]}')
+
+            send = self.http_sender(options['url']) if options['url'] else self.local_sender()
+            limiter = RateLimiter(options['rate'])
+
+            def deliver(event):
+                payload = json.dumps(event).encode()
+                limiter.wait()
+                # Signed at send time so a long replay stays within Stripe's timestamp tolerance
+                signature = sign(payload, secret)
+                start = time.perf_counter()
+                status = send(payload, signature)
+                return status, time.perf_counter() - start
+
+            started = time.perf_counter()
+            if options['concurrency'] == 1:
+                results = [deliver(event) for event in events]
+            else:
+                with ThreadPoolExecutor(max_workers=options['concurrency'], thread_name_prefix='webhook') as pool:
+                    results = list(pool.map(deliver, events))
+            elapsed = time.perf_counter() - started
+
+            self.report(results, elapsed)
+            wrong = self.report_states(verify(checkouts))
+        finally:
+            if not options['keep']:
+                cleanup(tool, checkouts)
+
+        if wrong:
+            raise CommandError(f'{wrong} checkouts ended in the wrong state')
+        self.stdout.write(self.style.SUCCESS('Every checkout ended in the state its event implies'))
+
+    def local_sender(self):
+        path = reverse('stripe_webhook')
+        local = threading.local()
+
+        def send(payload, signature):
+            if not hasattr(local, 'client'):
+                local.client = Client()
+            return local.client.post(path, payload, content_type='application/json',
+                                     HTTP_STRIPE_SIGNATURE=signature).status_code
+        return send
+
+    def http_sender(self, url):
+        parts = urlsplit(url)
+        connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        path = parts.path or '/'
+        local = threading.local()
+
+        def send(payload, signature):
+            # One keep-alive connection per sending thread
+            if not hasattr(local, 'conn'):
+                local.conn = connection_class(parts.netloc, timeout=30)
+            try:
+                local.conn.request('POST', path, payload, {
+                    'Content-Type': 'application/json', 'Stripe-Signature': signature,
+                })
+                response = local.conn.getresponse()
+                response.read()
+                return response.status
+            except (OSError, http.client.HTTPException):
+                local.conn.close()
+                del local.conn
+                return 'error'
+        return send
+
+    def report(self, results, elapsed):
+        statuses = Counter(status for status, _ in results)
+        latencies = sorted(latency for _, latency in results)
+        if latencies:
+            p50 = latencies[len(latencies) // 2] * 1000
+            p99 = latencies[int(len(latencies) * 0.99)] * 1000
+            self.stdout.write(f'{len(results) / elapsed:.0f} events/s over {elapsed:.1f}s, '
+                              f'p50 {p50:.1f} ms, p99 {p99:.1f} ms')
+        self.stdout.write('Responses: ' + ', '.join(
+            f'{status}: {count}' for status, count in sorted(statuses.items(), key=lambda item: str(item[0]))
+        ))
+
+    def report_states(self, states):
+        ok, total = states['completed']
+        self.stdout.write(f'  completed: {ok}/{total} active and paid')
+        wrong = total - ok
+        ok, total = states['expired']
+        self.stdout.write(f'  expired: {ok}/{total} removed')
+        return wrong + total - ok
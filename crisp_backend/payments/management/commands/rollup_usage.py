@@ -0,0 +1,74 @@
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncHour
+from django.core.management.base import BaseCommand
+
+from payments.models import UsageEvent, UsageRollup
+from payments.sharding import all_shards
+
+
+class Command(BaseCommand):
+    help = 'Add stored usage events to the per-user, per-tool hourly rollups invoices are built from'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='Usage events rolled up per transaction')
+
+    def rollup_chunk(self, shard, batch_size):
+        """Fold the oldest pending events into their rollups; returns (events, rollups touched)"""
+        with transaction.atomic(using=shard):
+            # Locking the chunk makes a concurrent run wait and then skip these events
+            ids = list(
+                UsageEvent.objects.using(shard).select_for_update().filter(rolled_up=False)
+                .order_by('pk').values_list('pk', flat=True)[:batch_size]
+            )
+            if not ids:
+                return 0, 0
+            totals = list(
+                UsageEvent.objects.using(shard).filter(pk__in=ids)
+                .annotate(hour=TruncHour('occurred_at'))
+                .values('user_id', 'tool_id', 'hour')
+                .annotate(total=Sum('quantity'), count=Count('pk'))
+                .order_by()
+            )
+            # A superset of the rollups being added to, narrowed down in Python
+            hours = [row['hour'] for row in totals]
+            existing = {
+                (rollup.user_id, rollup.tool_id, rollup.hour): rollup
+                for rollup in UsageRollup.objects.using(shard).select_for_update().filter(
+                    user_id__in={row['user_id'] for row in totals},
+                    tool_id__in={row['tool_id'] for row in totals},
+                    hour__range=(min(hours), max(hours)),
+                )
+            }
+
+            rollups = []
+            for row in totals:
+                rollup = existing.get((row['user_id'], row['tool_id'], row['hour']))
+                if rollup is None:
+                    rollup = UsageRollup(user_id=row['user_id'], tool_id=row['tool_id'], hour=row['hour'])
+                rollup.quantity += row['total']
+                rollup.events += row['count']
+                rollups.append(rollup)
+            UsageRollup.objects.using(shard).bulk_create(
+                rollups, update_conflicts=True, unique_fields=['user', 'tool', 'hour'],
+                update_fields=['quantity', 'events', 'updated_at'],
+            )
+            UsageEvent.objects.using(shard).filter(pk__in=ids).update(rolled_up=True)
+        return len(ids), len(rollups)
+
+    def handle(self, *args, **options):
+        total_events = total_rollups = 0
+        for shard in all_shards():
+            events = rollups = 0
+            while True:
+                chunk_events, chunk_rollups = self.rollup_chunk(shard, options['batch_size'])
+                if not chunk_events:
+                    break
+                events += chunk_events
+                rollups += chunk_rollups
+            if events:
+                self.stdout.write(f'{shard}: {events} events into {rollups} hourly rollups')
+            total_events += events
+            total_rollups += rollups
+        self.stdout.write(self.style.SUCCESS(f'Rolled up {total_events} usage events ({total_rollups} rollup updates)'))
@@ -0,0 +1,61 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from payments.models import Tool
+from payments.reminders import ReminderRenderer, SMTPPool, mark_sent, pending, upcoming
+from payments.sharding import all_shards
+
+
+class Command(BaseCommand):
+    help = 'Email users whose plans end within the reminder window; safe to rerun'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=float, default=settings.EXPIRY_REMINDER_DAYS,
+                            help='Remind about plans ending within this many days (default: EXPIRY_REMINDER_DAYS)')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Subscriptions rendered and sent per batch')
+        parser.add_argument('--connections', type=int, default=4,
+                            help='SMTP connections sending in parallel')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report how many reminders are due')
+
+    def handle(self, *args, **options):
+        start = timezone.now()
+        end = start + timedelta(days=options['days'])
+
+        due = sent = skipped = 0
+        if options['dry_run']:
+            for shard in all_shards():
+                for rows in upcoming(shard, start, end, options['batch_size']):
+                    due += len(pending(rows, start, end))
+            self.stdout.write(f'{due} reminders due for plans ending before {end:%Y-%m-%d %H:%M}')
+            return
+
+        renderer = ReminderRenderer(dict(Tool.objects.values_list('id', 'name')))
+        with SMTPPool(options['connections']) as pool:
+            for shard in all_shards():
+                for rows in upcoming(shard, start, end, options['batch_size']):
+                    rows = pending(rows, start, end)
+                    if not rows:
+                        continue
+                    messages = renderer.messages(rows)
+                    addressed = {row['id'] for row, _ in messages}
+                    # Users without an email address are marked too, or every run would count them as failed
+                    unreachable = [row for row in rows if row['id'] not in addressed]
+                    accepted = pool.send(messages)
+                    mark_sent(accepted + unreachable)
+                    due += len(messages)
+                    sent += len(accepted)
+                    skipped += len(unreachable)
+                    self.stdout.write(f'  {shard}: {len(accepted)} of {len(messages)} reminders sent')
+
+        message = f'Sent {sent} expiry reminders for plans ending before {end:%Y-%m-%d %H:%M}'
+        if skipped:
+            message += f' and skipped {skipped} without an email address'
+        if sent < due:
+            self.stdout.write(self.style.WARNING(f'{message}; {due - sent} not sent and will be retried on the next run'))
+        else:
+            self.stdout.write(self.style.SUCCESS(message))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from payments.catalog import CatalogError, apply_catalog, diff_catalog, load_catalog
+
+
+class Command(BaseCommand):
+    help = 'Make the tool catalog match a YAML or JSON catalog file, deactivating tools it no longer lists'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Catalog file (.yaml, .yml or .json)')
+        parser.add_argument('--keep-missing', action='store_true',
+                            help='Leave tools that are not in the file active')
+        parser.add_argument('--create-only', action='store_true',
+                            help='Only add tools that are not stored yet; leave existing ones as they are')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report what would change')
+
+    def handle(self, *args, **options):
+        try:
+            diff = diff_catalog(load_catalog(options['path']), prune=not options['keep_missing'],
+                                update=not options['create_only'])
+        except (CatalogError, OSError, ValueError) as e:
+            raise CommandError(f"{options['path']}: {e}")
+
+        for label, tools in (('create', diff.create), ('update', diff.update), ('deactivate', diff.deactivate)):
+            for tool in tools:
+                self.stdout.write(f'  {label}: {tool.name}')
+        summary = (f'{len(diff.create)} created, {len(diff.update)} updated, '
+                   f'{len(diff.deactivate)} deactivated, {diff.unchanged} unchanged')
+
+        if options['dry_run']:
+            self.stdout.write(f'Would sync catalog: {summary}')
+            return
+        apply_catalog(diff)
+        self.stdout.write(self.style.SUCCESS(f'Synced catalog: {summary}'))
@@ -0,0 +1,232 @@
+"""
+Ingestion of metered tool usage.
+
+record_usage validates a batch of events against active subscriptions and
+hands them to usage_dispatcher, which stores them off the request thread in
+large bulk inserts. The in-memory buffer is bounded: when it is full the
+endpoint answers 429 so tools back off instead of the process growing.
+
+With USAGE_LOG_DIR set, accepted events are first appended and fsynced to an
+NDJSON segment in that directory. A segment is deleted once it has been
+rotated and every event in it is stored; segments left behind by a worker
+that died are stored by the replay_usage_log command. Inserts skip events
+whose (tool, event_id) is already stored, so replays are safe.
+"""
+import json
+import os
+import threading
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+from itertools import count
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Subscription, UsageEvent
+from .sharding import fan_out, group_by_shard, shard_for_user
+from .tasks import BatchDispatcher
+
+# How far ahead of our clock a tool's timestamps may run
+CLOCK_SKEW = timedelta(minutes=5)
+EVENT_FIELDS = ('user_id', 'tool_id', 'subscription_id', 'quantity', 'occurred_at', 'event_id')
+
+
+def parse_event(event, now):
+    """Normalise one submitted event into a dict, raising ValueError when it is malformed"""
+    if not isinstance(event, dict):
+        raise ValueError('event must be an object')
+    try:
+        user_id, tool_id = int(event['user_id']), int(event['tool_id'])
+        quantity = int(event.get('quantity', 1))
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('user_id and tool_id are required and quantity must be an integer') from None
+    if quantity <= 0:
+        raise ValueError('quantity must be positive')
+
+    timestamp = event.get('timestamp')
+    if timestamp is None:
+        occurred_at = now
+    elif isinstance(timestamp, (int, float)) and not isinstance(timestamp, bool):
+        occurred_at = datetime.fromtimestamp(timestamp, dt_timezone.utc)
+    else:
+        occurred_at = parse_datetime(str(timestamp))
+        if occurred_at is None:
+            raise ValueError('timestamp must be ISO 8601 or seconds since the epoch')
+        if timezone.is_naive(occurred_at):
+            occurred_at = timezone.make_aware(occurred_at, dt_timezone.utc)
+    if occurred_at > now + CLOCK_SKEW:
+        raise ValueError('timestamp is in the future')
+
+    event_id = str(event.get('id') or uuid.uuid4().hex)
+    if len(event_id) > UsageEvent._meta.get_field('event_id').max_length:
+        raise ValueError('id is too long')
+    return {'user_id': user_id, 'tool_id': tool_id, 'quantity': quantity,
+            'occurred_at': occurred_at, 'event_id': event_id}
+
+
+def validate_usage(events):
+    """Split submitted events into (accepted, rejected)
+
+    An event is accepted when its user holds an active subscription to the
+    tool that had not ended when the event occurred. Subscriptions are read
+    with one query per shard involved.
+    """
+    now = timezone.now()
+    parsed, rejected = [], []
+    for index, event in enumerate(events):
+        try:
+            parsed.append((index, parse_event(event, now)))
+        except ValueError as e:
+            rejected.append({"index": index, "reason": str(e)})
+    if not parsed:
+        return [], rejected
+
+    shards = group_by_shard({event['user_id'] for _, event in parsed})
+    tool_ids = {event['tool_id'] for _, event in parsed}
+    earliest = min(event['occurred_at'] for _, event in parsed)
+
+    def active_on(shard):
+        return list(Subscription.objects.using(shard).filter(
+            Q(end_date__isnull=True) | Q(end_date__gt=earliest),
+            user_id__in=shards[shard],
+            tool_id__in=tool_ids,
+            status=Subscription.Status.ACTIVE,
+        ).values_list('user_id', 'tool_id', 'pk', 'end_date'))
+
+    # (user, tool) -> [(subscription id, end_date)]
+    subscriptions = defaultdict(list)
+    for shard_rows in fan_out(active_on, shards).values():
+        for user_id, tool_id, pk, end_date in shard_rows:
+            subscriptions[user_id, tool_id].append((pk, end_date))
+
+    accepted = []
+    for index, event in parsed:
+        for pk, end_date in subscriptions.get((event['user_id'], event['tool_id']), ()):
+            if end_date is None or end_date > event['occurred_at']:
+                event['subscription_id'] = pk
+                accepted.append(event)
+                break
+        else:
+            rejected.append({"index": index, "reason": "no active subscription"})
+    rejected.sort(key=lambda rejection: rejection["index"])
+    return accepted, rejected
+
+
+class UsageLog:
+    """Append-only NDJSON segments holding events until they are stored"""
+
+    def __init__(self, directory, segment_events=10000):
+        self.directory = directory
+        self.segment_events = segment_events
+        self._sequence = count(1)
+        self._lock = threading.Lock()
+        self._appended = Counter()
+        self._stored = Counter()
+        os.makedirs(directory, exist_ok=True)
+        self._segment = self._next_segment()
+
+    def _next_segment(self):
+        return f'{timezone.now():%Y%m%dT%H%M%S}-{os.getpid()}-{next(self._sequence)}.ndjson'
+
+    def append(self, events):
+        """Durably write `events` and return the segment they went to"""
+        encoder = DjangoJSONEncoder()
+        lines = ''.join(encoder.encode({field: event[field] for field in EVENT_FIELDS}) + '\n' for event in events)
+        with self._lock:
+            segment = self._segment
+            with open(os.path.join(self.directory, segment), 'a', encoding='utf-8') as log:
+                log.write(lines)
+                log.flush()
+                os.fsync(log.fileno())
+            self._appended[segment] += len(events)
+            if self._appended[segment] >= self.segment_events:
+                self._segment = self._next_segment()
+                self._release(segment)
+        return segment
+
+    def done(self, segment, stored):
+        """Record that `stored` events from `segment` are in the database"""
+        with self._lock:
+            self._stored[segment] += stored
+            self._release(segment)
+
+    def _release(self, segment):
+        if segment != self._segment and self._stored[segment] >= self._appended[segment]:
+            try:
+                os.remove(os.path.join(self.directory, segment))
+            except FileNotFoundError:
+                pass  # already stored by replay_usage_log
+            del self._appended[segment], self._stored[segment]
+
+
+def read_segment(path):
+    """Events written to a UsageLog segment, ready for store_usage()"""
+    with open(path, encoding='utf-8') as log:
+        for line in log:
+            if not line.strip():
+                continue
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue  # a write torn by a crash; the tool got no 202 for it
+            event['occurred_at'] = parse_datetime(event['occurred_at'])
+            yield event
+
+
+_logs = {}
+_logs_lock = threading.Lock()
+
+
+def usage_log():
+    """This process's UsageLog, or None when USAGE_LOG_DIR is unset"""
+    directory = settings.USAGE_LOG_DIR
+    if not directory:
+        return None
+    key = (directory, os.getpid())
+    with _logs_lock:
+        if key not in _logs:
+            _logs[key] = UsageLog(directory)
+        return _logs[key]
+
+
+def store_usage(batch):
+    """Insert a batch of accepted events on their users' shards, skipping ones already stored"""
+    by_shard = defaultdict(list)
+    for event in batch:
+        row = UsageEvent(**{field: event[field] for field in EVENT_FIELDS})
+        by_shard[shard_for_user(event['user_id'])].append(row)
+    for shard, rows in by_shard.items():
+        UsageEvent.objects.using(shard).bulk_create(rows, batch_size=settings.USAGE_FLUSH_SIZE, ignore_conflicts=True)
+
+    segments = Counter(event['segment'] for event in batch if event.get('segment'))
+    if segments:
+        log = usage_log()
+        for segment, stored in segments.items():
+            log.done(segment, stored)
+
+
+usage_dispatcher = BatchDispatcher(
+    store_usage,
+    batch_size=settings.USAGE_FLUSH_SIZE,
+    interval=settings.USAGE_FLUSH_INTERVAL,
+    maxsize=settings.USAGE_BUFFER_CAPACITY,
+    name='usage-dispatcher',
+)
+_enqueue_lock = threading.Lock()
+
+
+def enqueue_usage(events):
+    """Buffer accepted events for storage; False, with nothing logged, when the buffer is full"""
+    with _enqueue_lock:
+        if not usage_dispatcher.has_room(len(events)):
+            return False
+        log = usage_log()
+        if log is not None:
+            segment = log.append(events)
+            for event in events:
+                event['segment'] = segment
+        return usage_dispatcher.offer_many(events)
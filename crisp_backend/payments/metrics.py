@@ -0,0 +1,149 @@
+"""
+Per-request timing accumulators and Prometheus histograms.
+
+Under gunicorn each worker writes its samples to files in
+PROMETHEUS_MULTIPROC_DIR (prometheus_client's multiprocess mode), and
+/metrics adds up every worker's, whichever worker answers the scrape.
+"""
+import fcntl
+import glob
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from prometheus_client import CollectorRegistry, Histogram, generate_latest, multiprocess
+from prometheus_client.mmap_dict import MmapedDict
+
+_current = ContextVar('request_timings', default=None)
+
+
+class RequestTimings:
+    """Totals collected while a single request is being handled"""
+    __slots__ = ('db_count', 'db_time', 'stripe_count', 'stripe_time', 'smtp_count', 'smtp_time')
+
+    def __init__(self):
+        self.db_count = 0
+        self.db_time = 0.0
+        self.stripe_count = 0
+        self.stripe_time = 0.0
+        self.smtp_count = 0
+        self.smtp_time = 0.0
+
+    def add(self, kind, elapsed):
+        setattr(self, f'{kind}_count', getattr(self, f'{kind}_count') + 1)
+        setattr(self, f'{kind}_time', getattr(self, f'{kind}_time') + elapsed)
+
+
+def start_request():
+    """Begin collecting timings for the current request/context"""
+    timings = RequestTimings()
+    return timings, _current.set(timings)
+
+
+def finish_request(token):
+    _current.reset(token)
+
+
+def current_timings():
+    return _current.get()
+
+
+@contextmanager
+def timed(kind):
+    """Attribute the wrapped block to `kind` ('stripe' or 'smtp') on the current request"""
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(kind, time.perf_counter() - start)
+
+
+def db_execute_wrapper(execute, sql, params, many, context):
+    """`connection.execute_wrapper` hook counting queries and their time"""
+    timings = _current.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.db_count += 1
+        timings.db_time += time.perf_counter() - start
+
+
+REGISTRY = CollectorRegistry()
+
+REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds', 'Total time spent handling the request.', ('view', 'method'),
+    registry=REGISTRY,
+)
+DB_SECONDS = Histogram(
+    'http_request_db_seconds', 'Time spent executing database queries per request.', ('view',),
+    registry=REGISTRY,
+)
+DB_QUERIES = Histogram(
+    'http_request_db_queries', 'Number of database queries per request.', ('view',),
+    buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55, 100), registry=REGISTRY,
+)
+STRIPE_SECONDS = Histogram(
+    'http_request_stripe_seconds', 'Time spent in Stripe API calls per request.', ('view',),
+    registry=REGISTRY,
+)
+SMTP_SECONDS = Histogram(
+    'http_request_smtp_seconds', 'Time spent sending email per request.', ('view',),
+    registry=REGISTRY,
+)
+
+# Where the workers of a gunicorn master keep their samples (see gunicorn.conf.py)
+ARCHIVE_FILE = 'histogram_archive.db'
+
+
+def record_request(view, method, duration, timings):
+    """Fold one finished request into the per-view histograms"""
+    REQUEST_SECONDS.labels(view, method).observe(duration)
+    DB_SECONDS.labels(view).observe(timings.db_time)
+    DB_QUERIES.labels(view).observe(timings.db_count)
+    if timings.stripe_count:
+        STRIPE_SECONDS.labels(view).observe(timings.stripe_time)
+    if timings.smtp_count:
+        SMTP_SECONDS.labels(view).observe(timings.smtp_time)
+
+
+def render_prometheus():
+    """Exposition text for every worker sharing PROMETHEUS_MULTIPROC_DIR, else for this process"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry)
+
+
+def archive_process(pid, path=None):
+    """
+    Fold a dead worker's sample files into one archive file and delete them.
+
+    Histograms only ever grow, so a recycled worker's counts must stay in the
+    totals. Without this every recycle would leave its files behind and each
+    scrape would read more of them.
+    """
+    path = path or os.environ['PROMETHEUS_MULTIPROC_DIR']
+    dead = glob.glob(os.path.join(path, f'*_{pid}.db'))
+    if not dead:
+        return
+    # During a binary upgrade both masters may archive at once
+    with open(os.path.join(path, 'archive.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        archive = MmapedDict(os.path.join(path, ARCHIVE_FILE))
+        try:
+            for filename in dead:
+                for key, value, timestamp, _ in MmapedDict.read_all_values_from_file(filename):
+                    archive.write_value(key, archive.read_value(key)[0] + value, timestamp)
+                os.remove(filename)
+        finally:
+            archive.close()
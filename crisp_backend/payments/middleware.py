@@ -0,0 +1,154 @@
+import re
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.handlers.exception import convert_exception_to_response
+from django.db import connections
+from django.utils.cache import patch_vary_headers
+from django.utils.module_loading import import_string
+
+from . import compression, metrics
+
+STRONG_ETAG = re.compile(r'^"[^"]*"$')
+
+
+class ServerTimingMiddleware:
+    """Report DB, Stripe and SMTP time per request as Server-Timing headers and metrics"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        timings, token = metrics.start_request()
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(metrics.db_execute_wrapper))
+                response = self.get_response(request)
+        finally:
+            metrics.finish_request(token)
+        duration = time.perf_counter() - start
+
+        match = request.resolver_match
+        view = (match.url_name or match.view_name) if match else 'unmatched'
+        metrics.record_request(view, request.method, duration, timings)
+
+        entries = [f'db;dur={timings.db_time * 1000:.1f};desc="{timings.db_count} queries"']
+        if timings.stripe_count:
+            entries.append(f'stripe;dur={timings.stripe_time * 1000:.1f}')
+        if timings.smtp_count:
+            entries.append(f'smtp;dur={timings.smtp_time * 1000:.1f}')
+        entries.append(f'total;dur={duration * 1000:.1f}')
+        response['Server-Timing'] = ', '.join(entries)
+        return response
+
+
+class PathScopedMiddleware:
+    """Run settings.SITE_MIDDLEWARE only for requests outside API_PATH_PREFIXES
+
+    JSON API calls authenticate with bearer tokens and need no sessions,
+    CSRF cookies, messages or frame options, so they skip that stack while
+    the admin keeps it. Django only calls process_view, process_exception
+    and process_template_response on entries of MIDDLEWARE, so this forwards
+    them to the wrapped middleware for requests that went through it.
+    """
+
+    def __init__(self, get_response):
+        if not settings.SITE_MIDDLEWARE:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.api_prefixes = tuple(settings.API_PATH_PREFIXES)
+        # Same construction and hook order as BaseHandler.load_middleware()
+        self.view_hooks, self.template_response_hooks, self.exception_hooks = [], [], []
+        handler = get_response
+        for path in reversed(settings.SITE_MIDDLEWARE):
+            try:
+                middleware = import_string(path)(handler)
+            except MiddlewareNotUsed:
+                continue
+            if hasattr(middleware, 'process_view'):
+                self.view_hooks.insert(0, middleware.process_view)
+            if hasattr(middleware, 'process_template_response'):
+                self.template_response_hooks.append(middleware.process_template_response)
+            if hasattr(middleware, 'process_exception'):
+                self.exception_hooks.append(middleware.process_exception)
+            handler = convert_exception_to_response(middleware)
+        self.site_handler = handler
+
+    def is_api(self, request):
+        return request.path_info.startswith(self.api_prefixes)
+
+    def __call__(self, request):
+        if self.is_api(request):
+            return self.get_response(request)
+        return self.site_handler(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if self.is_api(request):
+            return None
+        for hook in self.view_hooks:
+            response = hook(request, view_func, view_args, view_kwargs)
+            if response is not None:
+                return response
+        return None
+
+    def process_template_response(self, request, response):
+        if not self.is_api(request):
+            for hook in self.template_response_hooks:
+                response = hook(request, response)
+        return response
+
+    def process_exception(self, request, exception):
+        if self.is_api(request):
+            return None
+        for hook in self.exception_hooks:
+            response = hook(request, exception)
+            if response is not None:
+                return response
+        return None
+
+
+class CompressionMiddleware:
+    """Compress /api/ responses with brotli or gzip, whichever the client prefers
+
+    Responses that already carry a Content-Encoding (precompressed payloads),
+    responses of never_compress views, which hold secrets, and bodies under
+    COMPRESSION_MIN_SIZE, where the framing overhead eats the savings, go out
+    as they are.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if not request.path.startswith('/api/') or getattr(response, 'never_compress', False):
+            return response
+        if response.has_header('Content-Encoding') or 'no-transform' in response.get('Cache-Control', ''):
+            return response
+        if not response.streaming and len(response.content) < settings.COMPRESSION_MIN_SIZE:
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = compression.negotiate(request.META.get('HTTP_ACCEPT_ENCODING'))
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            if response.is_async:
+                return response
+            response.streaming_content = compression.compress_stream(response.streaming_content, encoding)
+            del response['Content-Length']
+        else:
+            response.content = compression.compress(response.content, encoding)
+            response['Content-Length'] = str(len(response.content))
+
+        # The compressed body is a different representation of the same resource
+        etag = response.get('ETag')
+        if etag and STRONG_ETAG.match(etag):
+            response['ETag'] = 'W/' + etag
+        response['Content-Encoding'] = encoding
+        return response
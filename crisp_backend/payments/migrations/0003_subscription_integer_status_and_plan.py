@@ -0,0 +1,22 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """Nullable code columns next to the slug ones; 0003_backfill_subscription_codes fills them"""
+
+    dependencies = [
+        ('payments', '0002_subscription_email_tool_price_id_userprofile_role_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscription',
+            name='status_code',
+            field=models.SmallIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='subscription',
+            name='plan_code',
+            field=models.SmallIntegerField(null=True),
+        ),
+    ]
@@ -0,0 +1,68 @@
+from django.db import migrations
+from django.db.models import Case, Max, Min, Value, When
+
+PLAN_CODES = {'': 0, '1-month': 1, '3-month': 3, '6-month': 6, '12-month': 12}
+STATUS_CODES = {'active': 1, 'inactive': 2, 'expired': 3, 'cancelled': 4, 'canceled': 4}
+CHUNK_SIZE = 5000
+
+
+def coded():
+    """status_code/plan_code as computed from the slug columns, for QuerySet.update()"""
+    return {
+        'status_code': Case(
+            *[When(status=slug, then=Value(code)) for slug, code in STATUS_CODES.items()],
+            default=Value(2),
+        ),
+        'plan_code': Case(
+            *[When(plan=slug, then=Value(code)) for slug, code in PLAN_CODES.items()],
+            default=Value(0),
+        ),
+    }
+
+
+def backfill_codes(apps, schema_editor):
+    """Fill status_code/plan_code one primary-key range at a time.
+
+    Each range commits on its own and is found through the primary key, as
+    status_code has no index. The last key is reread after every range, so
+    rows inserted meanwhile by code still saving slugs are reached too. Rows
+    already filled are skipped, so a rerun after an interruption only costs
+    a pass over the keys. Rows inserted after the last range are coded by
+    the swap migration.
+    """
+    Subscription = apps.get_model('payments', 'Subscription')
+    subscriptions = Subscription.objects.using(schema_editor.connection.alias)
+    start = subscriptions.aggregate(start=Min('pk'))['start']
+    while start is not None and start <= subscriptions.aggregate(end=Max('pk'))['end']:
+        subscriptions.filter(
+            pk__gte=start, pk__lt=start + CHUNK_SIZE, status_code__isnull=True,
+        ).update(**coded())
+        start += CHUNK_SIZE
+
+
+def restore_slugs(apps, schema_editor):
+    Subscription = apps.get_model('payments', 'Subscription')
+    status_slugs = {code: slug for slug, code in STATUS_CODES.items() if slug != 'cancelled'}
+    plan_slugs = {code: slug for slug, code in PLAN_CODES.items()}
+    Subscription.objects.using(schema_editor.connection.alias).update(
+        status=Case(*[When(status_code=code, then=Value(slug)) for code, slug in status_slugs.items()]),
+        plan=Case(*[When(plan_code=code, then=Value(slug)) for code, slug in plan_slugs.items()], default=Value('')),
+    )
+
+
+class Migration(migrations.Migration):
+    # Each backfill chunk commits on its own instead of holding one long
+    # transaction (and its row locks) over the whole table. Nothing else
+    # runs here, so a rerun after an interruption only backfills.
+    atomic = False
+
+    # Numbered 0003 until the three 0003 migrations were put in order
+    replaces = [('payments', '0003_backfill_subscription_codes')]
+
+    dependencies = [
+        ('payments', '0003_subscription_integer_status_and_plan'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_codes, restore_slugs, hints={'model_name': 'subscription'}),
+    ]
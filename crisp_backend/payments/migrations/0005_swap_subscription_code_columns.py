@@ -0,0 +1,67 @@
+from importlib import import_module
+
+from django.db import migrations, models
+
+backfill = import_module('payments.migrations.0004_backfill_subscription_codes')
+
+
+def code_stragglers(apps, schema_editor):
+    """Code the rows inserted with only slugs since the backfill's last range
+
+    Making the columns NOT NULL below would otherwise fill them in as
+    active with no plan. On PostgreSQL the table is locked against writes
+    first, so none can slip in between this and the swap.
+    """
+    Subscription = apps.get_model('payments', 'Subscription')
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(f'LOCK TABLE {connection.ops.quote_name(Subscription._meta.db_table)} IN SHARE MODE')
+    Subscription.objects.using(connection.alias).filter(status_code__isnull=True).update(**backfill.coded())
+
+
+class Migration(migrations.Migration):
+    """Swap the backfilled code columns in for the slug ones"""
+
+    # Numbered 0003 until the three 0003 migrations were put in order
+    replaces = [('payments', '0003_swap_subscription_code_columns')]
+
+    dependencies = [
+        ('payments', '0004_backfill_subscription_codes'),
+    ]
+
+    operations = [
+        migrations.RunPython(code_stragglers, migrations.RunPython.noop, hints={'model_name': 'subscription'}),
+        migrations.RemoveField(
+            model_name='subscription',
+            name='status',
+        ),
+        migrations.RemoveField(
+            model_name='subscription',
+            name='plan',
+        ),
+        migrations.RenameField(
+            model_name='subscription',
+            old_name='status_code',
+            new_name='status',
+        ),
+        migrations.RenameField(
+            model_name='subscription',
+            old_name='plan_code',
+            new_name='plan',
+        ),
+        migrations.AlterField(
+            model_name='subscription',
+            name='status',
+            field=models.SmallIntegerField(choices=[(1, 'Active'), (2, 'Inactive'), (3, 'Expired'), (4, 'Canceled')], default=1),
+        ),
+        migrations.AlterField(
+            model_name='subscription',
+            name='plan',
+            field=models.SmallIntegerField(choices=[(0, 'No plan'), (1, '1 Month'), (3, '3 Months'), (6, '6 Months'), (12, '12 Months')], default=0),
+        ),
+        migrations.AddIndex(
+            model_name='subscription',
+            index=models.Index(fields=['user', 'status'], name='subscription_user_status'),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.2.4 on 2026-10-19 17:23
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    # Numbered 0005 until the three 0003 migrations were put in order
+    replaces = [('payments', '0005_usage_metering')]
+
+    dependencies = [
+        ('payments', '0006_shard_subscriptions_by_user'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsageEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField(default=1)),
+                ('occurred_at', models.DateTimeField()),
+                ('event_id', models.CharField(max_length=64)),
+                ('rolled_up', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('subscription', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='payments.subscription')),
+                ('tool', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, to='payments.tool')),
+                ('user', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('rolled_up', False)), fields=['id'], name='usage_event_pending_rollup')],
+                'constraints': [models.UniqueConstraint(fields=('tool', 'event_id'), name='usage_event_unique_per_tool')],
+            },
+        ),
+        migrations.CreateModel(
+            name='UsageRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('quantity', models.BigIntegerField(default=0)),
+                ('events', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('tool', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, to='payments.tool')),
+                ('user', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'tool', 'hour'), name='usage_rollup_unique_hour')],
+            },
+        ),
+    ]
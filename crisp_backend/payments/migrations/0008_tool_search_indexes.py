@@ -0,0 +1,59 @@
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.operations import TrigramExtension
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations
+
+# Must match payments.search.search_document() for the planner to use the index
+SEARCH_INDEXES = [
+    GinIndex(
+        SearchVector('name', weight='A', config='english') + SearchVector('description', weight='B', config='english'),
+        name='tool_search_document',
+    ),
+    GinIndex(OpClass('name', name='gin_trgm_ops'), name='tool_name_trgm'),
+    GinIndex(OpClass('description', name='gin_trgm_ops'), name='tool_description_trgm'),
+]
+
+
+class PostgresTrigramExtension(TrigramExtension):
+    """TrigramExtension that is also a no-op when unapplied outside PostgreSQL
+
+    CreateExtension only checks the vendor going forwards; going backwards it
+    queries pg_extension, which other databases do not have.
+    """
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+def add_search_indexes(apps, schema_editor):
+    # GIN indexes exist only on PostgreSQL; elsewhere payments.search uses an in-memory index
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    Tool = apps.get_model('payments', 'Tool')
+    for index in SEARCH_INDEXES:
+        schema_editor.add_index(Tool, index)
+
+
+def remove_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    Tool = apps.get_model('payments', 'Tool')
+    for index in SEARCH_INDEXES:
+        schema_editor.remove_index(Tool, index)
+
+
+class Migration(migrations.Migration):
+
+    # Numbered 0006 until the three 0003 migrations were put in order
+    replaces = [('payments', '0006_tool_search_indexes')]
+
+    dependencies = [
+        ('payments', '0007_usage_metering'),
+    ]
+
+    operations = [
+        # Only runs on PostgreSQL
+        PostgresTrigramExtension(),
+        migrations.RunPython(add_search_indexes, remove_search_indexes, hints={'model_name': 'tool'}),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.4 on 2026-10-19 17:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    # Numbered 0007 until the three 0003 migrations were put in order
+    replaces = [('payments', '0007_request_profiles')]
+
+    dependencies = [
+        ('payments', '0008_tool_search_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RequestProfile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('view', models.CharField(max_length=100)),
+                ('method', models.CharField(max_length=10)),
+                ('path', models.CharField(max_length=255)),
+                ('status_code', models.PositiveSmallIntegerField()),
+                ('duration_ms', models.FloatField()),
+                ('trigger', models.CharField(choices=[('header', 'Signed header'), ('sampled', 'Sample rate'), ('slow', 'Latency threshold')], max_length=10)),
+                ('samples', models.PositiveIntegerField()),
+                ('stacks', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['view', '-duration_ms'], name='request_profile_slowest')],
+            },
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.4 on 2026-10-19 17:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    # Numbered 0008 until the three 0003 migrations were put in order
+    replaces = [('payments', '0008_userprofile_stripe_customer_id')]
+
+    dependencies = [
+        ('payments', '0009_request_profiles'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='stripe_customer_id',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
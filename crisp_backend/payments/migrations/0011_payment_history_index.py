@@ -0,0 +1,22 @@
+# Generated by Django 5.2.4 on 2026-10-19 17:43
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    # Numbered 0009 until the three 0003 migrations were put in order
+    replaces = [('payments', '0009_payment_history_index')]
+
+    dependencies = [
+        ('payments', '0010_userprofile_stripe_customer_id'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['user', '-created_at', '-id'], name='payment_user_history'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.4 on 2026-10-19 17:46
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    # Numbered 0010 until the three 0003 migrations were put in order
+    replaces = [('payments', '0010_expiry_reminders')]
+
+    dependencies = [
+        ('payments', '0011_payment_history_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExpiryReminder',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('end_date', models.DateTimeField()),
+                ('sent_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='subscription',
+            index=models.Index(condition=models.Q(('status', 1)), fields=['end_date'], name='subscription_active_end_date'),
+        ),
+        migrations.AddField(
+            model_name='expiryreminder',
+            name='tool',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='payments.tool'),
+        ),
+        migrations.AddField(
+            model_name='expiryreminder',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='expiryreminder',
+            constraint=models.UniqueConstraint(fields=('user', 'tool', 'end_date'), name='expiry_reminder_once'),
+        ),
+    ]
@@ -1,13 +1,17 @@
-from django.db import models
+from django.db import DEFAULT_DB_ALIAS, models
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import User
 from django.utils import timezone
 
+from .sharding import shard_for_user
+
 
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     phone = models.CharField(max_length=20, blank=True)
     is_verified = models.BooleanField(default=False)
     role = models.CharField(max_length=20, default='user')
+    stripe_customer_id = models.CharField(max_length=255, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -28,26 +32,76 @@ class Tool(models.Model):
         return self.name
 
 
+class ShardedQuerySet(models.QuerySet):
+    """Queries over tables sharded by user (see payments.sharding)"""
+
+    def for_user(self, user):
+        """One user's rows, read from that user's shard"""
+        user_id = getattr(user, 'pk', user)
+        return self.using(shard_for_user(user_id)).filter(user_id=user_id)
+
+    def create(self, **kwargs):
+        """Insert on the shard of the row's user unless using() picked a database"""
+        user_id = kwargs['user'].pk if 'user' in kwargs else kwargs.get('user_id')
+        if self._db is None and user_id is not None:
+            return self.using(shard_for_user(user_id)).create(**kwargs)
+        return super().create(**kwargs)
+
+    def with_related(self, *fields):
+        """Load related global rows: joined on `default`, prefetched from any other shard"""
+        if self.db == DEFAULT_DB_ALIAS:
+            return self.select_related(*fields)
+        return self.prefetch_related(*fields)
+
+
 class Subscription(models.Model):
-    PLAN_CHOICES = [
-        ('1-month', '1 Month'),
-        ('3-month', '3 Months'),
-        ('6-month', '6 Months'),
-        ('12-month', '12 Months'),
-    ]
-    
-    STATUS_CHOICES = [
-        ('active', 'Active'),
-        ('inactive', 'Inactive'),
-        ('expired', 'Expired'),
-        ('cancelled', 'Cancelled'),
-        ('canceled', 'Canceled'),  # Alternative spelling
-    ]
+    class Plan(models.IntegerChoices):
+        # Values are the plan length in months
+        NONE = 0, 'No plan'
+        ONE_MONTH = 1, '1 Month'
+        THREE_MONTHS = 3, '3 Months'
+        SIX_MONTHS = 6, '6 Months'
+        TWELVE_MONTHS = 12, '12 Months'
 
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
-    tool = models.ForeignKey(Tool, on_delete=models.CASCADE)
-    plan = models.CharField(max_length=20, choices=PLAN_CHOICES, blank=True)
-    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='active')
+        @property
+        def slug(self):
+            return f'{self.value}-month' if self.value else ''
+
+        @classmethod
+        def from_slug(cls, slug):
+            """'3-month' -> Plan.THREE_MONTHS; raises ValueError for unknown plans"""
+            if not slug:
+                return cls.NONE
+            months, _, unit = str(slug).partition('-')
+            if unit != 'month' or not months.isdigit():
+                raise ValueError(f'Unknown plan {slug!r}')
+            return cls(int(months))
+
+    class Status(models.IntegerChoices):
+        ACTIVE = 1, 'Active'
+        INACTIVE = 2, 'Inactive'
+        EXPIRED = 3, 'Expired'
+        CANCELED = 4, 'Canceled'
+
+        @property
+        def slug(self):
+            return self.name.lower()
+
+        @classmethod
+        def from_slug(cls, slug):
+            """'active' -> Status.ACTIVE; the British 'cancelled' is accepted too"""
+            if slug == 'cancelled':
+                return cls.CANCELED
+            try:
+                return cls[str(slug).upper()]
+            except KeyError:
+                raise ValueError(f'Unknown status {slug!r}') from None
+
+    # Users and tools live on `default`; payments.sharding cascades their deletes
+    user = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False)
+    tool = models.ForeignKey(Tool, on_delete=models.DO_NOTHING, db_constraint=False)
+    plan = models.SmallIntegerField(choices=Plan.choices, default=Plan.NONE)
+    status = models.SmallIntegerField(choices=Status.choices, default=Status.ACTIVE)
     stripe_subscription_id = models.CharField(max_length=255, blank=True)
     email = models.EmailField(blank=True)  # For backup email reference
     start_date = models.DateTimeField(default=timezone.now)
@@ -55,11 +109,28 @@ class Subscription(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = ShardedQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'status'], name='subscription_user_status'),
+            # Upcoming expiries of active plans (status 1), for send_expiry_reminders
+            models.Index(fields=['end_date'], condition=models.Q(status=1), name='subscription_active_end_date'),
+        ]
+
     def __str__(self):
-        return f"{self.user.username} - {self.tool.name} - {self.plan}"
+        return f"{self.user.username} - {self.tool.name} - {self.plan_slug}"
+
+    @property
+    def plan_slug(self):
+        return self.Plan(self.plan).slug
+
+    @property
+    def status_slug(self):
+        return self.Status(self.status).slug
 
     def is_active(self):
-        return self.status == 'active' and (self.end_date is None or self.end_date > timezone.now())
+        return self.status == self.Status.ACTIVE and (self.end_date is None or self.end_date > timezone.now())
 
 
 class Payment(models.Model):
@@ -70,7 +141,7 @@ class Payment(models.Model):
         ('cancelled', 'Cancelled'),
     ]
 
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False)
     subscription = models.ForeignKey(Subscription, on_delete=models.CASCADE)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     currency = models.CharField(max_length=3, default='USD')
@@ -79,5 +150,136 @@ class Payment(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = ShardedQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Keyset pages of a user's payment history (payments/history.py)
+            models.Index(fields=['user', '-created_at', '-id'], name='payment_user_history'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} - ${self.amount} - {self.status}"
+
+
+class UsageEvent(models.Model):
+    """One metered unit of tool usage, as reported by the tool"""
+    user = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False)
+    tool = models.ForeignKey(Tool, on_delete=models.DO_NOTHING, db_constraint=False)
+    subscription = models.ForeignKey(Subscription, on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField(default=1)
+    occurred_at = models.DateTimeField()
+    # Set by the tool, or generated on receipt, so retries and replays are stored once
+    event_id = models.CharField(max_length=64)
+    rolled_up = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = ShardedQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['tool', 'event_id'], name='usage_event_unique_per_tool'),
+        ]
+        indexes = [
+            models.Index(fields=['id'], condition=models.Q(rolled_up=False), name='usage_event_pending_rollup'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} - {self.tool_id} - {self.quantity}"
+
+
+class UsageRollup(models.Model):
+    """Usage per user, tool and hour, the basis for usage-based invoices"""
+    user = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False)
+    tool = models.ForeignKey(Tool, on_delete=models.DO_NOTHING, db_constraint=False)
+    hour = models.DateTimeField()
+    quantity = models.BigIntegerField(default=0)
+    events = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = ShardedQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'tool', 'hour'], name='usage_rollup_unique_hour'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} - {self.tool.name} - {self.hour:%Y-%m-%d %H:00}"
+
+
+class UserShardMove(models.Model):
+    """Where rebalance_shards last moved a user's billing rows"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE)
+    source = models.CharField(max_length=100)
+    target = models.CharField(max_length=100)
+    moved_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.user_id}: {self.source} -> {self.target}"
+
+
+class ExpiryReminder(models.Model):
+    """Marks that a user was reminded of one plan end date, so send_expiry_reminders reruns skip it"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    tool = models.ForeignKey(Tool, on_delete=models.CASCADE)
+    end_date = models.DateTimeField()
+    sent_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'tool', 'end_date'], name='expiry_reminder_once'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} - {self.tool_id} - {self.end_date:%Y-%m-%d}"
+
+
+class RequestProfile(models.Model):
+    """Sampled call stacks of one profiled request (see payments/profiling.py)"""
+    class Trigger(models.TextChoices):
+        HEADER = 'header', 'Signed header'
+        SAMPLED = 'sampled', 'Sample rate'
+        SLOW = 'slow', 'Latency threshold'
+
+    view = models.CharField(max_length=100)
+    method = models.CharField(max_length=10)
+    path = models.CharField(max_length=255)
+    status_code = models.PositiveSmallIntegerField()
+    duration_ms = models.FloatField()
+    trigger = models.CharField(max_length=10, choices=Trigger.choices)
+    samples = models.PositiveIntegerField()
+    # Collapsed stacks, one 'outer;inner;leaf <samples>' line each
+    stacks = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['view', '-duration_ms'], name='request_profile_slowest'),
+        ]
+
+    def __str__(self):
+        return f"{self.method} {self.path} - {self.duration_ms:.0f} ms"
+
+
+class IdempotencyKey(models.Model):
+    """The first response to a POST sent with an Idempotency-Key header (see payments/idempotency.py)"""
+    # Null for anonymous requests such as register
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
+    key = models.CharField(max_length=255)
+    # SHA-256 of the method, path and body the key was first used with
+    fingerprint = models.CharField(max_length=64)
+    # Null while the first request is still running
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    body = models.TextField(blank=True)
+    locked_at = models.DateTimeField()
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(Coalesce('user', models.Value(0)), 'key',
+                                    name='idempotency_key_per_user'),
+        ]
+
     def __str__(self):
-        return f"{self.user.username} - ${self.amount} - {self.status}"
\ No newline at end of file
+        return f"{self.user_id or 'anonymous'} - {self.key}"
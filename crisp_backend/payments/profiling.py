@@ -0,0 +1,221 @@
+"""
+Opt-in sampling profiler for production requests.
+
+A request is profiled when it carries a valid signed X-Profile-Request
+header (see the profile_token command), when its view is picked by
+PROFILE_SAMPLE_RATES, or, with PROFILE_SLOW_MS set, whenever it ends up
+slower than that. A background thread samples the stack of every request
+being profiled every PROFILE_INTERVAL_MS. That costs little enough to
+run on every request in threshold mode, where only the slow ones are kept.
+
+Captured stacks are stored as RequestProfile rows in collapsed form
+('outer;inner;leaf <samples>'), trimmed to the newest PROFILE_MAX_STORED,
+and drawn as flame graphs in the admin.
+"""
+import hashlib
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core import signing
+from django.utils.html import escape, format_html
+from django.utils.safestring import mark_safe
+
+from .tasks import BatchDispatcher
+
+HEADER = 'HTTP_X_PROFILE_REQUEST'
+SIGNING_SALT = 'payments.profiling'
+MAX_DEPTH = 128
+
+
+def make_token():
+    """A value for the X-Profile-Request header, valid for PROFILE_TOKEN_MAX_AGE seconds"""
+    return signing.TimestampSigner(salt=SIGNING_SALT).sign('profile')
+
+
+def valid_token(token):
+    try:
+        signing.TimestampSigner(salt=SIGNING_SALT).unsign(token, max_age=settings.PROFILE_TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        return False
+    return True
+
+
+def _frame_name(code):
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return f'{code.co_name} ({module}:{code.co_firstlineno})'
+
+
+def collapse(frame):
+    """'outermost;...;innermost' for a frame and its callers"""
+    names = []
+    while frame is not None and len(names) < MAX_DEPTH:
+        names.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Sampler:
+    """Daemon thread that counts the stacks of threads being profiled, idle when there are none"""
+
+    def __init__(self):
+        self._targets = {}
+        self._lock = threading.Lock()
+        self._active = threading.Event()
+        self._thread = None
+
+    def start(self, thread_id):
+        stacks = Counter()
+        with self._lock:
+            self._targets[thread_id] = stacks
+            self._active.set()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='request-sampler', daemon=True)
+                self._thread.start()
+        return stacks
+
+    def stop(self, thread_id):
+        with self._lock:
+            stacks = self._targets.pop(thread_id, Counter())
+            if not self._targets:
+                self._active.clear()
+        return stacks
+
+    def _run(self):
+        while True:
+            self._active.wait()
+            time.sleep(settings.PROFILE_INTERVAL_MS / 1000)
+            with self._lock:
+                targets = list(self._targets.items())
+            frames = sys._current_frames()
+            for thread_id, stacks in targets:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    stacks[collapse(frame)] += 1
+
+
+sampler = Sampler()
+
+
+def store_profiles(batch):
+    """Insert captured profiles and drop the oldest beyond PROFILE_MAX_STORED"""
+    from .models import RequestProfile
+
+    created = RequestProfile.objects.bulk_create([RequestProfile(**profile) for profile in batch])
+    newest = max(profile.pk for profile in created)
+    RequestProfile.objects.filter(pk__lte=newest - settings.PROFILE_MAX_STORED).delete()
+
+
+profile_dispatcher = BatchDispatcher(store_profiles, batch_size=20, maxsize=100, name='profile-dispatcher')
+
+
+class ProfilingMiddleware:
+    """Sample the stacks of selected requests and keep the ones that qualify"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def trigger(self, request, view_name):
+        """Why this request should be profiled, or None"""
+        token = request.META.get(HEADER)
+        if token and valid_token(token):
+            return 'header'
+        rate = settings.PROFILE_SAMPLE_RATES.get(view_name)
+        if rate and random.random() < rate:
+            return 'sampled'
+        if settings.PROFILE_SLOW_MS:
+            return 'slow'
+        return None
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_name = request.resolver_match.url_name or request.resolver_match.view_name
+        trigger = self.trigger(request, view_name)
+        if trigger:
+            request._profile = (trigger, view_name, threading.get_ident(), time.perf_counter())
+            sampler.start(threading.get_ident())
+
+    def __call__(self, request):
+        try:
+            response = self.get_response(request)
+        finally:
+            profile = getattr(request, '_profile', None)
+            stacks = sampler.stop(profile[2]) if profile else None
+        if profile is None or response.streaming:
+            return response
+
+        trigger, view_name, _, started = profile
+        duration_ms = (time.perf_counter() - started) * 1000
+        if trigger == 'slow' and duration_ms < settings.PROFILE_SLOW_MS:
+            return response
+        profile_dispatcher.offer_many([{
+            'view': view_name,
+            'method': request.method,
+            'path': request.path[:255],
+            'status_code': response.status_code,
+            'duration_ms': duration_ms,
+            'trigger': trigger,
+            'samples': sum(stacks.values()),
+            'stacks': ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common()),
+        }])
+        response['X-Profiled'] = trigger
+        return response
+
+
+def parse_stacks(collapsed):
+    """{stack: samples} from collapsed-stack text"""
+    stacks = {}
+    for line in collapsed.splitlines():
+        stack, _, count = line.rpartition(' ')
+        if stack and count.isdigit():
+            stacks[stack] = stacks.get(stack, 0) + int(count)
+    return stacks
+
+
+def _colour(name):
+    digest = hashlib.md5(name.encode()).digest()
+    return f'rgb({205 + digest[0] % 50},{80 + digest[1] % 130},{digest[2] % 60})'
+
+
+def flame_graph(collapsed, width=1200, row_height=17):
+    """Inline SVG flame graph (callers on top) of collapsed stacks"""
+    stacks = parse_stacks(collapsed)
+    total = sum(stacks.values())
+    if not total:
+        return format_html('<p>{}</p>', 'No samples: the request finished within one sampling interval.')
+
+    # Merge stacks into a tree of {name: [samples, children]}
+    root = defaultdict(lambda: [0, defaultdict(root.default_factory)])
+    for stack, count in stacks.items():
+        level = root
+        for name in stack.split(';'):
+            node = level[name]
+            node[0] += count
+            level = node[1]
+
+    rects, depth = [], 0
+    pending = [(root, 0, 0.0)]
+    while pending:
+        level, row, x = pending.pop()
+        for name, (count, children) in sorted(level.items()):
+            frame_width = count / total * width
+            if frame_width >= 0.5:
+                depth = max(depth, row + 1)
+                label = name if frame_width > 7 * len(name) else name[:max(int(frame_width / 7) - 2, 0)] + '..'
+                rects.append(
+                    f'<g><title>{escape(name)} ({count} samples, {count / total:.1%})</title>'
+                    f'<rect x="{x:.1f}" y="{row * row_height}" width="{frame_width:.1f}" height="{row_height - 1}" '
+                    f'fill="{_colour(name)}" rx="2"/>'
+                    + (f'<text x="{x + 3:.1f}" y="{row * row_height + row_height - 5}">{escape(label)}</text>'
+                       if frame_width > 21 else '')
+                    + '</g>'
+                )
+                pending.append((children, row + 1, x))
+            x += frame_width
+    return mark_safe(
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{depth * row_height}" '
+        f'font-family="monospace" font-size="11">{"".join(rects)}</svg>'
+    )
@@ -0,0 +1,142 @@
+"""
+Reminder emails for plans that are about to end.
+
+send_expiry_reminders walks each shard's active subscriptions ending
+within the reminder window, in end_date order through a partial index.
+It builds one message per plan and sends every batch over a small pool
+of SMTP connections that stay open for the whole run. The templates are
+compiled once per run and only the per-user context changes.
+
+After each batch an ExpiryReminder marker is stored for every message
+the server accepted, and for every user with no email address to send
+to. Reruns skip those (user, tool, end_date) triples, so
+a plan extended to a new end date is reminded again. A crash can resend
+at most the batch in flight.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db.models import Q
+from django.template.loader import get_template
+from django.utils import timezone
+
+from .metrics import timed
+from .models import Subscription, ExpiryReminder
+
+logger = logging.getLogger(__name__)
+
+RENEW_URL = 'https://marketplace.crispai.ca/'
+
+
+def upcoming(shard, start, end, batch_size):
+    """Batches of active subscriptions on `shard` ending in [start, end), keyset-paginated on (end_date, id)"""
+    queryset = Subscription.objects.using(shard).filter(
+        status=Subscription.Status.ACTIVE, end_date__gte=start, end_date__lt=end,
+    ).order_by('end_date', 'id').values('id', 'user_id', 'tool_id', 'plan', 'end_date')
+    rows = list(queryset[:batch_size])
+    while rows:
+        yield rows
+        last = rows[-1]
+        rows = list(queryset.filter(
+            Q(end_date__gt=last['end_date']) | Q(end_date=last['end_date'], id__gt=last['id']),
+        )[:batch_size])
+
+
+def pending(rows, start, end):
+    """The rows whose (user, tool, end_date) has not been reminded yet"""
+    sent = set(ExpiryReminder.objects.filter(
+        user_id__in={row['user_id'] for row in rows}, end_date__gte=start, end_date__lt=end,
+    ).values_list('user_id', 'tool_id', 'end_date'))
+    return [row for row in rows if (row['user_id'], row['tool_id'], row['end_date']) not in sent]
+
+
+class ReminderRenderer:
+    """Expiry reminder messages from templates compiled once"""
+
+    def __init__(self, tool_names):
+        self.html = get_template('payments/email/expiry_reminder.html')
+        self.text = get_template('payments/email/expiry_reminder.txt')
+        self.tool_names = tool_names
+        self.year = timezone.now().year
+
+    def messages(self, rows):
+        """[(row, message)] for rows whose user has an email address"""
+        users = {user['id']: user for user in User.objects.filter(
+            pk__in={row['user_id'] for row in rows},
+        ).exclude(email='').values('id', 'email', 'first_name')}
+        messages = []
+        for row in rows:
+            user = users.get(row['user_id'])
+            if user is None:
+                continue
+            context = {
+                'first_name': user['first_name'],
+                'tool': self.tool_names.get(row['tool_id'], 'your tool'),
+                'plan': Subscription.Plan(row['plan']).label.lower(),
+                'end_date': timezone.localtime(row['end_date']),
+                'renew_url': RENEW_URL,
+                'year': self.year,
+            }
+            end_date = context['end_date']
+            message = EmailMultiAlternatives(
+                f"Your {context['tool']} plan ends on {end_date:%B} {end_date.day}",
+                self.text.render(context), settings.DEFAULT_FROM_EMAIL, [user['email']],
+            )
+            message.attach_alternative(self.html.render(context), 'text/html')
+            messages.append((row, message))
+        return messages
+
+
+class SMTPPool:
+    """A few SMTP connections held open for a whole run, each used by one sending thread"""
+
+    def __init__(self, size):
+        self.connections = [get_connection() for _ in range(size)]
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='smtp')
+
+    def __enter__(self):
+        for connection in self.connections:
+            connection.open()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.executor.shutdown()
+        for connection in self.connections:
+            connection.close()
+
+    def send(self, items):
+        """Send [(key, message)] spread over the connections; returns the keys the server accepted"""
+        slices = [items[i::len(self.connections)] for i in range(len(self.connections))]
+        sent = []
+        for accepted in self.executor.map(self._send_slice, self.connections, slices):
+            sent.extend(accepted)
+        return sent
+
+    def _send_slice(self, connection, items):
+        accepted = []
+        for key, message in items:
+            try:
+                with timed('smtp'):
+                    sent = connection.send_messages([message])
+            except Exception:
+                logger.exception('Expiry reminder to %s failed', message.to)
+                # The server may have dropped the connection; start a fresh one for the rest
+                connection.close()
+                try:
+                    connection.open()
+                except Exception:
+                    pass  # send_messages() then connects for each message itself
+                continue
+            if sent:
+                accepted.append(key)
+        return accepted
+
+
+def mark_sent(rows):
+    ExpiryReminder.objects.bulk_create([
+        ExpiryReminder(user_id=row['user_id'], tool_id=row['tool_id'], end_date=row['end_date'])
+        for row in rows
+    ], ignore_conflicts=True)
@@ -0,0 +1,146 @@
+"""
+Ranked search over the active tool catalog.
+
+On PostgreSQL, tools match through full-text search over name and
+description, or through trigram word similarity so misspelt queries still
+find them. Both are served by the GIN indexes added in migration 0006, and
+a page with its total match count costs one query.
+
+Other databases use an inverted index of the catalog built in memory once
+per process and rebuilt when catalog_changed fires, which answers searches
+without a query.
+"""
+import math
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count, F, Window
+from django.dispatch import receiver
+
+from .models import Tool
+from .serializers import ToolSerializer
+from .signals import catalog_changed
+
+MAX_PAGE_SIZE = 100
+SEARCH_CONFIG = 'english'
+TOKEN_RE = re.compile(r'\w+')
+# Relative weight of a term found in each field
+FIELD_WEIGHTS = (('name', 3.0), ('description', 1.0))
+# A query term that only prefixes a word in the catalog counts for this much
+PREFIX_WEIGHT = 0.5
+
+
+def search_document():
+    """The tsvector the tool_search_document index is built on; queries must use the same expression"""
+    from django.contrib.postgres.search import SearchVector
+
+    return (SearchVector('name', weight='A', config=SEARCH_CONFIG)
+            + SearchVector('description', weight='B', config=SEARCH_CONFIG))
+
+
+def search_catalog(query, offset=0, limit=20):
+    """(total matches, serialized tools for the page) for a free-text query, best matches first"""
+    if connection.vendor == 'postgresql':
+        return _search_postgres(query, offset, limit)
+    return catalog_index().search(query, offset, limit)
+
+
+def _search_postgres(query, offset, limit):
+    from django.contrib.postgres.lookups import TrigramWordSimilar
+    from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVectorExact, TrigramWordSimilarity
+
+    text = SearchQuery(query, search_type='websearch', config=SEARCH_CONFIG)
+    matches = Tool.objects.filter(is_active=True).alias(document=search_document()).filter(
+        SearchVectorExact(F('document'), text)
+        | TrigramWordSimilar(F('name'), query)
+        | TrigramWordSimilar(F('description'), query)
+    )
+    # The window counts every match before LIMIT applies, so total and page are one query
+    ranked = matches.annotate(
+        score=SearchRank(F('document'), text) + TrigramWordSimilarity(query, 'name'),
+        total=Window(Count('*')),
+    ).order_by('-score', 'name', 'pk')
+    tools = list(ranked[offset:offset + limit])
+    if tools:
+        total = tools[0].total
+    else:
+        # Past the last page the window has no row to ride on
+        total = matches.count() if offset else 0
+    return total, ToolSerializer(tools, many=True).data
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+class InvertedIndex:
+    """Term -> tool postings for the catalog, with prefix matching on the sorted vocabulary"""
+
+    def __init__(self, tools):
+        self.tools = {tool['id']: tool for tool in tools}
+        postings = defaultdict(lambda: defaultdict(float))
+        for tool in tools:
+            for field, weight in FIELD_WEIGHTS:
+                for token in tokenize(tool[field] or ''):
+                    postings[token][tool['id']] += weight
+        self.postings = {token: dict(scores) for token, scores in postings.items()}
+        self.vocabulary = sorted(self.postings)
+        self.built_at = time.monotonic()
+
+    def _prefixed(self, term):
+        start = bisect_left(self.vocabulary, term)
+        for token in self.vocabulary[start:]:
+            if not token.startswith(term):
+                return
+            yield token
+
+    def search(self, query, offset=0, limit=20):
+        """Every query term must match a word or word prefix; rarer terms weigh more"""
+        terms = tokenize(query)
+        if not terms:
+            return 0, []
+        scores = None
+        for term in dict.fromkeys(terms):
+            term_scores = defaultdict(float)
+            for token in self._prefixed(term):
+                factor = 1.0 if token == term else PREFIX_WEIGHT
+                idf = math.log(1 + len(self.tools) / len(self.postings[token]))
+                for tool_id, weight in self.postings[token].items():
+                    term_scores[tool_id] += weight * factor * idf
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {tool_id: score + term_scores[tool_id] for tool_id, score in scores.items()
+                          if tool_id in term_scores}
+            if not scores:
+                return 0, []
+        ranked = sorted(scores, key=lambda tool_id: (-scores[tool_id], self.tools[tool_id]['name'], tool_id))
+        return len(ranked), [self.tools[tool_id] for tool_id in ranked[offset:offset + limit]]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def catalog_index():
+    """This process's index of active tools, rebuilt after a catalog change"""
+    global _index
+    index = _index
+    # Changes made by other processes only arrive through the timeout, as for the cached catalog
+    if index is None or time.monotonic() - index.built_at > settings.CATALOG_CACHE_SECONDS:
+        with _index_lock:
+            if _index is None or _index is index:
+                _index = InvertedIndex(ToolSerializer(Tool.objects.filter(is_active=True), many=True).data)
+            index = _index
+    return index
+
+
+@receiver(catalog_changed)
+def invalidate_index(sender, **kwargs):
+    global _index
+    _index = None
@@ -23,9 +23,28 @@ class ToolSerializer(serializers.ModelSerializer):
         fields = ['id', 'name', 'description', 'price', 'is_active', 'created_at', 'updated_at']
 
 
+class SlugChoiceField(serializers.Field):
+    """Expose an IntegerChoices field by its string slug ('active', '3-month')"""
+
+    def __init__(self, choices_class, **kwargs):
+        self.choices_class = choices_class
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        return self.choices_class(value).slug
+
+    def to_internal_value(self, data):
+        try:
+            return self.choices_class.from_slug(data)
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
+
+
 class SubscriptionSerializer(serializers.ModelSerializer):
     tool = ToolSerializer(read_only=True)
     user = UserSerializer(read_only=True)
+    plan = SlugChoiceField(Subscription.Plan)
+    status = SlugChoiceField(Subscription.Status)
     
     class Meta:
         model = Subscription
@@ -0,0 +1,238 @@
+"""
+Horizontal sharding of per-user billing rows: subscriptions, payments and
+metered usage.
+
+Every such row lives on the database its user hashes to
+on a consistent-hash ring of the aliases in SHARDS. Users, tools and every
+other table stay on `default`, so rows on a shard point at them without
+database foreign keys, and queries never join across the two.
+
+Changing the ring moves only the users whose arc changed hands. While
+`rebalance_shards` moves them, SHARDS_PREVIOUS keeps the old ring: a user
+is read from their old shard until a UserShardMove row records the move.
+"""
+import bisect
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+
+SHARDED_MODELS = {'payments.subscription', 'payments.payment', 'payments.usageevent', 'payments.usagerollup'}
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode(), usedforsecurity=False).digest()[:8], 'big')
+
+
+class HashRing:
+    """Each node owns `replicas` points on the ring; a key belongs to the next point clockwise"""
+
+    def __init__(self, nodes, replicas=64):
+        points = sorted((_hash(f'{node}#{i}'), node) for node in nodes for i in range(replicas))
+        self._points = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key):
+        index = bisect.bisect(self._points, _hash(str(key))) % len(self._points)
+        return self._nodes[index]
+
+
+def _build_ring(aliases):
+    unknown = set(aliases) - set(settings.DATABASES)
+    if unknown:
+        raise ImproperlyConfigured(f'Shards {sorted(unknown)} are not in DATABASES')
+    return HashRing(aliases, settings.SHARD_VIRTUAL_NODES)
+
+
+@lru_cache(maxsize=1)
+def ring():
+    return _build_ring(settings.SHARDS)
+
+
+@lru_cache(maxsize=1)
+def previous_ring():
+    return _build_ring(settings.SHARDS_PREVIOUS) if settings.SHARDS_PREVIOUS else None
+
+
+def all_shards():
+    """Every database that may hold sharded rows, current ring first"""
+    return list(dict.fromkeys(settings.SHARDS + settings.SHARDS_PREVIOUS))
+
+
+def _moved_key(user_id, shard):
+    return f'shard-move:{user_id}:{shard}'
+
+
+def has_moved(user_id, shard):
+    from .models import UserShardMove
+
+    if cache.get(_moved_key(user_id, shard)):
+        return True
+    moved = UserShardMove.objects.filter(user_id=user_id, target=shard).exists()
+    if moved:
+        cache.set(_moved_key(user_id, shard), True, 3600)
+    return moved
+
+
+def shard_for_user(user):
+    """Alias of the database holding a user's subscriptions and payments (a User or an id)"""
+    user_id = getattr(user, 'pk', user)
+    if len(settings.SHARDS) == 1 and not settings.SHARDS_PREVIOUS:
+        return settings.SHARDS[0]
+    shard = ring().node_for(user_id)
+    previous = previous_ring()
+    if previous is None:
+        return shard
+    # Mid-rebalance: only users whose arc changed hands pay for the lookup
+    old = previous.node_for(user_id)
+    if old == shard or has_moved(user_id, shard):
+        return shard
+    return old
+
+
+def group_by_shard(user_ids):
+    """{alias: [user_id, ...]} for the shards holding these users"""
+    groups = {}
+    for user_id in user_ids:
+        groups.setdefault(shard_for_user(user_id), []).append(user_id)
+    return groups
+
+
+def fan_out(func, aliases=None):
+    """Run func(alias) on each shard in a thread pool and return {alias: result}"""
+    aliases = list(all_shards() if aliases is None else aliases)
+    # Pool threads have their own connections and can't see an open transaction's writes
+    if len(aliases) <= 1 or any(connections[alias].in_atomic_block for alias in aliases):
+        return {alias: func(alias) for alias in aliases}
+
+    def run(alias):
+        try:
+            return func(alias)
+        finally:
+            # Connections are per thread; don't leave one open per pool thread
+            connections.close_all()
+
+    with ThreadPoolExecutor(max_workers=len(aliases), thread_name_prefix='shard') as pool:
+        return dict(zip(aliases, pool.map(run, aliases)))
+
+
+def move_user(user_id, source, target):
+    """Move a user's billing rows from `source` to `target` while they stay online
+
+    Rows are copied under new primary keys, routing is flipped, and the
+    originals deleted, in one transaction on `source`. The target copy is
+    committed first, so a failure can leave a duplicate but never lose rows.
+    Rows written to `source` by requests that raced the flip are swept up by
+    the next pass. Returns the number of subscriptions moved.
+    """
+    from .models import Subscription, Payment, UsageEvent, UsageRollup, UserShardMove
+
+    moved = 0
+    while True:
+        with transaction.atomic(using=source):
+            subscriptions = list(
+                Subscription.objects.using(source).select_for_update().filter(user_id=user_id).order_by('pk')
+            )
+            if not subscriptions:
+                return moved
+            payments = list(Payment.objects.using(source).filter(subscription__in=subscriptions).order_by('pk'))
+            usage = list(UsageEvent.objects.using(source).filter(subscription__in=subscriptions).order_by('pk'))
+            rollups = list(UsageRollup.objects.using(source).filter(user_id=user_id).order_by('pk'))
+            rollup_ids = [rollup.pk for rollup in rollups]
+
+            new_ids = {}
+            with transaction.atomic(using=target):
+                # raw saves keep created_at/updated_at as they were
+                for subscription in subscriptions:
+                    old_id, subscription.pk = subscription.pk, None
+                    subscription.save_base(raw=True, using=target, force_insert=True)
+                    new_ids[old_id] = subscription.pk
+                for row in payments + usage:
+                    row.pk = None
+                    row.subscription_id = new_ids[row.subscription_id]
+                    row.save_base(raw=True, using=target, force_insert=True)
+                for rollup in rollups:
+                    rollup.pk = None
+                    rollup.save_base(raw=True, using=target, force_insert=True)
+
+            if not moved:
+                UserShardMove.objects.update_or_create(
+                    user_id=user_id, defaults={'source': source, 'target': target},
+                )
+                cache.delete(_moved_key(user_id, source))
+                cache.set(_moved_key(user_id, target), True, 3600)
+            UsageRollup.objects.using(source).filter(pk__in=rollup_ids).delete()
+            Subscription.objects.using(source).filter(pk__in=new_ids).delete()
+        moved += len(subscriptions)
+
+
+class ShardRouter:
+    """Send queries for sharded models to their user's shard and everything else to `default`"""
+
+    def _db(self, model, instance=None, **hints):
+        # Not label_lower: DatabaseCache's stand-in model only has app_label and model_name
+        if f'{model._meta.app_label}.{model._meta.model_name}' not in SHARDED_MODELS:
+            return DEFAULT_DB_ALIAS
+        if instance is None:
+            return None
+        if instance._meta.label_lower in SHARDED_MODELS:
+            if instance._state.db:
+                return instance._state.db
+            user_id = instance.user_id
+        elif instance._meta.label == settings.AUTH_USER_MODEL:
+            user_id = instance.pk
+        else:
+            return None
+        return shard_for_user(user_id) if user_id is not None else None
+
+    db_for_read = _db
+    db_for_write = _db
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Sharded rows may point at global rows on `default`, never across shards
+        if {obj1._meta.label_lower, obj2._meta.label_lower} <= SHARDED_MODELS:
+            return obj1._state.db == obj2._state.db
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if f'{app_label}.{model_name}' in SHARDED_MODELS:
+            return db in all_shards()
+        # Global tables are created everywhere so the initial foreign keys of
+        # the sharded tables resolve; outside `default` they stay empty.
+        return None
+
+
+# The foreign keys to users and tools cannot cascade across databases, so
+# these receivers delete the dependent rows on whichever shard holds them.
+
+@receiver(pre_delete, sender=settings.AUTH_USER_MODEL)
+def delete_user_shard_rows(sender, instance, **kwargs):
+    from .models import Subscription, Payment, UsageEvent, UsageRollup
+
+    # Every shard, not just the user's: a move in progress can leave rows on both rings
+    for alias in all_shards():
+        for model in (UsageEvent, UsageRollup, Payment, Subscription):
+            model.objects.using(alias).filter(user_id=instance.pk).delete()
+
+
+@receiver(pre_delete, sender='payments.Tool')
+def delete_tool_shard_rows(sender, instance, **kwargs):
+    from .models import Subscription, UsageEvent, UsageRollup
+
+    for alias in all_shards():
+        for model in (UsageEvent, UsageRollup, Subscription):
+            model.objects.using(alias).filter(tool_id=instance.pk).delete()
+
+
+@receiver(setting_changed)
+def reset_ring(setting, **kwargs):
+    if setting in ('SHARDS', 'SHARDS_PREVIOUS', 'SHARD_VIRTUAL_NODES'):
+        ring.cache_clear()
+        previous_ring.cache_clear()
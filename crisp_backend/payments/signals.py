@@ -0,0 +1,15 @@
+from django.dispatch import Signal
+
+# Sent once per affected user whenever what that user may access changes
+# (checkout completed, cancellation, admin edits). Receivers get `user_id`.
+entitlements_changed = Signal()
+
+
+def notify_entitlements_changed(user_ids, sender=None):
+    """Fire one entitlements_changed event per distinct user"""
+    for user_id in set(user_ids):
+        entitlements_changed.send(sender=sender, user_id=user_id)
+
+# Sent when tools are added, edited or removed, including by bulk operations
+# that bypass model signals. Cached renderings of the catalog listen for it.
+catalog_changed = Signal()
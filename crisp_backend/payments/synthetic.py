@@ -0,0 +1,146 @@
+"""
+Synthetic Stripe checkout events, for load testing stripe_webhook.
+
+seed_checkouts() opens one pending checkout per synthetic user, the way
+create_checkout does, and decides whether Stripe will report it completed
+or expired. schedule() turns those into webhook events, with a share
+delivered twice and a share delivered late, as Stripe does under retries.
+sign() produces a Stripe-Signature header that Webhook.construct_event
+accepts for STRIPE_WEBHOOK_SECRET. It is computed at send time, so a long
+replay stays within the signature tolerance. verify() checks that every
+checkout ended in the state its event implies.
+"""
+import hashlib
+import hmac
+import time
+import uuid
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.utils import timezone
+
+from .models import Tool, Subscription, Payment
+from .sharding import shard_for_user
+
+COMPLETED = 'checkout.session.completed'
+EXPIRED = 'checkout.session.expired'
+EMAIL_DOMAIN = 'synthetic.invalid'
+
+
+def sign(payload, secret, timestamp=None):
+    """Stripe-Signature header value for `payload` (bytes)"""
+    timestamp = int(time.time() if timestamp is None else timestamp)
+    signed = f'{timestamp}.'.encode() + payload
+    signature = hmac.new(secret.encode(), signed, hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={signature}'
+
+
+@dataclass
+class Checkout:
+    session_id: str
+    user_id: int
+    outcome: str
+
+
+def checkout_event(checkout, created=None):
+    """A Stripe event dict reporting `checkout.outcome` for its session"""
+    completed = checkout.outcome == COMPLETED
+    return {
+        'id': f'evt_{uuid.uuid4().hex}',
+        'object': 'event',
+        'type': checkout.outcome,
+        'created': int(created or time.time()),
+        'livemode': False,
+        'pending_webhooks': 1,
+        'data': {'object': {
+            'id': checkout.session_id,
+            'object': 'checkout.session',
+            'mode': 'payment',
+            'status': 'complete' if completed else 'expired',
+            'payment_status': 'paid' if completed else 'unpaid',
+            'metadata': {'user_id': str(checkout.user_id)},
+        }},
+    }
+
+
+def seed_checkouts(count, rng, expire_ratio=0.2, label=None):
+    """Create `count` synthetic users, each with a pending checkout; returns (tool, [Checkout])"""
+    label = label or uuid.uuid4().hex[:8]
+    tool = Tool.objects.create(name=f'Webhook Load Test {label}', description='Synthetic', price=Decimal('19.99'),
+                               is_active=False)
+    users = User.objects.bulk_create([
+        User(username=f'webhook-{label}-{i}@{EMAIL_DOMAIN}', email=f'webhook-{label}-{i}@{EMAIL_DOMAIN}')
+        for i in range(count)
+    ])
+
+    checkouts, by_shard = [], defaultdict(list)
+    for i, user in enumerate(users):
+        outcome = EXPIRED if rng.random() < expire_ratio else COMPLETED
+        checkout = Checkout(f'cs_test_{label}_{i}', user.pk, outcome)
+        checkouts.append(checkout)
+        by_shard[shard_for_user(user.pk)].append(checkout)
+
+    end_date = timezone.now() + timedelta(days=30)
+    for shard, shard_checkouts in by_shard.items():
+        subscriptions = Subscription.objects.using(shard).bulk_create([
+            Subscription(user_id=checkout.user_id, tool=tool, plan=Subscription.Plan.ONE_MONTH,
+                         status=Subscription.Status.INACTIVE, end_date=end_date)
+            for checkout in shard_checkouts
+        ])
+        Payment.objects.using(shard).bulk_create([
+            Payment(user_id=checkout.user_id, subscription=subscription, amount=tool.price,
+                    stripe_payment_intent_id=checkout.session_id)
+            for checkout, subscription in zip(shard_checkouts, subscriptions)
+        ])
+    return tool, checkouts
+
+
+def schedule(checkouts, rng, duplicates=0.1, out_of_order=0.1):
+    """Delivery order of the checkouts' events, with shares delivered late and delivered twice
+
+    Returns (events, duplicated, reordered).
+    """
+    deliveries, duplicated, reordered = [], 0, 0
+    for position, checkout in enumerate(checkouts):
+        event = checkout_event(checkout)
+        slot = position
+        if rng.random() < out_of_order:
+            slot = rng.uniform(position, len(checkouts))
+            reordered += 1
+        deliveries.append((slot, event))
+        if rng.random() < duplicates:
+            # Redeliveries carry the same event id
+            deliveries.append((rng.uniform(slot, len(checkouts)), event))
+            duplicated += 1
+    deliveries.sort(key=lambda delivery: delivery[0])
+    return [event for _, event in deliveries], duplicated, reordered
+
+
+def verify(checkouts):
+    """{'completed': (correct, total), 'expired': (correct, total)} from the final subscription states"""
+    by_shard = defaultdict(list)
+    for checkout in checkouts:
+        by_shard[shard_for_user(checkout.user_id)].append(checkout)
+
+    states = defaultdict(list)
+    for shard, shard_checkouts in by_shard.items():
+        for user_id, status, payment_status in Subscription.objects.using(shard).filter(
+            user_id__in=[checkout.user_id for checkout in shard_checkouts],
+        ).values_list('user_id', 'status', 'payment__status'):
+            states[user_id].append((status, payment_status))
+
+    results = {COMPLETED: [0, 0], EXPIRED: [0, 0]}
+    for checkout in checkouts:
+        expected = [(Subscription.Status.ACTIVE, 'succeeded')] if checkout.outcome == COMPLETED else []
+        results[checkout.outcome][0] += states[checkout.user_id] == expected
+        results[checkout.outcome][1] += 1
+    return {'completed': tuple(results[COMPLETED]), 'expired': tuple(results[EXPIRED])}
+
+
+def cleanup(tool, checkouts):
+    """Remove the synthetic users and tool; their billing rows go with them"""
+    User.objects.filter(pk__in=[checkout.user_id for checkout in checkouts]).delete()
+    tool.delete()
@@ -0,0 +1,123 @@
+"""
+In-process background workers for work that must not block a request:
+Stripe calls, and storing buffered usage events.
+"""
+import logging
+import queue
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .utils import get_stripe
+
+logger = logging.getLogger(__name__)
+
+# Queued by shutdown() to tell the worker thread to finish its batch and exit
+_STOP = object()
+
+
+class BatchDispatcher:
+    """Run queued operations on a daemon thread, draining up to `batch_size` at a time
+
+    With `maxsize`, the queue is bounded and offer_many() refuses work that
+    does not fit instead of blocking the caller.
+    """
+
+    def __init__(self, handler, batch_size=50, interval=1.0, maxsize=0, name='stripe-dispatcher'):
+        self.handler = handler
+        self.batch_size = batch_size
+        self.interval = interval
+        self.name = name
+        self._queue = queue.Queue(maxsize)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._producer_lock = threading.Lock()
+
+    def enqueue_many(self, operations):
+        for operation in operations:
+            self._queue.put(operation)
+        self._ensure_started()
+
+    def has_room(self, count):
+        return not self._queue.maxsize or self._queue.qsize() + count <= self._queue.maxsize
+
+    def offer_many(self, operations):
+        """Queue all of `operations`, or none of them if they would overflow the queue"""
+        with self._producer_lock:
+            if not self.has_room(len(operations)):
+                return False
+            for operation in operations:
+                self._queue.put_nowait(operation)
+        self._ensure_started()
+        return True
+
+    def drain(self):
+        """Hand everything queued so far to the handler on the calling thread"""
+        while True:
+            batch = []
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            if not batch:
+                return
+            self.handler(batch)
+
+    def shutdown(self, timeout=10):
+        """Handle everything queued or in flight, then stop the thread; call before the process exits"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None and thread.is_alive():
+            try:
+                self._queue.put(_STOP, timeout=timeout)
+            except queue.Full:
+                pass
+            else:
+                thread.join(timeout)
+        self.drain()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < self.batch_size and batch[-1] is not _STOP:
+                    batch.append(self._queue.get(timeout=self.interval))
+            except queue.Empty:
+                pass
+            stopping = batch[-1] is _STOP
+            if stopping:
+                batch.pop()
+            try:
+                if batch:
+                    self.handler(batch)
+            except Exception:
+                logger.exception('%s: batch of %d operations failed', self.name, len(batch))
+            finally:
+                # Recycle this thread's database connections the way request handling does
+                close_old_connections()
+            if stopping:
+                return
+
+
+def run_stripe_operations(batch):
+    stripe = get_stripe()
+    for operation, argument in batch:
+        try:
+            if operation == 'expire_session':
+                stripe.checkout.Session.expire(argument)
+            else:
+                logger.error('Unknown Stripe operation %s', operation)
+        except stripe.StripeError as e:
+            # Sessions already completed or expired cannot be expired again
+            logger.warning('Stripe %s(%s) failed: %s', operation, argument, e)
+
+
+stripe_dispatcher = BatchDispatcher(run_stripe_operations, batch_size=settings.STRIPE_DISPATCH_BATCH_SIZE)
@@ -0,0 +1,88 @@
+from datetime import timedelta
+from decimal import Decimal
+from itertools import count
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import connections
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from payments.admin import PLAN_EXTENSIONS, selected_shard
+from payments.models import Tool, Subscription, Payment
+from payments.sharding import shard_for_user
+from payments.signals import entitlements_changed
+
+
+class SubscriptionAdminActionTests(TestCase):
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin@example.com', 'admin@example.com', 'pw')
+        tool = Tool.objects.create(name='Tool', description='', price=Decimal('19.99'))
+        cls.end_date = timezone.now() + timedelta(days=10)
+        cls.subscriptions = []
+        plans = [Subscription.Plan.ONE_MONTH, Subscription.Plan.TWELVE_MONTHS, Subscription.Plan.THREE_MONTHS]
+        # The changelist shows one shard at a time, so keep the selection on one
+        users = (User.objects.create_user(f'user{i}@example.com', f'user{i}@example.com', 'pw') for i in count())
+        cls.shard = selected_shard(RequestFactory().get('/'))
+        users = (user for user in users if shard_for_user(user) == cls.shard)
+        for plan, user in zip(plans, users):
+            cls.subscriptions.append(Subscription.objects.create(
+                user=user, tool=tool, plan=plan, status=Subscription.Status.ACTIVE, end_date=cls.end_date,
+            ))
+        Payment.objects.create(user=user, subscription=cls.subscriptions[-1], amount=Decimal('19.99'),
+                               stripe_payment_intent_id='cs_open')
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+        self.notified = []
+        handler = lambda sender, user_id, **kwargs: self.notified.append(user_id)
+        entitlements_changed.connect(handler)
+        self.addCleanup(entitlements_changed.disconnect, handler)
+
+    def changelist_url(self):
+        return reverse('admin:payments_subscription_changelist') + f'?shard={self.shard}'
+
+    def run_action(self, action):
+        with CaptureQueriesContext(connections[self.shard]) as queries, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.client.post(self.changelist_url(), {
+                'action': action,
+                '_selected_action': [sub.pk for sub in self.subscriptions],
+            })
+        return [q['sql'] for q in queries if q['sql'].startswith('UPDATE "payments_subscription"')]
+
+    def test_extend_is_a_single_update(self):
+        self.assertEqual(len(self.run_action('extend_subscriptions')), 1)
+        for subscription in self.subscriptions:
+            subscription.refresh_from_db()
+            self.assertEqual(subscription.end_date, self.end_date + PLAN_EXTENSIONS[subscription.plan])
+        self.assertCountEqual(self.notified, [sub.user_id for sub in self.subscriptions])
+
+    def test_cancel_expires_open_checkout_sessions(self):
+        with mock.patch('payments.admin.stripe_dispatcher.enqueue_many') as enqueue:
+            self.assertEqual(len(self.run_action('cancel_subscriptions')), 1)
+        enqueue.assert_called_once_with([('expire_session', 'cs_open')])
+        self.assertEqual(set(Subscription.objects.using(self.shard).values_list('status', flat=True)),
+                         {Subscription.Status.CANCELED})
+
+    def test_reactivate_only_touches_canceled_and_expired(self):
+        statuses = [Subscription.Status.CANCELED, Subscription.Status.EXPIRED, Subscription.Status.INACTIVE]
+        for subscription, status in zip(self.subscriptions, statuses):
+            Subscription.objects.using(self.shard).filter(pk=subscription.pk).update(status=status)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(self.changelist_url(), {
+                'action': 'reactivate_subscriptions',
+                '_selected_action': [sub.pk for sub in self.subscriptions],
+            }, follow=True)
+        messages = [str(message) for message in response.context['messages']]
+        self.assertIn('2 subscriptions reactivated.', messages)
+        self.assertIn('1 subscriptions skipped: only canceled or expired ones can be reactivated.', messages)
+        current = [Subscription.objects.using(self.shard).get(pk=sub.pk).status for sub in self.subscriptions]
+        self.assertEqual(current, [Subscription.Status.ACTIVE, Subscription.Status.ACTIVE, Subscription.Status.INACTIVE])
+        self.assertCountEqual(self.notified, [sub.user_id for sub in self.subscriptions[:2]])
@@ -0,0 +1,125 @@
+import shutil
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from payments.archive import iter_archived, partitions_for
+from payments.models import Tool, Subscription, Payment, UsageEvent
+
+
+class ArchiveBillingTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        archive_root = tempfile.TemporaryDirectory()
+        self.addCleanup(archive_root.cleanup)
+        self.enterContext(override_settings(BILLING_ARCHIVE_ROOT=archive_root.name))
+
+        self.user = User.objects.create_user('old@example.com', 'old@example.com', 'pw')
+        tool = Tool.objects.create(name='Archived Tool', description='', price=Decimal('19.99'))
+        long_ago = timezone.now() - timedelta(days=800)
+
+        self.dead = Subscription.objects.create(
+            user=self.user, tool=tool, plan=Subscription.Plan.ONE_MONTH, status=Subscription.Status.EXPIRED,
+            end_date=long_ago + timedelta(days=30),
+        )
+        self.live = Subscription.objects.create(
+            user=self.user, tool=tool, plan=Subscription.Plan.TWELVE_MONTHS, status=Subscription.Status.ACTIVE,
+            end_date=timezone.now() + timedelta(days=30),
+        )
+        for subscription in (self.dead, self.live):
+            Payment.objects.create(user=self.user, subscription=subscription, amount=Decimal('19.99'),
+                                   status='succeeded')
+        self.long_ago = long_ago
+        Payment.objects.filter(subscription=self.dead).update(created_at=long_ago)
+        Subscription.objects.filter(pk=self.dead.pk).update(created_at=long_ago, updated_at=long_ago)
+
+    def test_moves_old_rows_to_archive(self):
+        call_command('archive_billing', days=365, chunk_size=1, stdout=StringIO())
+
+        self.assertQuerySetEqual(Subscription.objects.all(), [self.live])
+        self.assertEqual(Payment.objects.get().subscription_id, self.live.pk)
+
+        archived_payments = list(iter_archived('payments', self.user.pk))
+        archived_subscriptions = list(iter_archived('subscriptions', self.user.pk))
+        self.assertEqual([row['subscription_id'] for row in archived_payments], [self.dead.pk])
+        self.assertEqual(archived_payments[0]['tool_name'], 'Archived Tool')
+        self.assertEqual([row['id'] for row in archived_subscriptions], [self.dead.pk])
+        self.assertEqual((archived_subscriptions[0]['status'], archived_subscriptions[0]['plan']), ('expired', '1-month'))
+        self.assertEqual(list(iter_archived('payments', self.user.pk + 1)), [])
+
+    def test_usage_of_archived_subscription_is_archived_not_cascaded(self):
+        Payment.objects.filter(subscription=self.dead).delete()
+        old = UsageEvent.objects.create(user=self.user, tool=self.dead.tool, subscription=self.dead, quantity=3,
+                                        occurred_at=self.long_ago, event_id='old', rolled_up=True)
+        pending = UsageEvent.objects.create(user=self.user, tool=self.dead.tool, subscription=self.dead,
+                                            occurred_at=self.long_ago, event_id='pending')
+        UsageEvent.objects.update(created_at=self.long_ago)
+
+        call_command('archive_billing', days=365, stdout=StringIO())
+        # Not yet rolled up, so the event and its subscription stay
+        self.assertQuerySetEqual(UsageEvent.objects.all(), [pending])
+        self.assertTrue(Subscription.objects.filter(pk=self.dead.pk).exists())
+        self.assertEqual([(row['id'], row['quantity']) for row in iter_archived('usage', self.user.pk)], [(old.pk, 3)])
+
+        UsageEvent.objects.update(rolled_up=True)
+        call_command('archive_billing', days=365, stdout=StringIO())
+        self.assertFalse(UsageEvent.objects.exists())
+        self.assertQuerySetEqual(Subscription.objects.all(), [self.live])
+        self.assertEqual([row['event_id'] for row in iter_archived('usage', self.user.pk)], ['old', 'pending'])
+        self.assertEqual([row['id'] for row in iter_archived('subscriptions', self.user.pk)], [self.dead.pk])
+
+    def test_dry_run_keeps_rows(self):
+        out = StringIO()
+        call_command('archive_billing', days=365, dry_run=True, stdout=out)
+
+        self.assertIn('1 payments, 0 usage events and 0 subscriptions', out.getvalue())
+        self.assertEqual(Payment.objects.count(), 2)
+
+    def get_archive(self, **params):
+        return self.client.get(reverse('archived_billing'), params,
+                               HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+
+    def test_pages_through_partitions_in_primary_key_order(self):
+        for _ in range(10):
+            Payment.objects.create(user=self.user, subscription=self.dead, amount=Decimal('19.99'), status='succeeded')
+        Payment.objects.filter(subscription=self.dead).update(created_at=self.long_ago)
+        expected = list(Payment.objects.filter(subscription=self.dead).order_by('pk').values_list('pk', flat=True))
+        call_command('archive_billing', days=365, chunk_size=1, stdout=StringIO())
+
+        # One partition per row, numbered past 9, so a name sort would misorder them
+        self.assertEqual(len(partitions_for('payments', self.user.pk)), 11)
+        seen, cursor = [], None
+        for _ in range(3):
+            data = self.get_archive(limit=4, **({'cursor': cursor} if cursor else {})).json()
+            seen += [row['id'] for row in data['results']]
+            cursor = data['next_cursor']
+        self.assertEqual((seen, cursor), (expected, None))
+
+        data = self.get_archive(kind='subscriptions').json()
+        self.assertEqual([row['id'] for row in data['results']], [self.dead.pk])
+        for params in ({'cursor': 'bogus'}, {'kind': 'tools'}, {'limit': 0}):
+            with self.subTest(params=params):
+                self.assertEqual(self.get_archive(**params).status_code, 400)
+
+    def test_reindex_rebuilds_user_index_from_manifests(self):
+        call_command('archive_billing', days=365, chunk_size=1, stdout=StringIO())
+        partitions = partitions_for('payments', self.user.pk)
+        # As left by archives written before the index existed
+        shutil.rmtree(Path(settings.BILLING_ARCHIVE_ROOT) / 'payments' / 'users')
+        self.assertEqual(partitions_for('payments', self.user.pk), [])
+
+        out = StringIO()
+        call_command('archive_billing', reindex=True, stdout=out)
+        self.assertIn('Indexed 1 payments partitions', out.getvalue())
+        self.assertEqual(partitions_for('payments', self.user.pk), partitions)
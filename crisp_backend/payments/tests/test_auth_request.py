@@ -0,0 +1,87 @@
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from payments import auth_request
+from payments.models import Tool, Subscription, UserProfile
+from payments.signals import notify_entitlements_changed
+
+
+class AuthRequestTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        auth_request.clear()
+        self.addCleanup(auth_request.clear)
+        self.user = User.objects.create_user('proxied@example.com', 'proxied@example.com', 'pw')
+        UserProfile.objects.create(user=self.user, role='agent')
+        self.tool = Tool.objects.create(name='Proxied Tool', description='', price=Decimal('9.99'))
+        self.other_tool = Tool.objects.create(name='Other Tool', description='', price=Decimal('9.99'))
+        self.subscription = Subscription.objects.create(
+            user=self.user, tool=self.tool, plan=Subscription.Plan.ONE_MONTH, status=Subscription.Status.ACTIVE,
+            end_date=timezone.now() + timedelta(days=30),
+        )
+        self.token = str(RefreshToken.for_user(self.user).access_token)
+
+    def check(self, tool, token=None, **headers):
+        token = self.token if token is None else token
+        if token:
+            headers['HTTP_AUTHORIZATION'] = f'Bearer {token}'
+        return self.client.get(reverse('auth_request'), {'tool': tool} if tool else {}, **headers)
+
+    def test_allows_subscribers_with_user_headers(self):
+        for tool in (self.tool.pk, 'proxied tool'):
+            response = self.check(tool)
+            self.assertEqual(response.status_code, 204)
+            self.assertEqual((response['X-User-Id'], response['X-User-Role']), (str(self.user.pk), 'agent'))
+            self.assertEqual(response.content, b'')
+
+        response = self.client.get(reverse('auth_request'), HTTP_AUTHORIZATION=f'Bearer {self.token}',
+                                   HTTP_X_TOOL=str(self.tool.pk))
+        self.assertEqual(response.status_code, 204)
+
+    def test_denies_everything_else(self):
+        Subscription.objects.create(
+            user=self.user, tool=self.other_tool, plan=Subscription.Plan.ONE_MONTH,
+            status=Subscription.Status.ACTIVE, end_date=timezone.now() - timedelta(days=1),
+        )
+        for tool, token in (
+            (self.other_tool.pk, None),     # plan has ended
+            ('Missing Tool', None),
+            (self.tool.pk, ''),             # no token
+            (self.tool.pk, 'not-a-jwt'),
+            (None, None),                   # no tool
+            (self.tool.pk, str(RefreshToken.for_user(self.user))),  # refresh, not access token
+        ):
+            with self.subTest(tool=tool, token=token):
+                self.assertEqual(self.check(tool, token).status_code, 403)
+
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertEqual(self.check(self.tool.pk, str(RefreshToken.for_user(self.user).access_token)).status_code,
+                         403)
+
+    def test_decisions_are_cached_until_entitlements_change(self):
+        self.assertEqual(self.check(self.tool.pk).status_code, 204)
+        Subscription.objects.filter(pk=self.subscription.pk).update(status=Subscription.Status.CANCELED)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.check(self.tool.pk).status_code, 204)
+
+        notify_entitlements_changed([self.user.pk])
+        self.assertEqual(self.check(self.tool.pk).status_code, 403)
+
+    @override_settings(AUTH_REQUEST_CACHE_SECONDS=0)
+    def test_cache_can_be_turned_off(self):
+        self.check(self.tool.pk)
+        with self.assertNumQueries(2):
+            self.check(self.tool.pk)
+
+    @override_settings(AUTH_REQUEST_CACHE_SIZE=2)
+    def test_cache_stays_within_its_size(self):
+        for tool in (self.tool.pk, self.other_tool.pk, 'Proxied Tool', 'Other Tool'):
+            self.check(tool)
+            self.assertLessEqual(len(auth_request._decisions), 2)
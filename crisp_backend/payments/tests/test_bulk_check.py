@@ -0,0 +1,35 @@
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from payments.models import Tool, Subscription
+
+
+@override_settings(SERVICE_API_TOKENS={'tools': 'svc-token'})
+class BulkCheckSubscriptionTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.user = User.objects.create(username='checked@example.com')
+        self.tool = Tool.objects.create(name='Checked Tool', description='', price=Decimal('9.99'))
+        Subscription.objects.create(user=self.user, tool=self.tool, plan=Subscription.Plan.ONE_MONTH,
+                                    status=Subscription.Status.ACTIVE, end_date=timezone.now() + timedelta(days=30))
+
+    def check(self, checks, token='svc-token'):
+        return self.client.post(reverse('bulk_check_subscription'), {'checks': checks},
+                                content_type='application/json', HTTP_AUTHORIZATION=f'Service {token}')
+
+    def test_non_ascii_token_is_refused_not_an_error(self):
+        self.assertEqual(self.check([{'user_id': self.user.pk, 'tool_id': self.tool.pk}], token='svc-tökén').status_code,
+                         401)
+
+    def test_each_check_needs_a_tool(self):
+        self.assertEqual(self.check([{'user_id': self.user.pk, 'tool_name': 'checked tool'}]).status_code, 200)
+        for check in ({'user_id': self.user.pk}, {'user_id': self.user.pk, 'tool_name': None},
+                      {'user_id': self.user.pk, 'tool_name': ''}, {'user_id': self.user.pk, 'tool_name': 7}, 'bogus'):
+            with self.subTest(check=check):
+                self.assertEqual(self.check([check]).status_code, 400)
@@ -0,0 +1,86 @@
+import gzip
+import json
+from decimal import Decimal
+from unittest import skipIf
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from payments import compression
+from payments.models import Tool, Subscription
+from payments.signals import catalog_changed
+
+
+class NegotiationTests(TestCase):
+    def test_prefers_brotli_then_gzip(self):
+        best = compression.supported_encodings()[0]
+        self.assertEqual(compression.negotiate('gzip, deflate, br'), best)
+        self.assertEqual(compression.negotiate('gzip;q=1.0, br;q=0.5'), 'gzip')
+        self.assertEqual(compression.negotiate('*'), best)
+        self.assertIsNone(compression.negotiate('br;q=0, gzip;q=0'))
+        self.assertIsNone(compression.negotiate(''))
+
+
+@override_settings(COMPRESSION_MIN_SIZE=200)
+class CatalogCompressionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        for i in range(20):
+            Tool.objects.create(name=f'Tool {i}', description='Compressible description ' * 5, price=Decimal('9.99'))
+
+    def test_catalog_is_compressed_once_and_served_from_cache(self):
+        identity = self.client.get(reverse('list_tools'))
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('list_tools'), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(gzip.decompress(response.content), identity.content)
+        self.assertEqual(len(identity.json()), 20)
+
+    @skipIf(compression.brotli is None, 'brotli not installed')
+    def test_brotli_catalog(self):
+        response = self.client.get(reverse('list_tools'), HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(len(compression.brotli.decompress(response.content)), len(
+            self.client.get(reverse('list_tools')).content
+        ))
+
+    def test_tool_changes_invalidate_the_catalog(self):
+        self.client.get(reverse('list_tools'))
+        Tool.objects.create(name='New Tool', description='', price=Decimal('1.00'))
+        self.assertEqual(len(self.client.get(reverse('list_tools')).json()), 21)
+
+        Tool.objects.update(is_active=False)  # bulk update: no model signals
+        catalog_changed.send(sender=Tool)
+        self.assertEqual(self.client.get(reverse('list_tools')).json(), [])
+
+    def test_dynamic_responses_are_compressed_above_the_threshold(self):
+        user = User.objects.create_user('sub@example.com', 'sub@example.com', 'pw')
+        for tool in Tool.objects.all():
+            Subscription.objects.create(user=user, tool=tool, plan=Subscription.Plan.ONE_MONTH)
+        headers = {'HTTP_AUTHORIZATION': f'Bearer {RefreshToken.for_user(user).access_token}'}
+
+        response = self.client.get(reverse('my_subscriptions'), HTTP_ACCEPT_ENCODING='gzip', **headers)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(len(json.loads(gzip.decompress(response.content))), 20)
+        self.assertEqual(int(response['Content-Length']), len(response.content))
+
+        response = self.client.post(reverse('login'), {}, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    @override_settings(COMPRESSION_MIN_SIZE=0)
+    def test_responses_carrying_secrets_are_never_compressed(self):
+        User.objects.create_user('secret@example.com', 'secret@example.com', 'pw')
+        response = self.client.post(reverse('login'), {'email': 'secret@example.com', 'password': 'pw'},
+                                    content_type='application/json', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertIn('access', response.json())
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+        headers = {'HTTP_AUTHORIZATION': f"Bearer {response.json()['access']}", 'HTTP_ACCEPT_ENCODING': 'gzip'}
+        response = self.client.post(reverse('entitlement_stream_ticket'), **headers)
+        self.assertIn('ticket', response.json())
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(self.client.get(reverse('my_subscriptions'), **headers)['Content-Encoding'], 'gzip')
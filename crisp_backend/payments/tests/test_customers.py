@@ -0,0 +1,74 @@
+from decimal import Decimal
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
+
+import stripe
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from payments.models import Tool, UserProfile
+
+
+def fake_customer(**kwargs):
+    return SimpleNamespace(id=f"cus_{kwargs['metadata']['user_id']}")
+
+
+class StripeCustomerTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.user = User.objects.create_user('repeat@example.com', 'repeat@example.com', 'pw')
+        UserProfile.objects.create(user=self.user)
+        self.tools = [Tool.objects.create(name=f'Customer Tool {i}', description='', price=Decimal('9.99'))
+                      for i in range(2)]
+
+    def checkout(self, tool):
+        session = SimpleNamespace(id=f'cs_{tool.pk}', url='https://checkout.stripe.test/')
+        with mock.patch('stripe.checkout.Session.create', return_value=session) as create_session:
+            response = self.client.post(
+                reverse('create_checkout'), {'tool_id': tool.pk}, content_type='application/json',
+                HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}',
+            )
+        self.assertEqual(response.status_code, 200)
+        return create_session.call_args.kwargs
+
+    def test_customer_is_created_once_and_reused(self):
+        with mock.patch('stripe.Customer.create', side_effect=fake_customer) as create_customer:
+            first = self.checkout(self.tools[0])
+            second = self.checkout(self.tools[1])
+
+        create_customer.assert_called_once_with(
+            email='repeat@example.com', metadata={'user_id': str(self.user.pk)},
+            idempotency_key=f'customer-user-{self.user.pk}',
+        )
+        self.assertEqual(UserProfile.objects.get(user=self.user).stripe_customer_id, f'cus_{self.user.pk}')
+        for session in (first, second):
+            self.assertEqual(session['customer'], f'cus_{self.user.pk}')
+            self.assertEqual(session['saved_payment_method_options'], {'payment_method_save': 'enabled'})
+            self.assertNotIn('customer_email', session)
+
+    def test_backfill_fills_missing_customers(self):
+        others = [User.objects.create_user(f'user{i}@example.com', f'user{i}@example.com', 'pw') for i in range(4)]
+        for user in others:
+            UserProfile.objects.create(user=user)
+        UserProfile.objects.filter(user=others[0]).update(stripe_customer_id='cus_existing')
+
+        def flaky(**kwargs):
+            if kwargs['metadata']['user_id'] == str(others[1].pk):
+                raise stripe.APIConnectionError('network down')
+            return fake_customer(**kwargs)
+
+        out = StringIO()
+        with mock.patch('stripe.Customer.create', side_effect=flaky) as create_customer:
+            call_command('backfill_stripe_customers', batch_size=2, workers=2, rate=1000, stdout=out, stderr=StringIO())
+
+        self.assertEqual(create_customer.call_count, 4)
+        self.assertIn('Created 3 Stripe customers; 1 failed', out.getvalue())
+        customers = dict(UserProfile.objects.values_list('user_id', 'stripe_customer_id'))
+        self.assertEqual(customers[others[0].pk], 'cus_existing')
+        self.assertEqual(customers[others[1].pk], '')
+        self.assertEqual(customers[self.user.pk], f'cus_{self.user.pk}')
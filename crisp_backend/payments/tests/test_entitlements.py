@@ -0,0 +1,52 @@
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+
+import jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from payments.entitlements import issue_token
+from payments.models import Tool, Subscription
+from payments.signals import notify_entitlements_changed
+
+SIGNING_KEY = rsa.generate_private_key(public_exponent=65537, key_size=2048).private_bytes(
+    serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption(),
+).decode()
+# Stands in for the PostgreSQL default: a cache every worker reaches through its own connection
+SHARED_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+                            'LOCATION': 'test_entitlement_cache'}}
+
+
+@override_settings(CACHES=SHARED_CACHE, ENTITLEMENT_SIGNING_KEY=SIGNING_KEY)
+class EntitlementTokenCacheTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        call_command('createcachetable', verbosity=0)
+        self.user = User.objects.create_user('cached@example.com', 'cached@example.com', 'pw')
+        tool = Tool.objects.create(name='Cached Tool', description='', price=Decimal('9.99'))
+        self.subscription = Subscription.objects.create(
+            user=self.user, tool=tool, plan=Subscription.Plan.ONE_MONTH, status=Subscription.Status.ACTIVE,
+            end_date=timezone.now() + timedelta(days=30),
+        )
+        self.tool = tool
+
+    def tools(self, token):
+        return jwt.decode(token, options={'verify_signature': False})['tools']
+
+    def test_a_change_handled_by_another_worker_drops_the_cached_token(self):
+        token, _ = issue_token(self.user)
+        self.assertEqual(self.tools(token), [self.tool.pk])
+        Subscription.objects.filter(pk=self.subscription.pk).update(status=Subscription.Status.CANCELED)
+        self.assertEqual(issue_token(self.user)[0], token)
+
+        # The cancellation lands on a worker with its own cache client
+        with mock.patch('payments.entitlements.cache', caches.create_connection('default')):
+            notify_entitlements_changed([self.user.pk])
+        self.assertEqual(self.tools(issue_token(self.user)[0]), [])
@@ -0,0 +1,118 @@
+import asyncio
+import json
+import time
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from payments.entitlements import issue_stream_ticket
+from payments.events import hub
+from payments.models import Tool, Subscription
+
+
+@override_settings(EVENT_STREAM_HEARTBEAT_SECONDS=30, EVENTS_BACKEND='payments.events.LocalBackend')
+class EntitlementStreamTests(TestCase):
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='streamer@example.com')
+        cls.tool = Tool.objects.create(name='Streamed Tool', description='', price=Decimal('19.99'))
+        cls.token = str(RefreshToken.for_user(cls.user).access_token)
+
+    def subscribe(self, end_date):
+        return Subscription.objects.create(user=self.user, tool=self.tool, plan=Subscription.Plan.ONE_MONTH,
+                                           end_date=end_date)
+
+    async def open_stream(self, **headers):
+        ticket = await sync_to_async(issue_stream_ticket)(self.user)
+        response = await self.async_client.get(reverse('entitlement_stream'), {'ticket': ticket}, **headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        return response.streaming_content
+
+    async def next_event(self, stream, timeout=5):
+        chunk = (await asyncio.wait_for(anext(stream), timeout)).decode()
+        self.assertIn('event: entitlements', chunk)
+        return json.loads(chunk.split('data: ', 1)[1])
+
+    async def test_pushes_cancellation_to_the_open_stream(self):
+        await sync_to_async(self.subscribe)(timezone.now() + timedelta(days=30))
+        stream = await self.open_stream()
+        self.assertEqual((await self.next_event(stream))['tools'], [self.tool.pk])
+
+        response = await sync_to_async(self.client.post)(
+            reverse('cancel_subscription'), {'tool_id': self.tool.pk}, content_type='application/json',
+            HTTP_AUTHORIZATION=f'Bearer {self.token}',
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(await self.next_event(stream), {'tools': [], 'earliest_end': None})
+        await stream.aclose()
+
+    async def test_pushes_when_a_plan_lapses(self):
+        await sync_to_async(self.subscribe)(timezone.now() + timedelta(seconds=1))
+        stream = await self.open_stream()
+        self.assertEqual((await self.next_event(stream))['tools'], [self.tool.pk])
+        self.assertEqual((await self.next_event(stream, timeout=3))['tools'], [])
+        await stream.aclose()
+
+    async def test_sends_keepalives(self):
+        with override_settings(EVENT_STREAM_HEARTBEAT_SECONDS=0.01):
+            stream = await self.open_stream()
+            await self.next_event(stream)
+            self.assertEqual(await anext(stream), b': keepalive\n\n')
+            await stream.aclose()
+
+    async def test_heartbeat_picks_up_changes_published_elsewhere(self):
+        subscription = await sync_to_async(self.subscribe)(timezone.now() + timedelta(days=30))
+        with override_settings(EVENT_STREAM_HEARTBEAT_SECONDS=0.01):
+            stream = await self.open_stream()
+            self.assertEqual((await self.next_event(stream))['tools'], [self.tool.pk])
+
+            # Canceled by another worker: no notification reaches this process
+            await Subscription.objects.for_user(self.user).filter(pk=subscription.pk).aupdate(status=Subscription.Status.CANCELED)
+            chunk = b': keepalive\n\n'
+            while chunk == b': keepalive\n\n':
+                chunk = await asyncio.wait_for(anext(stream), 5)
+            self.assertIn('"tools": []', chunk.decode())
+            await stream.aclose()
+
+    async def test_client_disconnect_unsubscribes(self):
+        stream = await self.open_stream()
+        await self.next_event(stream)
+        self.assertIn(self.user.pk, hub._listeners)
+
+        # The ASGI handler cancels the response task when the client goes away
+        waiting = asyncio.ensure_future(anext(stream))
+        await asyncio.sleep(0.05)
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        self.assertNotIn(self.user.pk, hub._listeners)
+
+    async def test_requires_a_fresh_ticket_or_a_bearer_token(self):
+        url = reverse('entitlement_stream')
+        response = await sync_to_async(self.client.post)(reverse('entitlement_stream_ticket'),
+                                                         HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        ticket = response.json()['ticket']
+        self.assertEqual(response.json()['expires_in'], 60)
+        self.assertNotIn(self.token, ticket)
+
+        self.assertEqual((await self.async_client.get(url)).status_code, 401)
+        for params in ({'ticket': 'garbage'}, {'ticket': ticket.replace(':', ':x', 1)}, {'token': self.token}):
+            with self.subTest(params=params):
+                self.assertEqual((await self.async_client.get(url, params)).status_code, 401)
+        with mock.patch('django.core.signing.time.time', return_value=time.time() + 61):
+            self.assertEqual((await self.async_client.get(url, {'ticket': ticket})).status_code, 401)
+
+        for params, headers in (({'ticket': ticket}, {}), ({}, {'Authorization': f'Bearer {self.token}'})):
+            response = await self.async_client.get(url, params, headers=headers)
+            self.assertEqual(response.status_code, 200)
+            await response.streaming_content.aclose()
@@ -0,0 +1,85 @@
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+from payments.models import Tool, Subscription, ExpiryReminder
+
+
+class ExpiryReminderTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.tool = Tool.objects.create(name='Reminded Tool', description='', price=Decimal('19.99'))
+        self.users = [User.objects.create_user(f'expiring{i}@example.com', f'expiring{i}@example.com', 'pw',
+                                               first_name=f'User{i}') for i in range(4)]
+
+    def subscribe(self, user, days, status=Subscription.Status.ACTIVE):
+        return Subscription.objects.create(user=user, tool=self.tool, plan=Subscription.Plan.THREE_MONTHS,
+                                           status=status, end_date=timezone.now() + timedelta(days=days))
+
+    def run_command(self, **options):
+        out = StringIO()
+        call_command('send_expiry_reminders', days=7, batch_size=2, connections=2, stdout=out, **options)
+        return out.getvalue()
+
+    def test_reminds_each_upcoming_expiry_once(self):
+        soon = [self.subscribe(user, days=2 + i) for i, user in enumerate(self.users[:3])]
+        self.subscribe(self.users[3], days=30)
+        self.subscribe(self.users[3], days=1, status=Subscription.Status.CANCELED)
+
+        self.assertIn('Sent 3 expiry reminders', self.run_command())
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox),
+                         sorted(user.email for user in self.users[:3]))
+        message = next(message for message in mail.outbox if message.to == [self.users[0].email])
+        self.assertIn('Reminded Tool', message.subject)
+        self.assertIn('Hi User0,', message.body)
+        self.assertIn('3 months plan', message.alternatives[0][0])
+
+        # A rerun finds nothing new, but a renewal moves the end date and is reminded again
+        self.assertIn('Sent 0 expiry reminders', self.run_command())
+        Subscription.objects.filter(pk=soon[0].pk).update(end_date=soon[0].end_date + timedelta(days=1))
+        self.assertIn('Sent 1 expiry reminders', self.run_command())
+        self.assertEqual(len(mail.outbox), 4)
+        self.assertEqual(ExpiryReminder.objects.count(), 4)
+
+    def test_failed_sends_are_retried_on_the_next_run(self):
+        for user in self.users[:2]:
+            self.subscribe(user, days=3)
+        send_messages = EmailBackend.send_messages
+
+        def flaky(backend, messages):
+            if messages[0].to == [self.users[1].email]:
+                raise ConnectionResetError('server went away')
+            return send_messages(backend, messages)
+
+        with mock.patch.object(EmailBackend, 'send_messages', flaky), self.assertLogs('payments.reminders'):
+            self.assertIn('1 not sent', self.run_command())
+        self.assertEqual(list(ExpiryReminder.objects.values_list('user_id', flat=True)), [self.users[0].pk])
+
+        self.run_command()
+        self.assertEqual([message.to for message in mail.outbox], [[self.users[0].email], [self.users[1].email]])
+
+    def test_users_without_email_are_skipped_once(self):
+        User.objects.filter(pk=self.users[1].pk).update(email='')
+        for user in self.users[:2]:
+            self.subscribe(user, days=3)
+
+        out = self.run_command()
+        self.assertIn('Sent 1 expiry reminders', out)
+        self.assertIn('skipped 1 without an email address', out)
+        self.assertNotIn('not sent', out)
+        self.assertEqual(ExpiryReminder.objects.count(), 2)
+        self.assertNotIn('skipped', self.run_command())
+
+    def test_dry_run_sends_nothing(self):
+        self.subscribe(self.users[0], days=3)
+        self.assertIn('1 reminders due', self.run_command(dry_run=True))
+        self.assertEqual(mail.outbox, [])
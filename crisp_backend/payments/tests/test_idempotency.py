@@ -0,0 +1,128 @@
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from payments.models import Tool, Subscription, Payment, UserProfile, IdempotencyKey
+
+
+class IdempotencyKeyTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('retry@example.com', 'retry@example.com', 'pw')
+        UserProfile.objects.create(user=self.user, stripe_customer_id='cus_retry')
+        self.tool = Tool.objects.create(name='Retried Tool', description='', price=Decimal('9.99'))
+
+    def post(self, name, data, key, user=None, auth=True):
+        headers = {'HTTP_IDEMPOTENCY_KEY': key}
+        user = user or self.user
+        if auth:
+            headers['HTTP_AUTHORIZATION'] = f'Bearer {RefreshToken.for_user(user).access_token}'
+        return self.client.post(reverse(name), data, content_type='application/json', **headers)
+
+    def checkout(self, key, data=None, **patch):
+        session = SimpleNamespace(id='cs_retry', url='https://checkout.stripe.test/retry')
+        with mock.patch('stripe.checkout.Session.create', **(patch or {'return_value': session})) as create:
+            response = self.post('create_checkout', data or {'tool_id': self.tool.pk}, key)
+        return response, create.call_count
+
+    def test_checkout_retry_replays_the_first_response(self):
+        first, calls = self.checkout('key-1')
+        self.assertEqual((first.status_code, calls), (200, 1))
+        self.assertNotIn('Idempotent-Replayed', first)
+
+        # Only the JWT user lookup reaches the database
+        with self.assertNumQueries(1):
+            second, calls = self.checkout('key-1')
+        self.assertEqual((second.status_code, calls), (200, 0))
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(Subscription.objects.count(), 1)
+        self.assertEqual(Payment.objects.count(), 1)
+
+        # Another process without the cached copy answers from the row
+        cache.clear()
+        third, calls = self.checkout('key-1')
+        self.assertEqual((third.json(), calls), (first.json(), 0))
+
+    def test_key_is_bound_to_its_request_and_user(self):
+        self.checkout('key-2')
+        response, calls = self.checkout('key-2', data={'tool_id': self.tool.pk, 'plan': '3-months'})
+        self.assertEqual((response.status_code, calls), (422, 0))
+
+        other = User.objects.create_user('other@example.com', 'other@example.com', 'pw')
+        UserProfile.objects.create(user=other, stripe_customer_id='cus_other')
+        with mock.patch('stripe.checkout.Session.create',
+                        return_value=SimpleNamespace(id='cs_other', url='https://checkout.stripe.test/other')):
+            self.assertEqual(self.post('create_checkout', {'tool_id': self.tool.pk}, 'key-2', other).status_code, 200)
+
+    def test_server_errors_are_not_stored(self):
+        response, _ = self.checkout('key-3', side_effect=ConnectionError('stripe down'))
+        self.assertEqual(response.status_code, 500)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+        response, calls = self.checkout('key-3')
+        self.assertEqual((response.status_code, calls), (200, 1))
+
+    def test_cancel_and_register_run_once(self):
+        Subscription.objects.create(user=self.user, tool=self.tool, plan=Subscription.Plan.ONE_MONTH,
+                                    status=Subscription.Status.ACTIVE, end_date=timezone.now() + timedelta(days=30))
+        for _ in range(2):
+            response = self.post('cancel_subscription', {'tool_id': self.tool.pk}, 'cancel-1')
+            self.assertEqual(response.json(), {'detail': 'Subscription canceled successfully'})
+
+        data = {'first_name': 'New', 'last_name': 'User', 'email': 'new@example.com', 'phone': '555',
+                'password': 'pw12345!', 'repeat_password': 'pw12345!'}
+        responses = [self.post('register', data, 'register-1', auth=False) for _ in range(2)]
+        self.assertEqual([response.status_code for response in responses], [200, 200])
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(IdempotencyKey.objects.get(key='register-1').user_id, None)
+
+    def test_retry_waits_for_the_request_in_flight(self):
+        self.checkout('key-4')
+        record = IdempotencyKey.objects.get(key='key-4')
+        stored = (record.status_code, record.body)
+        IdempotencyKey.objects.filter(pk=record.pk).update(status_code=None, body='')
+        cache.clear()
+
+        def finish(delay):
+            IdempotencyKey.objects.filter(pk=record.pk).update(status_code=stored[0], body=stored[1])
+
+        with mock.patch('payments.idempotency.time.sleep', side_effect=finish) as sleep:
+            response, calls = self.checkout('key-4')
+        self.assertEqual((response.status_code, calls, sleep.call_count), (200, 0, 1))
+        self.assertEqual(response['Idempotent-Replayed'], 'true')
+
+    @override_settings(IDEMPOTENCY_WAIT_SECONDS=0)
+    def test_retry_gives_up_on_a_slow_request_and_takes_over_a_dead_one(self):
+        self.checkout('key-5')
+        now = timezone.now()
+        IdempotencyKey.objects.filter(key='key-5').update(status_code=None, body='', locked_at=now)
+        cache.clear()
+        response, calls = self.checkout('key-5')
+        self.assertEqual((response.status_code, calls), (409, 0))
+
+        IdempotencyKey.objects.filter(key='key-5').update(locked_at=now - timedelta(hours=1))
+        response, calls = self.checkout('key-5')
+        self.assertEqual((response.status_code, calls), (200, 1))
+
+    def test_purge_deletes_expired_keys(self):
+        self.checkout('key-6')
+        self.checkout('key-7')
+        IdempotencyKey.objects.filter(key='key-6').update(expires_at=timezone.now())
+        out = StringIO()
+        call_command('purge_idempotency_keys', stdout=out)
+        self.assertIn('Deleted 1 expired', out.getvalue())
+        self.assertEqual(list(IdempotencyKey.objects.values_list('key', flat=True)), ['key-7'])
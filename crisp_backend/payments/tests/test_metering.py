@@ -0,0 +1,156 @@
+import os
+import queue
+import tempfile
+import time
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from payments.metering import UsageLog, store_usage, usage_dispatcher, validate_usage
+from payments.models import Tool, Subscription, UsageEvent, UsageRollup
+from payments.tasks import BatchDispatcher
+
+
+@override_settings(SERVICE_API_TOKENS={'tools': 'svc-token'})
+class UsageMeteringTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        # Flush on this thread with drain() instead of the dispatcher's worker
+        self.enterContext(mock.patch.object(usage_dispatcher, '_ensure_started'))
+        self.addCleanup(usage_dispatcher.drain)
+
+        self.user = User.objects.create(username='metered@example.com')
+        self.tool = Tool.objects.create(name='Metered Tool', description='', price=Decimal('19.99'))
+        self.other_tool = Tool.objects.create(name='Unbought Tool', description='', price=Decimal('9.99'))
+        self.subscription = Subscription.objects.create(
+            user=self.user, tool=self.tool, plan=Subscription.Plan.ONE_MONTH,
+            start_date=timezone.now() - timedelta(days=40), end_date=timezone.now() + timedelta(days=30),
+        )
+
+    def event(self, **overrides):
+        return {'user_id': self.user.pk, 'tool_id': self.tool.pk, 'quantity': 1, **overrides}
+
+    def record(self, events):
+        return self.client.post(reverse('record_usage'), {'events': events},
+                                content_type='application/json', HTTP_AUTHORIZATION='Service svc-token')
+
+    def test_rejects_events_without_an_active_subscription(self):
+        long_ago = (timezone.now() - timedelta(days=400)).isoformat()
+        Subscription.objects.create(user=self.user, tool=self.other_tool, status=Subscription.Status.CANCELED)
+        response = self.record([
+            self.event(id='ok'),
+            self.event(tool_id=self.other_tool.pk),
+            self.event(quantity=0),
+            self.event(timestamp='yesterday'),
+            {'tool_id': self.tool.pk},
+        ])
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()['accepted'], 1)
+        self.assertEqual([r['index'] for r in response.json()['rejected']], [1, 2, 3, 4])
+        self.assertEqual(response.json()['rejected'][0]['reason'], 'no active subscription')
+
+        # Usage from after the subscription ended is not billable against it
+        self.subscription.end_date = timezone.now() - timedelta(days=1)
+        self.subscription.save()
+        accepted, rejected = validate_usage([self.event(timestamp=long_ago), self.event()])
+        self.assertEqual(len(accepted), 1)
+        self.assertEqual(rejected, [{'index': 1, 'reason': 'no active subscription'}])
+
+    def test_events_are_stored_in_bulk_once_per_id(self):
+        self.record([self.event(id='a', quantity=2), self.event(id='b', quantity=5)])
+        self.record([self.event(id='a', quantity=2)])  # a retry
+        self.assertFalse(UsageEvent.objects.exists())
+
+        usage_dispatcher.drain()
+        self.assertEqual(sorted(UsageEvent.objects.values_list('event_id', 'quantity')), [('a', 2), ('b', 5)])
+        self.assertEqual(set(UsageEvent.objects.values_list('subscription_id', flat=True)), {self.subscription.pk})
+
+    def test_full_buffer_pushes_back(self):
+        with mock.patch.object(usage_dispatcher, '_queue', queue.Queue(3)):
+            self.assertEqual(self.record([self.event(), self.event()]).status_code, 202)
+            response = self.record([self.event(), self.event()])
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response['Retry-After'], '1')
+            usage_dispatcher.drain()
+            self.assertEqual(self.record([self.event(), self.event()]).status_code, 202)
+            usage_dispatcher.drain()
+        self.assertEqual(UsageEvent.objects.count(), 4)
+
+    def test_batch_size_is_capped(self):
+        with override_settings(USAGE_MAX_BATCH=2):
+            self.assertEqual(self.record([self.event()] * 3).status_code, 400)
+
+    def test_usage_log_survives_a_lost_buffer(self):
+        directory = self.enterContext(tempfile.TemporaryDirectory())
+        with override_settings(USAGE_LOG_DIR=directory):
+            self.record([self.event(id='a'), self.event(id='b')])
+            self.assertEqual(len(os.listdir(directory)), 1)
+
+            # The worker dies before flushing: the replay stores the logged events
+            with mock.patch.object(usage_dispatcher, '_queue', queue.Queue()):
+                call_command('replay_usage_log', older_than=0, stdout=StringIO())
+            self.assertEqual(sorted(UsageEvent.objects.values_list('event_id', flat=True)), ['a', 'b'])
+            self.assertEqual(os.listdir(directory), [])
+
+            # The original flush happening as well stores nothing twice
+            usage_dispatcher.drain()
+        self.assertEqual(UsageEvent.objects.count(), 2)
+
+    def test_rotated_segments_are_deleted_once_stored(self):
+        log = UsageLog(self.enterContext(tempfile.TemporaryDirectory()), segment_events=2)
+        accepted, _ = validate_usage([self.event(), self.event(), self.event()])
+        first = log.append(accepted[:2])
+        second = log.append(accepted[2:])
+        self.assertNotEqual(first, second)
+
+        log.done(first, 1)
+        self.assertEqual(sorted(os.listdir(log.directory)), sorted([first, second]))
+        log.done(first, 1)
+        log.done(second, 1)  # still the segment being written to
+        self.assertEqual(os.listdir(log.directory), [second])
+
+    def test_rollup_sums_per_hour_and_only_counts_events_once(self):
+        hour = timezone.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=2)
+        accepted, _ = validate_usage([
+            self.event(id='1', quantity=3, timestamp=(hour + timedelta(minutes=5)).isoformat()),
+            self.event(id='2', quantity=4, timestamp=(hour + timedelta(minutes=55)).isoformat()),
+            self.event(id='3', quantity=10, timestamp=(hour + timedelta(minutes=65)).isoformat()),
+        ])
+        store_usage(accepted)
+        call_command('rollup_usage', batch_size=2, stdout=StringIO())
+        call_command('rollup_usage', stdout=StringIO())
+
+        accepted, _ = validate_usage([self.event(id='4', quantity=1, timestamp=hour.isoformat())])
+        store_usage(accepted)
+        out = StringIO()
+        call_command('rollup_usage', stdout=out)
+        self.assertIn('Rolled up 1 usage events', out.getvalue())
+
+        rollups = UsageRollup.objects.order_by('hour').values_list('hour', 'quantity', 'events')
+        self.assertEqual(list(rollups), [(hour, 8, 3), (hour + timedelta(hours=1), 10, 1)])
+        self.assertFalse(UsageEvent.objects.filter(rolled_up=False).exists())
+
+
+class DispatcherShutdownTests(SimpleTestCase):
+    def test_shutdown_handles_the_batch_in_flight_and_the_queue(self):
+        handled = []
+        dispatcher = BatchDispatcher(handled.extend, batch_size=3, interval=60, maxsize=10, name='test-dispatcher')
+        dispatcher.offer_many(range(5))
+        # The thread takes the first 3 at once, then waits up to a minute to fill a batch with the rest
+        deadline = time.monotonic() + 5
+        while dispatcher._queue.qsize() > 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        thread = dispatcher._thread
+
+        dispatcher.shutdown(timeout=5)
+        self.assertEqual(sorted(handled), [0, 1, 2, 3, 4])
+        self.assertFalse(thread.is_alive())
+
@@ -0,0 +1,52 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from unittest import mock
+
+from django.conf import settings
+from django.test import SimpleTestCase, override_settings
+from django.urls import reverse
+
+from payments import metrics
+
+# Stands in for a gunicorn worker: records one request, then exits
+WORKER = '''
+import os
+from payments.metrics import RequestTimings, record_request
+record_request('healthz', 'GET', 0.01, RequestTimings())
+print(os.getpid())
+'''
+
+
+class MetricsTests(SimpleTestCase):
+    databases = '__all__'
+
+    @override_settings(METRICS_TOKEN='scrape-secret')
+    def test_scrape_needs_the_token(self):
+        for headers in ({}, {'HTTP_AUTHORIZATION': 'Bearer wrong'}, {'HTTP_AUTHORIZATION': 'Bearer scrape-secret!'}):
+            with self.subTest(headers=headers):
+                self.assertEqual(self.client.get(reverse('metrics'), **headers).status_code, 403)
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer scrape-secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE http_request_duration_seconds histogram', response.content)
+
+    def test_scrape_adds_up_every_worker_including_dead_ones(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        env = {**os.environ, 'PROMETHEUS_MULTIPROC_DIR': path}
+        pids = [
+            subprocess.run([sys.executable, '-c', WORKER], cwd=settings.BASE_DIR, env=env,
+                           capture_output=True, text=True, check=True).stdout.strip()
+            for _ in range(3)
+        ]
+        metrics.archive_process(pids[0], path)
+        metrics.archive_process(pids[1], path)
+        self.assertEqual(sorted(name for name in os.listdir(path) if name.endswith('.db')),
+                         sorted([metrics.ARCHIVE_FILE, f'histogram_{pids[2]}.db']))
+
+        with mock.patch.dict(os.environ, {'PROMETHEUS_MULTIPROC_DIR': path}):
+            text = metrics.render_prometheus().decode()
+        self.assertIn('http_request_duration_seconds_count{method="GET",view="healthz"} 3.0', text)
+        self.assertIn('http_request_db_queries_bucket{le="1.0",view="healthz"} 3.0', text)
@@ -0,0 +1,51 @@
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.test import Client, TestCase
+from django.urls import reverse
+
+from payments.models import Tool
+
+
+class PathScopedMiddlewareTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin@example.com', 'admin@example.com', 'pw')
+
+    def test_api_requests_skip_the_site_stack(self):
+        response = self.client.get(reverse('list_tools'))
+        self.assertNotIn('X-Frame-Options', response)
+        self.assertNotIn('csrftoken', response.cookies)
+        self.assertFalse(hasattr(response.wsgi_request, 'session'))
+
+    def test_admin_keeps_sessions_csrf_and_frame_options(self):
+        self.client.force_login(self.admin)
+        response = self.client.get(reverse('admin:index'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Frame-Options'], 'DENY')
+
+        # process_view hooks still run for the wrapped middleware
+        client = Client(enforce_csrf_checks=True)
+        response = client.post(reverse('admin:login'), {'username': 'admin@example.com', 'password': 'pw'})
+        self.assertEqual(response.status_code, 403)
+
+    def test_session_cookie_does_not_authenticate_api_calls(self):
+        self.client.force_login(self.admin)
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('my_subscriptions'))
+        self.assertEqual(response.status_code, 401)
+
+    def test_benchmark_reports_both_stacks(self):
+        out = StringIO()
+        # Five requests are too few to hold anyone to the real budget
+        call_command('bench_middleware', iterations=5, metrics_budget=float('inf'), stdout=out)
+        self.assertIn('full', out.getvalue())
+        self.assertIn('scoped', out.getvalue())
+        self.assertIn('check_subscription:', out.getvalue())
+        self.assertFalse(Tool.objects.filter(name__startswith='bench-').exists())
+
+    def test_benchmark_fails_over_the_metrics_budget(self):
+        with self.assertRaisesMessage(CommandError, 'over the -100% budget'):
+            call_command('bench_middleware', iterations=5, metrics_budget=-1, stdout=StringIO())
@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from payments.models import Tool, Subscription, Payment
+
+
+class PaymentHistoryTests(TestCase):
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('payer@example.com', 'payer@example.com', 'pw')
+        other = User.objects.create_user('someone@example.com', 'someone@example.com', 'pw')
+        tool = Tool.objects.create(name='History Tool', description='', price=Decimal('10.00'))
+        subscription = Subscription.objects.create(user=cls.user, tool=tool, plan=Subscription.Plan.THREE_MONTHS)
+        start = datetime(2026, 1, 20, 12, tzinfo=dt_timezone.utc)
+        cls.payments = []
+        for i in range(5):
+            payment = Payment.objects.create(user=cls.user, subscription=subscription, amount=Decimal('10.00') + i,
+                                             status='failed' if i == 1 else 'succeeded')
+            # Two payments share a timestamp so paging must break the tie on id
+            Payment.objects.filter(pk=payment.pk).update(created_at=start + timedelta(days=10 * min(i, 3)))
+            cls.payments.append(payment)
+        Payment.objects.create(user=other, subscription=Subscription.objects.create(user=other, tool=tool),
+                               amount=Decimal('99.00'))
+
+    def fetch(self, **params):
+        token = RefreshToken.for_user(self.user).access_token
+        return self.client.get(reverse('payment_history'), params, HTTP_AUTHORIZATION=f'Bearer {token}')
+
+    def test_keyset_pages_cover_every_payment_once(self):
+        ids, cursor = [], None
+        while True:
+            body = self.fetch(limit=2, **({'cursor': cursor} if cursor else {})).json()
+            ids += [row['id'] for row in body['results']]
+            cursor = body['next_cursor']
+            if not cursor:
+                break
+        # Newest first; the two payments made at the same moment come out by descending id
+        self.assertEqual(ids, [self.payments[i].pk for i in (4, 3, 2, 1, 0)])
+
+    def test_rows_are_flat(self):
+        row = self.fetch(limit=1).json()['results'][0]
+        self.assertEqual(row['tool'], 'History Tool')
+        self.assertEqual((row['plan'], row['subscription_status']), ('3-month', 'active'))
+        self.assertEqual(row['amount'], '14.00')
+        self.assertNotIn('subscription', row)
+
+    def test_filters(self):
+        body = self.fetch(status='failed').json()
+        self.assertEqual([row['id'] for row in body['results']], [self.payments[1].pk])
+        body = self.fetch(since='2026-02-01', until='2026-02-15').json()
+        self.assertEqual([row['id'] for row in body['results']], [self.payments[2].pk])
+
+    def test_monthly_summary(self):
+        succeeded = [
+            {'month': '2026-02', 'currency': 'USD', 'total': '39.00', 'count': 3},
+            {'month': '2026-01', 'currency': 'USD', 'total': '10.00', 'count': 1},
+        ]
+        self.assertEqual(self.fetch(summary='month', status='succeeded').json()['summary'], succeeded)
+        # The failed payment is left out of the totals unless asked for
+        self.assertEqual(self.fetch(summary='month').json()['summary'], succeeded)
+        self.assertEqual(self.fetch(summary='month', status='failed').json()['summary'], [
+            {'month': '2026-01', 'currency': 'USD', 'total': '11.00', 'count': 1},
+        ])
+
+    def test_rejects_bad_parameters(self):
+        for params in ({'status': 'lost'}, {'since': 'yesterday'}, {'limit': 0}, {'limit': 101}, {'cursor': 'nope'}):
+            with self.subTest(params=params):
+                self.assertEqual(self.fetch(**params).status_code, 400)
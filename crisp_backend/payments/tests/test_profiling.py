@@ -0,0 +1,92 @@
+import time
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from payments.catalog import catalog_variants
+from payments.models import RequestProfile
+from payments.profiling import flame_graph, make_token, profile_dispatcher, store_profiles
+
+
+def slow_catalog():
+    time.sleep(0.05)
+    return catalog_variants()
+
+
+@override_settings(PROFILE_INTERVAL_MS=1)
+class RequestProfilingTests(TestCase):
+    def setUp(self):
+        # Store profiles on this thread with drain() instead of the dispatcher's worker
+        self.enterContext(mock.patch.object(profile_dispatcher, '_ensure_started'))
+        self.addCleanup(profile_dispatcher.drain)
+
+    def get_tools(self, slow=True, **headers):
+        with mock.patch('payments.views.catalog_variants', slow_catalog if slow else catalog_variants):
+            response = self.client.get(reverse('list_tools'), **headers)
+        profile_dispatcher.drain()
+        return response
+
+    def test_signed_header_captures_the_view_stack(self):
+        response = self.get_tools(HTTP_X_PROFILE_REQUEST=make_token())
+        self.assertEqual(response['X-Profiled'], 'header')
+
+        profile = RequestProfile.objects.get()
+        self.assertEqual((profile.view, profile.method, profile.status_code), ('list_tools', 'GET', 200))
+        self.assertGreaterEqual(profile.duration_ms, 50)
+        self.assertGreater(profile.samples, 0)
+        self.assertIn('slow_catalog (test_profiling:', profile.stacks)
+
+    def test_forged_or_missing_header_is_ignored(self):
+        self.get_tools(slow=False, HTTP_X_PROFILE_REQUEST='profile:forged:signature')
+        self.get_tools(slow=False)
+        self.assertFalse(RequestProfile.objects.exists())
+
+    def test_sample_rate_per_view(self):
+        with override_settings(PROFILE_SAMPLE_RATES={'list_tools': 1.0}):
+            self.assertEqual(self.get_tools(slow=False)['X-Profiled'], 'sampled')
+        with override_settings(PROFILE_SAMPLE_RATES={'login': 1.0}):
+            self.assertNotIn('X-Profiled', self.get_tools(slow=False))
+        self.assertEqual(RequestProfile.objects.count(), 1)
+
+    @override_settings(PROFILE_SLOW_MS=30)
+    def test_latency_threshold_keeps_only_slow_requests(self):
+        self.assertNotIn('X-Profiled', self.get_tools(slow=False))
+        self.assertEqual(self.get_tools()['X-Profiled'], 'slow')
+        self.assertEqual(RequestProfile.objects.get().trigger, 'slow')
+
+    @override_settings(PROFILE_MAX_STORED=3)
+    def test_stored_profiles_are_a_ring_buffer(self):
+        for duration in range(5):
+            store_profiles([{
+                'view': 'login', 'method': 'POST', 'path': '/api/auth/login/', 'status_code': 200,
+                'duration_ms': duration, 'trigger': 'sampled', 'samples': 0, 'stacks': '',
+            }])
+        self.assertEqual(list(RequestProfile.objects.values_list('duration_ms', flat=True).order_by('pk')), [2, 3, 4])
+
+    def test_flame_graph_merges_common_callers(self):
+        svg = flame_graph('handler;view;query 3\nhandler;view;<render> 1\n')
+        self.assertEqual(svg.count('<title>handler '), 1)
+        self.assertIn('view (4 samples, 100.0%)', svg)
+        self.assertIn('query (3 samples, 75.0%)', svg)
+        self.assertIn('&lt;render&gt;', svg)
+
+    def test_admin_lists_slowest_first_and_renders_flame_graph(self):
+        self.get_tools(HTTP_X_PROFILE_REQUEST=make_token())
+        profile = RequestProfile.objects.get()
+        self.client.force_login(User.objects.create_superuser('admin@example.com', 'admin@example.com', 'pw'))
+
+        response = self.client.get(reverse('admin:payments_requestprofile_changelist'), {'view': 'login'})
+        self.assertEqual(response.context['cl'].result_count, 0)
+        response = self.client.get(reverse('admin:payments_requestprofile_change', args=[profile.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '<svg')
+        self.assertContains(response, 'slow_catalog')
+
+    def test_profile_token_command(self):
+        out = StringIO()
+        call_command('profile_token', stdout=out, stderr=StringIO())
+        self.assertTrue(out.getvalue().startswith('X-Profile-Request: '))
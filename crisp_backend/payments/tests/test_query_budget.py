@@ -0,0 +1,390 @@
+"""
+Query and allocation budgets for every route in payments.urls.
+
+Each endpoint runs against a small and a large seeded dataset and must issue
+exactly its budgeted number of queries at both sizes, so an N+1 (or any new
+query) fails here instead of in production. Adding a route to payments.urls
+without a budget below also fails.
+"""
+import tracemalloc
+from contextlib import ExitStack, contextmanager
+from datetime import timedelta
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import mock, skipUnless
+
+import jwt
+import stripe
+from asgiref.sync import async_to_sync
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from django.contrib.auth.models import User
+from django.contrib.auth.tokens import default_token_generator
+from django.core.cache import cache
+from django.db import connection, connections
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+from django.utils.http import urlsafe_base64_encode
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from payments import urls as payment_urls
+from payments.events import PostgresNotifyBackend
+from payments.metering import usage_dispatcher
+from payments.models import UserProfile, Tool, Subscription, Payment, UsageEvent
+from payments.sharding import all_shards
+from payments.signals import catalog_changed
+
+PASSWORD = 'correct-horse-battery'
+SIGNING_KEY = rsa.generate_private_key(public_exponent=65537, key_size=2048).private_bytes(
+    serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption(),
+).decode()
+BUDGET_SETTINGS = {
+    'ENTITLEMENT_SIGNING_KEY': SIGNING_KEY,
+    # Budgets count queries on the app's own tables. The shared cache is a table on
+    # PostgreSQL, so keep it in memory here and a cache read costs no query on any database.
+    'CACHES': {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    # Pushes to open streams are budgeted separately below, so the counts are the same on every database
+    'EVENTS_BACKEND': 'payments.events.LocalBackend',
+}
+
+# url name -> exact number of queries per request
+QUERY_BUDGETS = {
+    'register': 3,
+    'login': 2,
+    'logout': 1,
+    'user_profile': 2,
+    'activate': 5,
+    'list_tools': 1,
+    'search_tools': 1,
+    'my_subscriptions': 2,
+    'check_subscription': 2,
+    'bulk_check_subscription': 1,
+    'auth_request': 2,
+    'record_usage': 1,
+    'cancel_subscription': 3,
+    'entitlement_token': 2,
+    'entitlement_jwks': 0,
+    'entitlement_stream': 2,
+    'entitlement_stream_ticket': 1,
+    'create_checkout': 8,
+    'payment_history': 2,
+    'stripe_webhook': 4,
+    'archived_billing': 1,
+    'agent_gateway': 2,
+}
+
+# Routes that publish an entitlement change. On PostgreSQL each change also costs one
+# `SELECT pg_notify` on `default`, on top of QUERY_BUDGETS, from PostgresNotifyBackend.
+NOTIFY_QUERIES = {
+    'cancel_subscription': 1,
+    'stripe_webhook': 1,
+}
+
+# admin changelist (model name) -> exact number of queries per request
+ADMIN_QUERY_BUDGETS = {
+    'userprofile': 5,
+    'tool': 5,
+    'subscription': 5,
+    'payment': 6,
+    'requestprofile': 4,
+}
+
+# Peak bytes allocated while serving a single request
+ALLOCATION_BUDGET = 1024 * 1024
+ADMIN_ALLOCATION_BUDGET = 4 * 1024 * 1024
+
+
+def seed(size):
+    """Create `size` tools, each with an active subscription and payment for one buyer"""
+    now = timezone.now()
+    tools = Tool.objects.bulk_create([
+        Tool(name=f'Seeded Tool {i}', description='Seeded for query budgets', price=Decimal('19.99'))
+        for i in range(size)
+    ])
+    Tool.objects.create(name='Unsubscribed Tool', description='Never bought', price=Decimal('9.99'))
+
+    buyer = User.objects.create_user('buyer@example.com', 'buyer@example.com', PASSWORD)
+    UserProfile.objects.create(user=buyer, role='agent', is_verified=True, stripe_customer_id='cus_buyer')
+    other = User.objects.create_user('other@example.com', 'other@example.com', PASSWORD)
+
+    subscriptions = Subscription.objects.bulk_create([
+        Subscription(user=owner, tool=tool, plan=Subscription.Plan.ONE_MONTH, status=Subscription.Status.ACTIVE,
+                     end_date=now + timedelta(days=30))
+        for tool in tools for owner in (buyer, other)
+    ])
+    Payment.objects.bulk_create([
+        # By id: the unsaved payment has no shard yet, so the router refuses the instance
+        Payment(user_id=sub.user_id, subscription_id=sub.pk, amount=Decimal('19.99'), status='succeeded',
+                stripe_payment_intent_id=f'cs_seed_{sub.pk}')
+        for sub in subscriptions
+    ])
+
+    pending = Subscription.objects.create(
+        user=buyer, tool=tools[0], plan=Subscription.Plan.ONE_MONTH, status=Subscription.Status.INACTIVE,
+        end_date=now + timedelta(days=30),
+    )
+    Payment.objects.create(
+        user=buyer, subscription=pending, amount=Decimal('19.99'), stripe_payment_intent_id='cs_pending'
+    )
+    return buyer, tools
+
+
+@contextmanager
+def capture_all_queries():
+    """Queries on every database, so rows on a shard count against the budget too"""
+    queries = []
+    with ExitStack() as stack:
+        contexts = [stack.enter_context(CaptureQueriesContext(connections[alias])) for alias in connections]
+        yield queries
+    for context in contexts:
+        queries.extend(context.captured_queries)
+
+
+class QueryBudgetMixin:
+    databases = '__all__'
+
+    size = None
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.buyer, cls.tools = seed(cls.size)
+        cls.admin = User.objects.create_superuser('admin@example.com', 'admin@example.com', PASSWORD)
+
+    def setUp(self):
+        cache.clear()
+
+    def auth_headers(self, user=None):
+        token = RefreshToken.for_user(user or self.buyer).access_token
+        return {'HTTP_AUTHORIZATION': f'Bearer {token}'}
+
+    def assertBudget(self, name, send, budget=None, allocation_budget=ALLOCATION_BUDGET):
+        budget = QUERY_BUDGETS[name] if budget is None else budget
+        tracemalloc.start()
+        try:
+            with capture_all_queries() as queries:
+                response = send()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertLess(response.status_code, 500, getattr(response, 'content', b''))
+        self.assertEqual(
+            len(queries), budget,
+            f'{name} issued {len(queries)} queries (budget {budget}) with {self.size} rows:\n'
+            + '\n'.join(q['sql'] for q in queries),
+        )
+        self.assertLess(peak, allocation_budget, f'{name} allocated {peak} bytes at peak')
+        return response
+
+    def get(self, name, data=None, **kwargs):
+        return lambda: self.client.get(reverse(name, kwargs=kwargs or None), data, **self.auth_headers())
+
+    def post(self, name, data=None, auth=True):
+        headers = self.auth_headers() if auth else {}
+        return lambda: self.client.post(reverse(name), data or {}, content_type='application/json', **headers)
+
+    def test_every_route_has_a_budget(self):
+        names = {pattern.name for pattern in payment_urls.urlpatterns}
+        self.assertEqual(names - set(QUERY_BUDGETS), set(), 'routes without a query budget')
+
+    def test_register(self):
+        self.assertBudget('register', self.post('register', {
+            'first_name': 'New', 'last_name': 'User', 'email': 'new@example.com',
+            'phone': '555-0100', 'password': PASSWORD, 'repeat_password': PASSWORD,
+        }, auth=False))
+
+    def test_activate(self):
+        user = User.objects.create_user('inactive@example.com', 'inactive@example.com', PASSWORD, is_active=False)
+        UserProfile.objects.create(user=user)
+        uidb64 = urlsafe_base64_encode(force_bytes(user.pk))
+        token = default_token_generator.make_token(user)
+        self.assertBudget('activate', self.get('activate', uidb64=uidb64, token=token))
+
+    def test_login(self):
+        self.assertBudget('login', self.post('login', {'email': 'buyer@example.com', 'password': PASSWORD}, auth=False))
+
+    def test_logout(self):
+        refresh = str(RefreshToken.for_user(self.buyer))
+        self.assertBudget('logout', self.post('logout', {'refresh': refresh}))
+
+    def test_user_profile(self):
+        self.assertBudget('user_profile', self.get('user_profile'))
+
+    def test_list_tools(self):
+        response = self.assertBudget('list_tools', self.get('list_tools'))
+        self.assertEqual(len(response.json()), self.size + 1)
+
+    def test_search_tools(self):
+        # Elsewhere the index is built with one query on first use, then answers from memory.
+        # PostgreSQL searches its GIN indexes, one query for the page and its count every time.
+        catalog_changed.send(sender=None)
+        response = self.assertBudget('search_tools', self.get('search_tools', {'q': 'seeded'}))
+        self.assertEqual(response.json()['count'], self.size)
+        warm = 1 if connection.vendor == 'postgresql' else 0
+        self.assertBudget('search_tools', self.get('search_tools', {'q': 'tool'}), budget=warm)
+
+    def test_my_subscriptions(self):
+        response = self.assertBudget('my_subscriptions', self.get('my_subscriptions'))
+        self.assertEqual(len(response.json()), self.size + 1)
+
+    def test_check_subscription_tool_list(self):
+        response = self.assertBudget('check_subscription', self.get('check_subscription'))
+        self.assertEqual(len(response.json()['tools']), self.size)
+
+    def test_check_subscription_single_tool(self):
+        # one extra query to resolve the tool by name
+        response = self.assertBudget(
+            'check_subscription', self.get('check_subscription', {'tool_name': self.tools[0].name}),
+            budget=QUERY_BUDGETS['check_subscription'] + 1,
+        )
+        self.assertTrue(response.json()['has_access'])
+
+    def test_auth_request(self):
+        headers = self.auth_headers()
+        send = lambda tool: lambda: self.client.get(reverse('auth_request'), {'tool': tool}, **headers)
+        response = self.assertBudget('auth_request', send(self.tools[0].pk))
+        self.assertEqual((response.status_code, response['X-User-Role']), (204, 'agent'))
+        # Repeats are answered from the per-process decision cache
+        self.assertBudget('auth_request', send(self.tools[0].pk), budget=0)
+        # one extra query to resolve the tool by name
+        response = self.assertBudget('auth_request', send('Unsubscribed Tool'),
+                                     budget=QUERY_BUDGETS['auth_request'] + 1)
+        self.assertEqual(response.status_code, 403)
+
+    @override_settings(SERVICE_API_TOKENS={'tools': 'svc-token'})
+    def test_bulk_check_subscription(self):
+        checks = [{'user_id': self.buyer.pk, 'tool_id': tool.pk} for tool in self.tools]
+        checks += [{'user_id': self.buyer.pk, 'tool_name': tool.name} for tool in self.tools]
+        checks.append({'user_id': self.buyer.pk, 'tool_name': 'Unsubscribed Tool'})
+        response = self.assertBudget('bulk_check_subscription', lambda: self.client.post(
+            reverse('bulk_check_subscription'), {'checks': checks},
+            content_type='application/json', HTTP_AUTHORIZATION='Service svc-token',
+        ))
+        results = response.json()['results']
+        self.assertEqual([r['has_access'] for r in results], [True] * (2 * self.size) + [False])
+
+    @override_settings(SERVICE_API_TOKENS={'tools': 'svc-token'})
+    def test_record_usage(self):
+        events = [{'user_id': self.buyer.pk, 'tool_id': tool.pk, 'quantity': 3} for tool in self.tools]
+        events.append({'user_id': self.buyer.pk, 'tool_id': Tool.objects.get(name='Unsubscribed Tool').pk})
+        with mock.patch.object(usage_dispatcher, '_ensure_started'):
+            response = self.assertBudget('record_usage', lambda: self.client.post(
+                reverse('record_usage'), {'events': events},
+                content_type='application/json', HTTP_AUTHORIZATION='Service svc-token',
+            ))
+        usage_dispatcher.drain()
+        self.assertEqual(response.json()['accepted'], self.size)
+        self.assertEqual(UsageEvent.objects.count(), self.size)
+
+    def test_entitlement_token(self):
+        token = self.assertBudget('entitlement_token', self.get('entitlement_token')).json()['token']
+        jwk = self.assertBudget('entitlement_jwks', self.get('entitlement_jwks')).json()['keys'][0]
+        claims = jwt.decode(token, jwt.PyJWK(jwk).key, algorithms=['RS256'])
+        self.assertEqual(claims['tools'], sorted(tool.pk for tool in self.tools))
+
+    def test_entitlement_stream(self):
+        ticket = self.assertBudget('entitlement_stream_ticket', self.post('entitlement_stream_ticket')).json()['ticket']
+
+        async def first_event():
+            response = await self.async_client.get(reverse('entitlement_stream'), {'ticket': ticket})
+            response.first_event = await anext(response.streaming_content)
+            await response.streaming_content.aclose()
+            return response
+
+        # The user and their active tools, then nothing until something changes
+        response = self.assertBudget('entitlement_stream', async_to_sync(first_event))
+        self.assertIn(f'"tools": {sorted(tool.pk for tool in self.tools)}', response.first_event.decode())
+
+    def test_cancel_subscription(self):
+        self.assertBudget('cancel_subscription', self.post('cancel_subscription', {'tool_id': self.tools[0].pk}))
+
+    @skipUnless(connection.vendor == 'postgresql', 'pg_notify needs PostgreSQL')
+    def test_published_changes_with_pg_notify(self):
+        name = 'cancel_subscription'
+        # The listener thread would hold a connection to the test database; publishing doesn't need it
+        with override_settings(EVENTS_BACKEND='payments.events.PostgresNotifyBackend'), \
+                mock.patch.object(PostgresNotifyBackend, 'start'):
+            self.assertBudget(name, self.post(name, {'tool_id': self.tools[0].pk}),
+                              budget=QUERY_BUDGETS[name] + NOTIFY_QUERIES[name])
+
+    def test_create_checkout(self):
+        session = SimpleNamespace(id='cs_budget', url='https://checkout.stripe.test/cs_budget')
+        with mock.patch('stripe.checkout.Session.create', return_value=session):
+            self.assertBudget('create_checkout', self.post('create_checkout', {'tool_name': 'Unsubscribed Tool'}))
+
+    def test_create_checkout_cart(self):
+        shopper = User.objects.create_user('shopper@example.com', 'shopper@example.com', PASSWORD)
+        UserProfile.objects.create(user=shopper, stripe_customer_id='cus_shopper')
+        items = [{'tool_id': tool.pk, 'plan': '3-month', 'is_yearly': True} for tool in self.tools]
+        session = SimpleNamespace(id='cs_cart', url='https://checkout.stripe.test/cs_cart')
+        with mock.patch('stripe.checkout.Session.create', return_value=session) as create:
+            self.assertBudget('create_checkout', lambda: self.client.post(
+                reverse('create_checkout'), {'items': items},
+                content_type='application/json', **self.auth_headers(shopper),
+            ))
+        self.assertEqual(len(create.call_args.kwargs['line_items']), self.size)
+        self.assertEqual(Payment.objects.for_user(shopper).filter(stripe_payment_intent_id='cs_cart').count(),
+                         self.size)
+
+    def test_stripe_webhook(self):
+        event = stripe.Event.construct_from({
+            'type': 'checkout.session.completed',
+            'data': {'object': {
+                'id': 'cs_pending',
+                'customer_email': self.buyer.email,
+                'metadata': {'tool_id': str(self.tools[0].pk), 'user_id': str(self.buyer.pk), 'plan': '1-month'},
+            }},
+        }, 'sk_test')
+        with mock.patch('stripe.Webhook.construct_event', return_value=event):
+            self.assertBudget('stripe_webhook', self.post('stripe_webhook', auth=False))
+        subscription = Payment.objects.get(stripe_payment_intent_id='cs_pending').subscription
+        self.assertEqual(subscription.status, Subscription.Status.ACTIVE)
+
+    def test_stripe_webhook_expired_session(self):
+        event = stripe.Event.construct_from({
+            'type': 'checkout.session.expired',
+            'data': {'object': {'id': 'cs_pending', 'metadata': {'user_id': str(self.buyer.pk)}}},
+        }, 'sk_test')
+        # Lock the abandoned rows, then the cascade: load them and delete payments, usage, subscriptions
+        with mock.patch('stripe.Webhook.construct_event', return_value=event):
+            self.assertBudget('stripe_webhook', self.post('stripe_webhook', auth=False), budget=7)
+        self.assertFalse(Payment.objects.filter(stripe_payment_intent_id='cs_pending').exists())
+
+    def test_payment_history(self):
+        self.assertBudget('payment_history', self.get('payment_history', {'limit': 10}))
+        # The monthly summary is one more aggregate query
+        self.assertBudget('payment_history', self.get('payment_history', {'summary': 'month'}), budget=3)
+
+    def test_archived_billing(self):
+        with override_settings(BILLING_ARCHIVE_ROOT='/nonexistent/archive'):
+            self.assertBudget('archived_billing', self.get('archived_billing'))
+
+    def test_agent_gateway(self):
+        self.assertBudget('agent_gateway', self.get('agent_gateway'))
+
+    def test_admin_changelists(self):
+        self.client.force_login(self.admin)
+        # With more than one shard, the shard filter counts the matching rows on each
+        shards = all_shards()
+        extra = len(shards) if len(shards) > 1 else 0
+        for model, budget in ADMIN_QUERY_BUDGETS.items():
+            if model in ('subscription', 'payment'):
+                budget += extra
+            with self.subTest(model=model):
+                url = reverse(f'admin:payments_{model}_changelist')
+                self.assertBudget(
+                    f'admin {model}', lambda: self.client.get(url),
+                    budget=budget, allocation_budget=ADMIN_ALLOCATION_BUDGET,
+                )
+
+
+@override_settings(**BUDGET_SETTINGS)
+class SmallDatasetQueryBudgetTests(QueryBudgetMixin, TestCase):
+    size = 2
+
+
+@override_settings(**BUDGET_SETTINGS)
+class LargeDatasetQueryBudgetTests(QueryBudgetMixin, TestCase):
+    size = 40
@@ -0,0 +1,120 @@
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
+
+import stripe
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from payments.models import Tool, Subscription, Payment
+
+
+class AbandonedCheckoutTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.user = User.objects.create_user('cart@example.com', 'cart@example.com', 'pw')
+        self.tools = [Tool.objects.create(name=f'Cart Tool {i}', description='', price=Decimal('19.99'))
+                      for i in range(3)]
+        self.stale = timezone.now() - timedelta(days=5)
+
+    def checkout(self, session_id, tool, status=Subscription.Status.INACTIVE, payment_status='pending', created_at=None):
+        subscription = Subscription.objects.create(user=self.user, tool=tool, plan=Subscription.Plan.ONE_MONTH,
+                                                   status=status)
+        Payment.objects.create(user=self.user, subscription=subscription, amount=tool.price,
+                               status=payment_status, stripe_payment_intent_id=session_id)
+        if created_at:
+            Subscription.objects.filter(pk=subscription.pk).update(created_at=created_at)
+        return subscription
+
+    def expire(self, session_id):
+        event = stripe.Event.construct_from({
+            'type': 'checkout.session.expired',
+            'data': {'object': {'id': session_id, 'metadata': {'user_id': str(self.user.pk)}}},
+        }, 'sk_test')
+        with mock.patch('stripe.Webhook.construct_event', return_value=event), \
+                mock.patch('stripe.checkout.Session.retrieve') as retrieve:
+            response = self.client.post(reverse('stripe_webhook'), b'{}', content_type='application/json')
+        # The event is Stripe's word that the session expired; no lookup needed
+        retrieve.assert_not_called()
+        return response
+
+    def test_expired_session_removes_only_its_unpaid_rows(self):
+        self.checkout('cs_abandoned', self.tools[0])
+        self.checkout('cs_abandoned', self.tools[1])
+        kept = self.checkout('cs_open', self.tools[2])
+
+        self.assertEqual(self.expire('cs_abandoned').status_code, 200)
+        self.assertQuerySetEqual(Subscription.objects.all(), [kept])
+        self.assertEqual(Payment.objects.get().stripe_payment_intent_id, 'cs_open')
+
+    def test_expired_event_leaves_paid_rows(self):
+        paid = self.checkout('cs_paid', self.tools[0], status=Subscription.Status.ACTIVE, payment_status='succeeded')
+        self.expire('cs_paid')
+        self.assertQuerySetEqual(Subscription.objects.all(), [paid])
+        self.assertEqual(Payment.objects.count(), 1)
+
+    def test_failed_activation_asks_stripe_to_retry(self):
+        self.checkout('cs_paid_late', self.tools[0])
+        event = stripe.Event.construct_from({
+            'type': 'checkout.session.completed',
+            'data': {'object': {'id': 'cs_paid_late', 'metadata': {'user_id': str(self.user.pk)}}},
+        }, 'sk_test')
+        with mock.patch('stripe.Webhook.construct_event', return_value=event), \
+                mock.patch('payments.views.notify_entitlements_changed', side_effect=RuntimeError('broker down')):
+            response = self.client.post(reverse('stripe_webhook'), b'{}', content_type='application/json')
+        self.assertEqual(response.status_code, 500)
+
+    def reap(self, sessions, **options):
+        """Run reap_checkouts with Stripe reporting `sessions` {id: status}; returns (output, sessions retrieved)"""
+        def retrieve(session_id):
+            if session_id not in sessions:
+                raise stripe.InvalidRequestError('No such checkout.session', 'id')
+            return SimpleNamespace(id=session_id, status=sessions[session_id])
+
+        out = StringIO()
+        with mock.patch('stripe.checkout.Session.retrieve', side_effect=retrieve) as retrieved:
+            call_command('reap_checkouts', stdout=out, **options)
+        return out.getvalue(), sorted(call.args[0] for call in retrieved.call_args_list)
+
+    def test_reaper_deletes_stale_checkouts_in_chunks(self):
+        for tool in self.tools:
+            self.checkout(f'cs_{tool.pk}', tool, created_at=self.stale)
+        recent = self.checkout('cs_recent', self.tools[0])
+        paid = self.checkout('cs_paid', self.tools[1], status=Subscription.Status.ACTIVE, payment_status='succeeded',
+                             created_at=self.stale)
+
+        with mock.patch('payments.utils.RateLimiter.wait') as wait:
+            out, retrieved = self.reap({f'cs_{tool.pk}': 'expired' for tool in self.tools}, chunk_size=2)
+        self.assertIn('Reaped 3 subscriptions and 3 payments', out)
+        # Each lookup waits its turn under --rate
+        self.assertEqual(wait.call_count, 3)
+        self.assertEqual(retrieved, sorted(f'cs_{tool.pk}' for tool in self.tools))
+        self.assertQuerySetEqual(Subscription.objects.order_by('pk'), [recent, paid])
+        self.assertEqual(Payment.objects.count(), 2)
+
+    def test_reaper_keeps_sessions_stripe_does_not_confirm_expired(self):
+        expired = self.checkout('cs_expired', self.tools[0], created_at=self.stale)
+        paid_late = self.checkout('cs_paid_late', self.tools[1], created_at=self.stale)
+        unknown = self.checkout('cs_unknown', self.tools[2], created_at=self.stale)
+
+        with self.assertLogs('payments.checkouts', 'WARNING'):
+            out, _ = self.reap({'cs_expired': 'expired', 'cs_paid_late': 'complete'})
+        self.assertIn('Reaped 1 subscriptions and 1 payments', out)
+        self.assertIn('kept 2 whose Stripe session is not confirmed expired', out)
+        self.assertQuerySetEqual(Subscription.objects.order_by('pk'), [paid_late, unknown])
+        self.assertFalse(Subscription.objects.filter(pk=expired.pk).exists())
+
+    def test_dry_run_keeps_rows(self):
+        self.checkout('cs_stale', self.tools[0], created_at=self.stale)
+        out = StringIO()
+        with mock.patch('stripe.checkout.Session.retrieve') as retrieve:
+            call_command('reap_checkouts', dry_run=True, stdout=out)
+        self.assertIn('Would check 1 abandoned checkouts', out.getvalue())
+        retrieve.assert_not_called()
+        self.assertEqual(Payment.objects.count(), 1)
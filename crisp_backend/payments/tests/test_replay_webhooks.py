@@ -0,0 +1,65 @@
+import random
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.test import TestCase, override_settings
+
+from payments.models import Tool, Subscription
+from payments.sharding import all_shards
+from payments.synthetic import COMPLETED, Checkout, schedule
+
+
+@override_settings(STRIPE_WEBHOOK_SECRET='whsec_replay_test')
+class ReplayWebhooksTests(TestCase):
+    # Checkouts are seeded on every shard when SHARD_DATABASES is set
+    databases = '__all__'
+
+    def replay(self, **options):
+        out = StringIO()
+        call_command('replay_webhooks', sessions=30, rate=10000, concurrency=1, duplicates=0.3,
+                     out_of_order=0.3, expire_ratio=0.3, seed=7, stdout=out, **options)
+        return out.getvalue()
+
+    def test_signed_events_settle_every_checkout_and_clean_up(self):
+        # The webhook never calls Stripe back, so a remote server under --url settles them too
+        with mock.patch('stripe.checkout.Session.retrieve') as retrieve:
+            out = self.replay()
+        retrieve.assert_not_called()
+        self.assertRegex(out, r'Responses: 200: \d+\n')
+        self.assertIn('Every checkout ended in the state its event implies', out)
+        self.assertFalse(User.objects.filter(email__endswith='@synthetic.invalid').exists())
+        self.assertFalse(Tool.objects.filter(name__startswith='Webhook Load Test').exists())
+
+    def test_keep_leaves_the_settled_checkouts(self):
+        out = self.replay(keep=True)
+        completed, total = (int(n) for n in out.split('completed: ')[1].split(' ')[0].split('/'))
+        self.assertEqual(completed, total)
+        self.assertEqual(User.objects.filter(email__endswith='@synthetic.invalid').count(), 30)
+        self.assertEqual(sum(Subscription.objects.using(shard).filter(status=Subscription.Status.ACTIVE).count()
+                             for shard in all_shards()), total)
+
+    def test_wrong_final_states_fail_the_run(self):
+        with mock.patch('payments.views.reap_session'), self.assertRaisesMessage(CommandError, 'wrong state'):
+            self.replay()
+        self.assertFalse(User.objects.filter(email__endswith='@synthetic.invalid').exists())
+
+    @override_settings(STRIPE_WEBHOOK_SECRET='')
+    def test_requires_a_webhook_secret(self):
+        with self.assertRaisesMessage(CommandError, 'STRIPE_WEBHOOK_SECRET'):
+            self.replay()
+
+
+class ScheduleTests(TestCase):
+    def test_duplicates_and_reordering(self):
+        checkouts = [Checkout(f'cs_{i}', i, COMPLETED) for i in range(200)]
+        events, duplicated, reordered = schedule(checkouts, random.Random(1), duplicates=0.25, out_of_order=0.25)
+
+        self.assertEqual(len(events), 200 + duplicated)
+        self.assertTrue(duplicated and reordered)
+        sessions = [event['data']['object']['id'] for event in events]
+        self.assertEqual(set(sessions), {checkout.session_id for checkout in checkouts})
+        self.assertNotEqual(list(dict.fromkeys(sessions)), [checkout.session_id for checkout in checkouts])
+        # A redelivery repeats the original event id
+        self.assertEqual(len({event['id'] for event in events}), 200)
@@ -0,0 +1,133 @@
+from decimal import Decimal
+from unittest import skipUnless
+
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import F
+from django.test import TestCase, TransactionTestCase
+from django.urls import reverse
+
+from payments.models import Tool
+from payments.search import SEARCH_CONFIG, InvertedIndex, search_catalog, search_document
+
+SEARCH_INDEXES = {'tool_search_document', 'tool_name_trgm', 'tool_description_trgm'}
+
+
+class ToolSearchTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        Tool.objects.bulk_create([
+            Tool(name='Chat Assistant', description='Answers customer support questions', price=Decimal('19.99')),
+            Tool(name='Support Desk', description='Ticketing for customer support teams', price=Decimal('29.99')),
+            Tool(name='Image Studio', description='Generate marketing images from a chat prompt',
+                 price=Decimal('9.99')),
+            Tool(name='Chatter Archive', description='Old chat logs', price=Decimal('5.00'), is_active=False),
+        ])
+        Tool.objects.create(name='Data Analyst', description='Charts and reports', price=Decimal('49.99'))
+
+    def search(self, q, **params):
+        response = self.client.get(reverse('search_tools'), {'q': q, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def names(self, q, **params):
+        return [tool['name'] for tool in self.search(q, **params)['results']]
+
+    def test_name_matches_rank_above_description_matches(self):
+        self.assertEqual(self.names('chat'), ['Chat Assistant', 'Image Studio'])
+        self.assertEqual(self.names('support'), ['Support Desk', 'Chat Assistant'])
+
+    def test_every_word_must_match_a_word_or_its_start(self):
+        self.assertEqual(self.names('customer supp'), ['Support Desk', 'Chat Assistant'])
+        self.assertEqual(self.names('ANALY'), ['Data Analyst'])
+        self.assertEqual(self.names('chat reports'), [])
+
+    def test_results_are_paginated(self):
+        first = self.search('customer', page_size=1)
+        second = self.search('customer', page_size=1, page=2)
+        self.assertEqual(first['count'], 2)
+        self.assertEqual([first['results'][0]['name'], second['results'][0]['name']],
+                         self.names('customer'))
+        self.assertEqual(self.search('customer', page=3)['results'], [])
+
+    def test_catalog_changes_reach_the_index(self):
+        self.assertEqual(self.names('analyst'), ['Data Analyst'])
+        Tool.objects.create(name='Analyst Pro', description='', price=Decimal('99.00'))
+        Tool.objects.filter(name='Data Analyst').delete()
+        self.assertEqual(self.names('analyst'), ['Analyst Pro'])
+
+    def test_rejects_bad_parameters(self):
+        url = reverse('search_tools')
+        self.assertEqual(self.client.get(url).status_code, 400)
+        self.assertEqual(self.client.get(url, {'q': 'chat', 'page': 0}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'q': 'chat', 'page_size': 1000}).status_code, 400)
+
+    def test_rare_terms_outweigh_common_ones(self):
+        index = InvertedIndex([
+            {'id': i, 'name': f'Tool {i}', 'description': 'common words' + (' rare' if i == 7 else '')}
+            for i in range(20)
+        ])
+        count, results = index.search('common rare')
+        self.assertEqual((count, results[0]['id']), (1, 7))
+        self.assertEqual(index.search('common')[0], 20)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'needs PostgreSQL')
+class PostgresSearchTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        Tool.objects.bulk_create([
+            Tool(name='Chat Assistant', description='Answers customer support questions', price=Decimal('19.99')),
+            Tool(name='Support Desk', description='Ticketing for customer support teams', price=Decimal('29.99')),
+            Tool(name='Chatter Archive', description='Old chat logs', price=Decimal('5.00'), is_active=False),
+        ])
+
+    def names(self, query, offset=0, limit=20):
+        count, results = search_catalog(query, offset, limit)
+        return count, [tool['name'] for tool in results]
+
+    def test_ranks_full_text_and_trigram_matches(self):
+        self.assertEqual(self.names('support'), (2, ['Support Desk', 'Chat Assistant']))
+        # Misspelt, so only the trigram index finds it
+        self.assertEqual(self.names('suport desk'), (1, ['Support Desk']))
+        self.assertEqual(self.names('chatter'), (0, []))
+        self.assertEqual(self.names('support', offset=1, limit=1), (2, ['Chat Assistant']))
+        self.assertEqual(self.names('support', offset=5), (2, []))
+
+    def test_page_and_count_are_one_query(self):
+        with self.assertNumQueries(1):
+            self.names('support')
+
+    def test_queries_use_the_migrated_indexes(self):
+        from django.contrib.postgres.search import SearchQuery, SearchVectorExact
+
+        query = Tool.objects.alias(document=search_document()).filter(
+            SearchVectorExact(F('document'), SearchQuery('support', search_type='websearch', config=SEARCH_CONFIG)),
+        )
+        with connection.cursor() as cursor:
+            # The table is far too small for the planner to pick an index on its own
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        self.assertIn('tool_search_document', query.explain())
+
+
+@skipUnless(connection.vendor == 'postgresql', 'needs PostgreSQL')
+class PostgresSearchMigrationTests(TransactionTestCase):
+    def migrate(self, target):
+        MigrationExecutor(connection).migrate([target])
+
+    def indexes(self):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, Tool._meta.db_table)
+        return SEARCH_INDEXES & set(constraints)
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes('payments')[0])
+
+    def test_indexes_come_and_go_with_migration_0008(self):
+        self.assertEqual(self.indexes(), SEARCH_INDEXES)
+        self.migrate(('payments', '0007_usage_metering'))
+        self.assertEqual(self.indexes(), set())
+        self.migrate(('payments', '0008_tool_search_indexes'))
+        self.assertEqual(self.indexes(), SEARCH_INDEXES)
@@ -0,0 +1,170 @@
+"""
+Sharding of billing rows by user.
+
+The ring tests always run. The rest need at least two databases besides
+`default`, e.g.
+
+    SHARD_DATABASES="shard_b=sqlite:///shard_b.db,shard_c=sqlite:///shard_c.db" \
+        python manage.py test payments.tests.test_sharding
+"""
+from collections import Counter
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock, skipUnless
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from payments.models import Tool, Subscription, Payment, UsageEvent, UserShardMove
+from payments.sharding import HashRing, ring, shard_for_user
+
+DATABASE_ALIASES = list(settings.DATABASES)
+
+
+class HashRingTests(SimpleTestCase):
+    def test_keys_spread_evenly(self):
+        nodes = ['a', 'b', 'c']
+        counts = Counter(HashRing(nodes).node_for(key) for key in range(30000))
+        self.assertEqual(set(counts), set(nodes))
+        for count in counts.values():
+            self.assertLess(abs(count - 10000), 2000)
+
+    def test_adding_a_node_only_moves_keys_to_it(self):
+        before, after = HashRing(['a', 'b', 'c']), HashRing(['a', 'b', 'c', 'd'])
+        moved = [key for key in range(30000) if before.node_for(key) != after.node_for(key)]
+        self.assertEqual({after.node_for(key) for key in moved}, {'d'})
+        self.assertLess(abs(len(moved) - 7500), 2000)
+
+
+@skipUnless(len(DATABASE_ALIASES) >= 3, 'set SHARD_DATABASES to at least two extra databases')
+class ShardedBillingTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.enterContext(override_settings(SHARDS=DATABASE_ALIASES, SHARDS_PREVIOUS=[]))
+        self.tool = Tool.objects.create(name='Sharded Tool', description='', price=Decimal('19.99'))
+        self.users = User.objects.bulk_create([
+            User(username=f'user{i}@example.com', email=f'user{i}@example.com') for i in range(24)
+        ])
+
+    def subscribe(self, user, status=Subscription.Status.ACTIVE):
+        subscription = Subscription.objects.create(
+            user=user, tool=self.tool, plan=Subscription.Plan.ONE_MONTH, status=status,
+            end_date=timezone.now() + timedelta(days=30),
+        )
+        Payment.objects.create(user=user, subscription=subscription, amount=Decimal('19.99'), status='succeeded')
+        UsageEvent.objects.create(user=user, tool=self.tool, subscription=subscription,
+                                  occurred_at=timezone.now(), event_id=f'usage-{user.pk}')
+        return subscription
+
+    def rows_by_shard(self, model):
+        return {alias: set(model.objects.using(alias).values_list('user_id', flat=True)) for alias in DATABASE_ALIASES}
+
+    def test_rows_are_written_to_the_users_shard(self):
+        for user in self.users:
+            self.subscribe(user)
+
+        for model in (Subscription, Payment, UsageEvent):
+            placed = self.rows_by_shard(model)
+            self.assertGreater(sum(1 for user_ids in placed.values() if user_ids), 1)
+            for alias, user_ids in placed.items():
+                self.assertEqual({shard_for_user(user_id) for user_id in user_ids} - {alias}, set())
+
+    def test_user_views_read_from_the_users_shard(self):
+        user = next(user for user in self.users if shard_for_user(user) != 'default')
+        self.subscribe(user)
+        headers = {'HTTP_AUTHORIZATION': f'Bearer {RefreshToken.for_user(user).access_token}'}
+
+        response = self.client.get(reverse('my_subscriptions'), **headers)
+        self.assertEqual([row['tool'] for row in response.json()], ['Sharded Tool'])
+        response = self.client.get(reverse('check_subscription'), {'tool_name': 'sharded tool'}, **headers)
+        self.assertTrue(response.json()['has_access'])
+
+        session = SimpleNamespace(id='cs_sharded', url='https://checkout.stripe.test/cs_sharded')
+        other = Tool.objects.create(name='Other Tool', description='', price=Decimal('9.99'))
+        with mock.patch('stripe.checkout.Session.create', return_value=session), \
+                mock.patch('stripe.Customer.create', return_value=SimpleNamespace(id='cus_sharded')):
+            self.client.post(reverse('create_checkout'), {'tool_id': other.pk}, content_type='application/json',
+                             **headers)
+        self.assertTrue(Payment.objects.using(shard_for_user(user)).filter(stripe_payment_intent_id='cs_sharded').exists())
+
+        response = self.client.get(reverse('payment_history'), **headers)
+        self.assertEqual([row['tool'] for row in response.json()['results']], ['Other Tool', 'Sharded Tool'])
+
+    @override_settings(SERVICE_API_TOKENS={'tools': 'svc-token'})
+    def test_bulk_check_fans_out_across_shards(self):
+        for user in self.users[::2]:
+            self.subscribe(user)
+        checks = [{'user_id': user.pk, 'tool_name': 'Sharded Tool'} for user in self.users]
+        checks += [{'user_id': user.pk, 'tool_id': self.tool.pk} for user in self.users]
+
+        response = self.client.post(reverse('bulk_check_subscription'), {'checks': checks},
+                                    content_type='application/json', HTTP_AUTHORIZATION='Service svc-token')
+        expected = [i % 2 == 0 for i in range(len(self.users))] * 2
+        self.assertEqual([result['has_access'] for result in response.json()['results']], expected)
+
+    def test_rebalance_moves_users_online(self):
+        old_ring, new_ring = DATABASE_ALIASES[:-1], DATABASE_ALIASES
+        with override_settings(SHARDS=old_ring):
+            originals = {user.pk: self.subscribe(user) for user in self.users}
+
+        with override_settings(SHARDS=new_ring, SHARDS_PREVIOUS=old_ring):
+            moving = [user.pk for user in self.users if HashRing(old_ring).node_for(user.pk) != ring().node_for(user.pk)]
+            self.assertTrue(moving)
+            # Before the move every user is still read from the old ring
+            for user in self.users:
+                self.assertEqual(Subscription.objects.for_user(user).count(), 1)
+
+            out = StringIO()
+            call_command('rebalance_shards', stdout=out)
+            self.assertIn(f'Moved {len(moving)} users', out.getvalue())
+
+            self.assertCountEqual(UserShardMove.objects.values_list('user_id', flat=True), moving)
+            for user in self.users:
+                subscription = Subscription.objects.for_user(user).get()
+                self.assertEqual(subscription._state.db, ring().node_for(user.pk))
+                self.assertEqual(subscription.created_at, originals[user.pk].created_at)
+                self.assertEqual(Payment.objects.using(subscription._state.db).get(user=user).subscription_id,
+                                 subscription.pk)
+
+        # Once moved, the plain new ring finds everyone and nothing was left behind
+        for model in (Subscription, Payment, UsageEvent):
+            placed = self.rows_by_shard(model)
+            self.assertEqual(sum(len(user_ids) for user_ids in placed.values()), len(self.users))
+            for alias, user_ids in placed.items():
+                self.assertEqual({ring().node_for(user_id) for user_id in user_ids} - {alias}, set())
+
+    def test_admin_browses_one_shard_and_counts_matches_on_all(self):
+        admin = User.objects.create(username='admin', is_staff=True, is_superuser=True)
+        for user in self.users:
+            self.subscribe(user)
+        user = next(user for user in self.users if shard_for_user(user) != 'default')
+        shard = shard_for_user(user)
+        self.client.force_login(admin)
+
+        response = self.client.get(reverse('admin:payments_subscription_changelist'),
+                                   {'shard': shard, 'q': user.username})
+        self.assertContains(response, f'{shard} (1)')
+        self.assertContains(response, 'default (0)')
+        self.assertEqual(list(response.context['cl'].result_list), list(Subscription.objects.for_user(user)))
+
+    def test_deleting_a_user_clears_every_shard(self):
+        old_ring, new_ring = DATABASE_ALIASES[:-1], DATABASE_ALIASES
+        user = next(user for user in self.users if HashRing(old_ring).node_for(user.pk) != ring().node_for(user.pk))
+        # Caught mid-move: rows on the old shard and a copy already on the new one
+        with override_settings(SHARDS=old_ring):
+            self.subscribe(user)
+        with override_settings(SHARDS=new_ring, SHARDS_PREVIOUS=old_ring):
+            UserShardMove.objects.create(user=user, source=HashRing(old_ring).node_for(user.pk),
+                                         target=ring().node_for(user.pk))
+            self.subscribe(user)
+            user.delete()
+        for model in (Subscription, Payment, UsageEvent):
+            self.assertEqual(self.rows_by_shard(model), {alias: set() for alias in DATABASE_ALIASES})
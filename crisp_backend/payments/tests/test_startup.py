@@ -0,0 +1,16 @@
+from io import StringIO
+
+from django.conf import settings
+from django.core.management import call_command
+from django.test import SimpleTestCase
+
+
+class ColdStartTests(SimpleTestCase):
+    def test_cold_start_within_budget(self):
+        # Heavy SDKs must load on first use, not while serving an unrelated first request
+        call_command(
+            'profile_startup',
+            budget_ms=settings.STARTUP_BUDGET_MS,
+            forbid=['stripe', 'dateutil'],
+            stdout=StringIO(),
+        )
@@ -0,0 +1,54 @@
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TransactionTestCase
+
+BEFORE = ('payments', '0002_subscription_email_tool_price_id_userprofile_role_and_more')
+COLUMNS_ADDED = ('payments', '0003_subscription_integer_status_and_plan')
+BACKFILLED = ('payments', '0004_backfill_subscription_codes')
+SWAPPED = ('payments', '0005_swap_subscription_code_columns')
+
+
+class SubscriptionCodeMigrationTests(TransactionTestCase):
+    def migrate(self, target):
+        executor = MigrationExecutor(connection)
+        executor.migrate([target])
+        return executor.loader.project_state([target]).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes('payments')[0])
+
+    def test_backfill_resumes_from_a_partly_filled_table(self):
+        apps = self.migrate(BEFORE)
+        User = apps.get_model('auth', 'User')
+        Tool = apps.get_model('payments', 'Tool')
+        Subscription = apps.get_model('payments', 'Subscription')
+        user = User.objects.create(username='migrated@example.com')
+        tool = Tool.objects.create(name='Migrated Tool', description='', price=1)
+        for status, plan in [('active', '1-month'), ('cancelled', '3-month'), ('expired', ''), ('inactive', '12-month')]:
+            Subscription.objects.create(user=user, tool=tool, status=status, plan=plan)
+
+        # As left by a backfill interrupted after its first chunk: the columns are
+        # committed and recorded on their own, one row is filled and the rest are not
+        apps = self.migrate(COLUMNS_ADDED)
+        Subscription = apps.get_model('payments', 'Subscription')
+        Subscription.objects.filter(status='active').update(status_code=1, plan_code=1)
+        self.assertIn(COLUMNS_ADDED, MigrationExecutor(connection).loader.applied_migrations)
+
+        apps = self.migrate(SWAPPED)
+        Subscription = apps.get_model('payments', 'Subscription')
+        self.assertEqual(sorted(Subscription.objects.values_list('status', 'plan')),
+                         [(1, 1), (2, 12), (3, 0), (4, 3)])
+
+    def test_swap_codes_rows_inserted_after_the_backfill(self):
+        apps = self.migrate(BACKFILLED)
+        User = apps.get_model('auth', 'User')
+        Tool = apps.get_model('payments', 'Tool')
+        Subscription = apps.get_model('payments', 'Subscription')
+        user = User.objects.create(username='late@example.com')
+        tool = Tool.objects.create(name='Late Tool', description='', price=1)
+        # Saved by a worker still running the slug-only code
+        Subscription.objects.create(user=user, tool=tool, status='expired', plan='6-month')
+
+        apps = self.migrate(SWAPPED)
+        Subscription = apps.get_model('payments', 'Subscription')
+        self.assertEqual(list(Subscription.objects.values_list('status', 'plan')), [(3, 6)])
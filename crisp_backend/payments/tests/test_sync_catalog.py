@@ -0,0 +1,143 @@
+import json
+import os
+import tempfile
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from payments.catalog import catalog_variants
+from payments.models import Tool
+from payments.signals import catalog_changed
+
+
+class SyncCatalogTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.kept = Tool.objects.create(name='Kept Tool', description='Same', price=Decimal('9.99'))
+        self.repriced = Tool.objects.create(name='Repriced Tool', description='Old', price=Decimal('9.99'))
+        self.removed = Tool.objects.create(name='Removed Tool', description='', price=Decimal('5.00'))
+
+    def write(self, data, name='catalog.json'):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(data if isinstance(data, str) else json.dumps(data))
+        return path
+
+    def sync(self, path, **options):
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('sync_catalog', path, stdout=out, **options)
+        return out.getvalue()
+
+    def catalog(self, extra=0):
+        return {'tools': [
+            {'name': 'Kept Tool', 'description': 'Same', 'price': 9.99},
+            {'name': 'Repriced Tool', 'description': 'New', 'price': '14.50', 'price_id': 'price_123'},
+            {'name': 'New Tool', 'description': 'Fresh', 'price': 29},
+        ] + [{'name': f'Extra {i}', 'price': 1} for i in range(extra)]}
+
+    def test_applies_the_diff_and_announces_it_once(self):
+        receiver = mock.Mock()
+        catalog_changed.connect(receiver)
+        self.addCleanup(catalog_changed.disconnect, receiver)
+
+        out = self.sync(self.write(self.catalog()))
+        self.assertIn('1 created, 1 updated, 1 deactivated, 1 unchanged', out)
+        self.assertEqual(receiver.call_count, 1)
+
+        tools = {tool.name: tool for tool in Tool.objects.all()}
+        self.assertEqual((tools['Repriced Tool'].price, tools['Repriced Tool'].description,
+                          tools['Repriced Tool'].price_id), (Decimal('14.50'), 'New', 'price_123'))
+        self.assertEqual(tools['New Tool'].price, Decimal('29.00'))
+        self.assertFalse(tools['Removed Tool'].is_active)
+        self.assertEqual(tools['Kept Tool'].updated_at, self.kept.updated_at)
+
+        # A second push of the same file changes nothing and stays quiet
+        self.assertIn('0 created, 0 updated, 0 deactivated, 3 unchanged', self.sync(self.write(self.catalog())))
+        self.assertEqual(receiver.call_count, 1)
+
+    def test_query_count_does_not_grow_with_the_catalog(self):
+        counts = []
+        for extra in (2, 40):
+            # Same starting point each time: one tool to update, one to deactivate, the rest new
+            Tool.objects.exclude(pk__in=[self.kept.pk, self.repriced.pk, self.removed.pk]).delete()
+            Tool.objects.filter(pk=self.repriced.pk).update(description='Old')
+            Tool.objects.filter(pk=self.removed.pk).update(is_active=True)
+            with CaptureQueriesContext(connection) as queries:
+                self.sync(self.write(self.catalog(extra)))
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_yaml_catalog_and_keep_missing(self):
+        path = self.write('tools:\n  - name: YAML Tool\n    description: From YAML\n    price: 3.50\n', 'catalog.yaml')
+        self.sync(path, keep_missing=True)
+        self.assertTrue(Tool.objects.get(name='Removed Tool').is_active)
+        self.assertEqual(Tool.objects.get(name='YAML Tool').price, Decimal('3.50'))
+
+    def test_invalid_catalog_changes_nothing(self):
+        for catalog in (
+            {'tools': [{'name': 'No Price'}]},
+            {'tools': [{'name': 'NaN Price', 'price': float('nan')}]},
+            {'tools': [{'name': 'Endless Price', 'price': 'Infinity'}]},
+            {'tools': [{'name': 'Twice', 'price': 1}, {'name': 'Twice', 'price': 2}]},
+            {'tools': [{'name': 'Odd', 'price': 1, 'colour': 'red'}]},
+            {'tools': [{'name': 'Flag', 'price': 1, 'is_active': 'no'}]},
+            {'items': []},
+        ):
+            with self.subTest(catalog=catalog), self.assertRaises(CommandError):
+                self.sync(self.write(catalog))
+        self.assertEqual(Tool.objects.count(), 3)
+        self.assertTrue(Tool.objects.get(name='Removed Tool').is_active)
+
+    def test_yaml_syntax_error_names_file_and_line(self):
+        path = self.write('tools:\n  - name: Broken\n    price: [1\n', 'catalog.yaml')
+        with self.assertRaisesMessage(CommandError, f'{path}: Invalid YAML at line 4'):
+            self.sync(path)
+
+    def test_omitted_fields_keep_their_stored_values(self):
+        Tool.objects.filter(pk=self.kept.pk).update(price_id='price_kept', is_active=False)
+        self.assertIn('1 updated, 0 deactivated, 1 unchanged', self.sync(self.write(self.catalog()), keep_missing=True))
+        kept = Tool.objects.get(pk=self.kept.pk)
+        self.assertEqual((kept.price_id, kept.is_active), ('price_kept', False))
+        created = Tool.objects.get(name='New Tool')
+        self.assertEqual((created.price_id, created.is_active), ('', True))
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+                                           'LOCATION': 'test_catalog_cache'}})
+    def test_sync_from_another_process_clears_the_shared_cache(self):
+        call_command('createcachetable', verbosity=0)
+        self.assertNotIn(b'New Tool', catalog_variants()['identity'])
+        # The command runs in its own process, with its own cache client
+        with mock.patch('payments.catalog.cache', caches.create_connection('default')):
+            self.sync(self.write(self.catalog()))
+        self.assertIn(b'New Tool', catalog_variants()['identity'])
+
+    def test_dry_run(self):
+        self.assertIn('Would sync catalog: 1 created', self.sync(self.write(self.catalog()), dry_run=True))
+        self.assertFalse(Tool.objects.filter(name='New Tool').exists())
+
+    def test_populate_data_loads_the_sample_catalog(self):
+        call_command('populate_data', stdout=StringIO())
+        self.assertEqual(Tool.objects.filter(is_active=True).count(), 9)
+        self.assertEqual(Tool.objects.get(name='AI Writing Assistant').price, Decimal('19.99'))
+
+        # Running it again adds nothing and leaves edited tools as they are
+        Tool.objects.filter(name='AI Writing Assistant').update(
+            price=Decimal('24.99'), description='Edited', price_id='price_live', is_active=False,
+        )
+        out = StringIO()
+        call_command('populate_data', stdout=out)
+        self.assertIn('0 created, 0 updated, 0 deactivated, 6 unchanged', out.getvalue())
+        tool = Tool.objects.get(name='AI Writing Assistant')
+        self.assertEqual((tool.price, tool.description, tool.price_id, tool.is_active),
+                         (Decimal('24.99'), 'Edited', 'price_live', False))
@@ -11,15 +11,29 @@ urlpatterns = [
     
     # Tools
     path('tools/', views.list_tools, name='list_tools'),
+    path('tools/search/', views.search_tools, name='search_tools'),
     
     # Subscriptions
     path('subscriptions/', views.my_subscriptions, name='my_subscriptions'),
     path('subscriptions/check/', views.check_subscription, name='check_subscription'),
+    path('subscriptions/check/bulk/', views.bulk_check_subscription, name='bulk_check_subscription'),
+    path('subscriptions/auth/', views.auth_request, name='auth_request'),
     path('subscriptions/cancel/', views.cancel_subscription, name='cancel_subscription'),
+
+    # Usage metering
+    path('usage/', views.record_usage, name='record_usage'),
+
+    # Entitlements
+    path('entitlements/token/', views.entitlement_token, name='entitlement_token'),
+    path('entitlements/jwks/', views.entitlement_jwks, name='entitlement_jwks'),
+    path('entitlements/stream/', views.entitlement_stream, name='entitlement_stream'),
+    path('entitlements/stream/ticket/', views.entitlement_stream_ticket, name='entitlement_stream_ticket'),
     
     # Payments
     path('checkout/', views.create_checkout, name='create_checkout'),
+    path('payments/', views.payment_history, name='payment_history'),
     path('webhook/stripe/', views.stripe_webhook, name='stripe_webhook'),
+    path('billing/archive/', views.archived_billing, name='archived_billing'),
     
     # Agent
     path('agent/gateway/', views.agent_gateway, name='agent_gateway'),
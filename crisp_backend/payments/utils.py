@@ -1,3 +1,8 @@
+import threading
+import time
+from functools import lru_cache
+
+from django.conf import settings
 from django.utils.http import urlsafe_base64_encode
 from django.utils.encoding import force_bytes
 from django.contrib.auth.tokens import default_token_generator
@@ -13,4 +18,28 @@ def generate_activation_link(user, request):
         reverse('activate', kwargs={'uidb64': uid, 'token': token})
     )
     
-    return activation_url
\ No newline at end of file
+    return activation_url
+
+
+@lru_cache(maxsize=None)
+def get_stripe():
+    """Import and configure the Stripe SDK on first use rather than at startup"""
+    import stripe
+    stripe.api_key = settings.STRIPE_SECRET_KEY
+    return stripe
+
+
+class RateLimiter:
+    """Space calls at least 1/rate seconds apart across all threads"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + self.interval
+        time.sleep(slot - now)
@@ -1,23 +1,36 @@
-import stripe
+import asyncio
+import hmac
+import json
+import math
+from datetime import datetime
+from itertools import chain
+
+from asgiref.sync import sync_to_async
+
 from django.conf import settings
-from django.http import JsonResponse, HttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Q
+from django.db.models.functions import Lower
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.shortcuts import redirect
 from django.views.decorators.csrf import csrf_exempt
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, authentication_classes, permission_classes
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
-from rest_framework import status
+from rest_framework import exceptions, status
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth.hashers import make_password
 from django.contrib.auth import authenticate
 from django.contrib.auth.models import User
-from django.core.mail import EmailMultiAlternatives
 from django.utils.http import urlsafe_base64_decode
 from django.contrib.auth.tokens import default_token_generator
 from django.utils.encoding import force_str
 from django.urls import reverse
 from django.utils import timezone
-from dateutil.relativedelta import relativedelta
+from django.utils.dateparse import parse_date, parse_datetime
 
 from .models import UserProfile, Tool, Subscription, Payment
 from .serializers import (
@@ -25,14 +38,28 @@ from .serializers import (
     SubscriptionSerializer, PaymentSerializer, UserRegistrationSerializer,
     LoginSerializer, CheckoutSerializer
 )
-from .utils import generate_activation_link
-
-# Set Stripe API key
-stripe.api_key = settings.STRIPE_SECRET_KEY
+from .utils import generate_activation_link, get_stripe
+from .authentication import ServiceTokenAuthentication, IsService
+from .entitlements import active_entitlements, issue_stream_ticket, issue_token, jwks, stream_ticket_user_id
+from .events import hub
+from . import archive
+from .auth_request import access_decision
+from .catalog import catalog_variants
+from . import history
+from .checkouts import reap_session
+from .customers import stripe_customer_id
+from .idempotency import idempotent
+from .compression import never_compress, precompressed_response
+from .metering import enqueue_usage, validate_usage
+from .search import MAX_PAGE_SIZE, search_catalog
+from .signals import notify_entitlements_changed
+from .sharding import fan_out, group_by_shard, shard_for_user
+from .metrics import timed, render_prometheus
 
 
 @api_view(["POST"])
 @permission_classes([AllowAny])
+@idempotent
 def register(request):
     """Enhanced user registration with email verification"""
     data = request.data
@@ -174,9 +201,12 @@ def register(request):
         text_body = f"Hi {data['first_name']},\n\nClick the link below to activate your account:\n\n{activation_url}"
         from_email = settings.DEFAULT_FROM_EMAIL
         
+        from django.core.mail import EmailMultiAlternatives
+
         msg = EmailMultiAlternatives(subject, text_body, from_email, [user.email])
         msg.attach_alternative(html_body, "text/html")
-        msg.send()
+        with timed("smtp"):
+            msg.send()
 
         return Response({"detail": "Registration successful. Please check your email to activate your account."})
     except Exception as e:
@@ -225,6 +255,7 @@ def activate(request, uidb64, token):
         return HttpResponse("Invalid or expired activation link.", status=400)
 
 
+@never_compress
 @api_view(['POST'])
 @permission_classes([AllowAny])
 def login(request):
@@ -294,12 +325,31 @@ def user_profile(request):
 
 
 @api_view(["GET"])
+@authentication_classes([])
 @permission_classes([AllowAny])
 def list_tools(request):
-    """Get list of available tools"""
-    tools = Tool.objects.filter(is_active=True)
-    serializer = ToolSerializer(tools, many=True)
-    return Response(serializer.data)
+    """Get list of available tools, served precompressed from the cache"""
+    return precompressed_response(request, catalog_variants())
+
+
+@api_view(["GET"])
+@authentication_classes([])
+@permission_classes([AllowAny])
+def search_tools(request):
+    """Search active tools by name and description, best matches first, a page at a time"""
+    query = request.query_params.get("q", "").strip()
+    if not query:
+        return Response({"detail": "q is required"}, status=400)
+    try:
+        page = int(request.query_params.get("page", 1))
+        page_size = int(request.query_params.get("page_size", 20))
+    except ValueError:
+        return Response({"detail": "page and page_size must be integers"}, status=400)
+    if page < 1 or not 1 <= page_size <= MAX_PAGE_SIZE:
+        return Response({"detail": f"page must be positive and page_size between 1 and {MAX_PAGE_SIZE}"}, status=400)
+
+    count, results = search_catalog(query, offset=(page - 1) * page_size, limit=page_size)
+    return Response({"count": count, "page": page, "page_size": page_size, "results": results})
 
 
 @api_view(["GET"])
@@ -313,13 +363,14 @@ def check_subscription(request):
         # Check specific tool subscription
         try:
             tool = Tool.objects.get(name__iexact=tool_name)
-            subscription = Subscription.objects.filter(
-                user=user,
+            subscription = Subscription.objects.for_user(user).filter(
                 tool=tool,
-                status="active"
+                status=Subscription.Status.ACTIVE
             ).first()
             
             if subscription and subscription.is_active():
+                # Both are loaded already, and cannot be joined from another shard
+                subscription.user, subscription.tool = user, tool
                 return Response({
                     "has_access": True,
                     "subscription": SubscriptionSerializer(subscription).data
@@ -330,8 +381,9 @@ def check_subscription(request):
             return Response({"error": "Tool not found"}, status=404)
     
     # Get all active subscriptions
-    active_subs = Subscription.objects.filter(user=user, status="active")
-    tools = [sub.tool.id for sub in active_subs]
+    tools = list(
+        Subscription.objects.for_user(user).filter(status=Subscription.Status.ACTIVE).values_list("tool_id", flat=True)
+    )
 
     return Response({
         "has_access": len(tools) > 0,
@@ -339,19 +391,234 @@ def check_subscription(request):
     })
 
 
+def auth_request(request):
+    """nginx auth_request target: 204 if the bearer token may use the tool, else 403; no DRF dispatch"""
+    header = request.headers.get("Authorization", "")
+    tool = request.GET.get("tool") or request.headers.get("X-Tool", "")
+    if not header.startswith("Bearer ") or not tool:
+        return HttpResponse(status=403)
+
+    decision = access_decision(header[len("Bearer "):], tool)
+    if decision is None:
+        return HttpResponse(status=403)
+    user_id, role = decision
+    response = HttpResponse(status=204)
+    response["X-User-Id"] = str(user_id)
+    response["X-User-Role"] = role
+    return response
+
+
+@api_view(["POST"])
+@authentication_classes([ServiceTokenAuthentication])
+@permission_classes([IsService])
+def bulk_check_subscription(request):
+    """Check access for many (user, tool) pairs in one query, for service clients"""
+    checks = request.data.get("checks") if isinstance(request.data, dict) else None
+    if not isinstance(checks, list) or not checks:
+        return Response({"detail": "checks must be a non-empty list"}, status=400)
+    if len(checks) > settings.BULK_CHECK_MAX_ITEMS:
+        return Response({"detail": f"At most {settings.BULK_CHECK_MAX_ITEMS} checks per request"}, status=400)
+
+    pairs = []
+    for check in checks:
+        try:
+            user_id = int(check["user_id"])
+            if check.get("tool_id") is not None:
+                pairs.append((user_id, int(check["tool_id"]), None))
+            elif isinstance(check.get("tool_name"), str) and check["tool_name"]:
+                pairs.append((user_id, None, check["tool_name"]))
+            else:
+                raise ValueError("no tool")
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return Response({"detail": "Each check needs user_id and tool_id or tool_name"}, status=400)
+
+    user_ids = {user_id for user_id, _, _ in pairs}
+    tool_ids = {tool_id for _, tool_id, _ in pairs if tool_id is not None}
+    tool_names = {name.lower() for _, _, name in pairs if name is not None}
+
+    shards = group_by_shard(user_ids)
+    tool_keys = {}
+    if tool_names and set(shards) != {DEFAULT_DB_ALIAS}:
+        # Tools live on `default`; other shards match names through their IDs
+        tool_keys = dict(
+            Tool.objects.annotate(tool_key=Lower("name")).filter(tool_key__in=tool_names).values_list("id", "tool_key")
+        )
+
+    # Same rule as Subscription.is_active(), evaluated in SQL, one query per shard
+    now = timezone.now()
+
+    def active_on(shard):
+        active = Subscription.objects.using(shard).filter(
+            Q(end_date__isnull=True) | Q(end_date__gt=now),
+            user_id__in=shards[shard],
+            status=Subscription.Status.ACTIVE,
+        )
+        if tool_names and shard == DEFAULT_DB_ALIAS:
+            return list(active.annotate(tool_key=Lower("tool__name")).filter(
+                Q(tool_id__in=tool_ids) | Q(tool_key__in=tool_names)
+            ).values_list("user_id", "tool_id", "tool_key", "end_date"))
+        active = active.filter(tool_id__in=tool_ids | set(tool_keys)).values_list("user_id", "tool_id", "end_date")
+        return [(user_id, tool_id, tool_keys.get(tool_id), end_date) for user_id, tool_id, end_date in active]
+
+    # (user, tool id or lowercased name) -> latest end_date, None meaning open-ended
+    access = {}
+    for user_id, tool_id, tool_key, end_date in chain.from_iterable(fan_out(active_on, shards).values()):
+        for key in ((user_id, tool_id), (user_id, tool_key)):
+            if key[1] is None:
+                continue
+            current = access.get(key, end_date)
+            if current is None or end_date is None:
+                access[key] = None
+            else:
+                access[key] = max(current, end_date)
+
+    def results():
+        for user_id, tool_id, tool_name in pairs:
+            if tool_id is not None:
+                key = (user_id, tool_id)
+                result = {"user_id": user_id, "tool_id": tool_id}
+            else:
+                key = (user_id, tool_name.lower())
+                result = {"user_id": user_id, "tool_name": tool_name}
+            result["has_access"] = key in access
+            result["end_date"] = access.get(key)
+            yield result
+
+    if len(pairs) < settings.BULK_CHECK_STREAM_THRESHOLD:
+        return Response({"results": list(results())})
+
+    def stream():
+        encoder = DjangoJSONEncoder()
+        yield '{"results": ['
+        for index, result in enumerate(results()):
+            yield ("," if index else "") + encoder.encode(result)
+        yield "]}"
+
+    return StreamingHttpResponse(stream(), content_type="application/json")
+
+
+@api_view(["POST"])
+@authentication_classes([ServiceTokenAuthentication])
+@permission_classes([IsService])
+def record_usage(request):
+    """Accept a batch of metered usage events from a tool; they are stored asynchronously"""
+    events = request.data.get("events") if isinstance(request.data, dict) else None
+    if not isinstance(events, list) or not events:
+        return Response({"detail": "events must be a non-empty list"}, status=400)
+    if len(events) > settings.USAGE_MAX_BATCH:
+        return Response({"detail": f"At most {settings.USAGE_MAX_BATCH} events per request"}, status=400)
+
+    accepted, rejected = validate_usage(events)
+    if accepted and not enqueue_usage(accepted):
+        return Response(
+            {"detail": "Usage buffer is full, retry later"}, status=429,
+            headers={"Retry-After": str(max(1, math.ceil(settings.USAGE_FLUSH_INTERVAL)))},
+        )
+    return Response({"accepted": len(accepted), "rejected": rejected}, status=202)
+
+
+@never_compress
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def entitlement_token(request):
+    """Issue a short-lived signed token listing the user's active tools"""
+    token, expires_at = issue_token(request.user)
+    return Response({"token": token, "expires_at": expires_at})
+
+
+@api_view(["GET"])
+@authentication_classes([])
+@permission_classes([AllowAny])
+def entitlement_jwks(request):
+    """Public keys tools use to verify entitlement tokens offline"""
+    response = Response(jwks())
+    response["Cache-Control"] = "public, max-age=3600"
+    return response
+
+
+@never_compress
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+def entitlement_stream_ticket(request):
+    """Issue a short-lived ticket for opening the entitlement stream, which EventSource can't authorize"""
+    return Response({
+        "ticket": issue_stream_ticket(request.user),
+        "expires_in": settings.ENTITLEMENT_STREAM_TICKET_SECONDS,
+    })
+
+
+def _stream_user(request):
+    """The user of a ?ticket= from entitlement_stream_ticket, or of a bearer token"""
+    ticket = request.GET.get("ticket")
+    if ticket is not None:
+        user_id = stream_ticket_user_id(ticket)
+        return User.objects.filter(pk=user_id, is_active=True).first() if user_id else None
+    result = JWTAuthentication().authenticate(request)
+    return result[0] if result else None
+
+
+def _entitlement_event(tool_ids, earliest_end):
+    data = {"tools": tool_ids, "earliest_end": int(earliest_end.timestamp()) if earliest_end else None}
+    return f"event: entitlements\ndata: {json.dumps(data)}\n\n"
+
+
+async def entitlement_stream(request):
+    """Server-sent events with the user's active tools, sent on connect and whenever they change"""
+    try:
+        user = await sync_to_async(_stream_user)(request)
+    except (InvalidToken, TokenError, exceptions.AuthenticationFailed):
+        user = None
+    if user is None:
+        return JsonResponse({"detail": "Authentication credentials were not provided."}, status=401)
+
+    async def events():
+        listener = hub.subscribe(user.pk)
+        loop = asyncio.get_running_loop()
+        closes_at = loop.time() + settings.EVENT_STREAM_MAX_SECONDS
+        try:
+            # Ask EventSource to reconnect quickly after the stream is recycled
+            prefix = "retry: 3000\n"
+            sent = None
+            while True:
+                now = timezone.now()
+                state = await sync_to_async(active_entitlements)(user, now)
+                if state != sent:
+                    yield prefix + _entitlement_event(*state)
+                    prefix, sent = "", state
+                else:
+                    yield ": keepalive\n\n"
+
+                remaining = closes_at - loop.time()
+                if remaining <= 0:
+                    return
+                # Wake for a change, the first plan lapsing, a heartbeat, or the end of the stream.
+                # Every wake reads the state again, so a change published in a process whose
+                # notifications don't reach this one still arrives within a heartbeat.
+                _, earliest_end = state
+                expires_in = (earliest_end - now).total_seconds() if earliest_end else float("inf")
+                await listener.wait(min(settings.EVENT_STREAM_HEARTBEAT_SECONDS, remaining, max(expires_in, 0)))
+        finally:
+            hub.unsubscribe(listener)
+
+    response = StreamingHttpResponse(events(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache, no-transform"
+    response["X-Accel-Buffering"] = "no"  # stop nginx from holding events back
+    return response
+
+
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def my_subscriptions(request):
     """Get user's subscriptions"""
     user = request.user
-    subscriptions = Subscription.objects.filter(user=user)
+    subscriptions = Subscription.objects.for_user(user).with_related("tool")
     
     data = [{
         "id": sub.id,
         "tool": sub.tool.name,
         "tool_id": sub.tool.id,
-        "status": sub.status,
-        "plan": sub.plan,
+        "status": sub.status_slug,
+        "plan": sub.plan_slug,
         "created_at": sub.created_at,
         "updated_at": sub.updated_at,
         "end_date": sub.end_date
@@ -360,104 +627,130 @@ def my_subscriptions(request):
     return Response(data)
 
 
+def _plan_total(tool, plan, is_yearly):
+    """Price of one tool for a plan, with the yearly-billing discount applied"""
+    base_price = float(tool.price)
+    if is_yearly:
+        # Apply discount for yearly billing
+        discount_rates = {
+            Subscription.Plan.ONE_MONTH: 0,
+            Subscription.Plan.THREE_MONTHS: 0.1,
+            Subscription.Plan.SIX_MONTHS: 0.15,
+            Subscription.Plan.TWELVE_MONTHS: 0.25
+        }
+        discount = discount_rates.get(plan, 0)
+        base_price = base_price * (1 - discount)
+
+    return base_price * plan.value
+
+
+@never_compress
 @api_view(["POST"])
 @permission_classes([IsAuthenticated])
+@idempotent
 def create_checkout(request):
-    """Create Stripe checkout session"""
+    """Create one Stripe checkout session for a single tool or a cart of tools"""
     user = request.user
-    tool_input = request.data.get("tool_id") or request.data.get("tool_name")
-    plan = request.data.get("plan", "1-month")
-    is_yearly = request.data.get("is_yearly", False)
+    if "items" in request.data:
+        items = request.data.get("items")
+        if not isinstance(items, list) or not items:
+            return Response({"detail": "items must be a non-empty list"}, status=400)
+    else:
+        items = [request.data]
 
-    if not tool_input:
-        return Response({"detail": "Missing tool_id or tool_name"}, status=400)
+    cart = []
+    for item in items:
+        tool_input = item.get("tool_id") or item.get("tool_name") if isinstance(item, dict) else None
+        if not tool_input:
+            return Response({"detail": "Missing tool_id or tool_name"}, status=400)
+        try:
+            plan = Subscription.Plan.from_slug(item.get("plan", "1-month"))
+        except ValueError:
+            plan = Subscription.Plan.NONE
+        if plan == Subscription.Plan.NONE:
+            return Response({"detail": f"Invalid plan {item.get('plan')!r}"}, status=400)
+        cart.append((str(tool_input), plan, item.get("is_yearly", False)))
 
     try:
-        # Find tool by ID or name
-        if str(tool_input).isdigit():
-            tool = Tool.objects.get(id=int(tool_input))
-        else:
-            tool = Tool.objects.get(name__iexact=tool_input)
+        # Find every tool by ID or name in one query
+        tool_ids = {int(key) for key, _, _ in cart if key.isdigit()}
+        tool_names = {key.lower() for key, _, _ in cart if not key.isdigit()}
+        tools = {}
+        for tool in Tool.objects.annotate(name_key=Lower("name")).filter(
+            Q(id__in=tool_ids) | Q(name_key__in=tool_names)
+        ):
+            tools[str(tool.id)] = tools[tool.name_key] = tool
+
+        lines = []
+        for key, plan, is_yearly in cart:
+            tool = tools.get(key if key.isdigit() else key.lower())
+            if tool is None:
+                raise Tool.DoesNotExist
+            lines.append((tool, plan, is_yearly, _plan_total(tool, plan, is_yearly)))
+
+        if len({tool.id for tool, _, _, _ in lines}) != len(lines):
+            return Response({"detail": "Each tool can only appear once per checkout"}, status=400)
 
         # Check if already subscribed
-        if Subscription.objects.filter(user=user, tool=tool, status="active").exists():
+        if Subscription.objects.for_user(user).filter(
+            tool__in=[tool for tool, _, _, _ in lines], status=Subscription.Status.ACTIVE
+        ).exists():
             return Response({"detail": "Already subscribed"}, status=400)
 
-        # Calculate price based on plan and billing cycle
-        price_multiplier = 1
-        if plan == '3-month':
-            price_multiplier = 3
-        elif plan == '6-month':
-            price_multiplier = 6
-        elif plan == '12-month':
-            price_multiplier = 12
-
-        base_price = float(tool.price)
-        if is_yearly:
-            # Apply discount for yearly billing
-            discount_rates = {
-                '1-month': 0,
-                '3-month': 0.1,
-                '6-month': 0.15,
-                '12-month': 0.25
-            }
-            discount = discount_rates.get(plan, 0)
-            base_price = base_price * (1 - discount)
-
-        total_price = base_price * price_multiplier
-
-        # Create Stripe checkout session
-        session = stripe.checkout.Session.create(
-            customer_email=user.email,
-            payment_method_types=["card"],
-            line_items=[{
-                'price_data': {
-                    'currency': 'usd',
-                    'product_data': {
-                        'name': f'{tool.name} - {plan}',
+        metadata = {"user_id": str(user.id)}
+        if len(lines) == 1:
+            tool, plan, is_yearly, _ = lines[0]
+            metadata.update(tool_id=str(tool.id), plan=plan.slug, is_yearly=str(is_yearly))
+        else:
+            metadata["tool_ids"] = ",".join(str(tool.id) for tool, _, _, _ in lines)
+
+        # Create Stripe checkout session for the user's Customer, offering their saved cards
+        customer_id = stripe_customer_id(user)
+        with timed("stripe"):
+            session = get_stripe().checkout.Session.create(
+                customer=customer_id,
+                saved_payment_method_options={"payment_method_save": "enabled"},
+                payment_method_types=["card"],
+                line_items=[{
+                    'price_data': {
+                        'currency': 'usd',
+                        'product_data': {
+                            'name': f'{tool.name} - {plan.slug}',
+                        },
+                        'unit_amount': int(total_price * 100),  # Convert to cents
                     },
-                    'unit_amount': int(total_price * 100),  # Convert to cents
-                },
-                'quantity': 1,
-            }],
-            mode='payment',
-            success_url="https://marketplace.crispai.ca/?status=success&session_id={CHECKOUT_SESSION_ID}",
-            cancel_url="https://marketplace.crispai.ca/?status=cancel",
-            metadata={
-                "tool_id": str(tool.id),
-                "user_id": str(user.id),
-                "plan": plan,
-                "is_yearly": str(is_yearly),
-            }
-        )
-
-        # Create subscription record (inactive until payment)
-        end_date = timezone.now()
-        if plan == '1-month':
-            end_date += relativedelta(months=1)
-        elif plan == '3-month':
-            end_date += relativedelta(months=3)
-        elif plan == '6-month':
-            end_date += relativedelta(months=6)
-        elif plan == '12-month':
-            end_date += relativedelta(months=12)
-
-        subscription = Subscription.objects.create(
-            user=user,
-            tool=tool,
-            plan=plan,
-            status="inactive",
-            email=user.email,
-            end_date=end_date
-        )
-
-        # Create payment record
-        Payment.objects.create(
-            user=user,
-            subscription=subscription,
-            amount=total_price,
-            stripe_payment_intent_id=session.id
-        )
+                    'quantity': 1,
+                } for tool, plan, _, total_price in lines],
+                mode='payment',
+                success_url="https://marketplace.crispai.ca/?status=success&session_id={CHECKOUT_SESSION_ID}",
+                cancel_url="https://marketplace.crispai.ca/?status=cancel",
+                metadata=metadata,
+            )
+
+        from dateutil.relativedelta import relativedelta
+
+        # Create subscription and payment records (inactive until payment)
+        now = timezone.now()
+        shard = shard_for_user(user)
+        with transaction.atomic(using=shard):
+            subscriptions = Subscription.objects.using(shard).bulk_create([
+                Subscription(
+                    user=user,
+                    tool=tool,
+                    plan=plan,
+                    status=Subscription.Status.INACTIVE,
+                    email=user.email,
+                    end_date=now + relativedelta(months=plan.value)
+                ) for tool, plan, _, _ in lines
+            ])
+            Payment.objects.using(shard).bulk_create([
+                Payment(
+                    user=user,
+                    subscription=subscription,
+                    amount=total_price,
+                    stripe_payment_intent_id=session.id
+                ) for subscription, (_, _, _, total_price) in zip(subscriptions, lines)
+            ])
 
         return Response({"checkout_url": session.url})
 
@@ -467,8 +760,77 @@ def create_checkout(request):
         return Response({"error": str(e)}, status=500)
 
 
+def _parse_moment(value):
+    """Aware datetime from an ISO date or datetime query parameter; raises ValueError"""
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(value)
+        moment = datetime.combine(day, datetime.min.time())
+    return timezone.make_aware(moment) if timezone.is_naive(moment) else moment
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def payment_history(request):
+    """Get the user's payments, newest first, a page at a time with optional monthly totals"""
+    params = request.query_params
+    status_filter = params.get("status")
+    if status_filter and status_filter not in dict(Payment.STATUS_CHOICES):
+        return Response({"detail": f"Unknown status {status_filter!r}"}, status=400)
+    try:
+        since = _parse_moment(params["since"]) if params.get("since") else None
+        until = _parse_moment(params["until"]) if params.get("until") else None
+    except ValueError:
+        return Response({"detail": "since and until must be ISO dates or datetimes"}, status=400)
+    try:
+        limit = int(params.get("limit", 50))
+    except ValueError:
+        limit = 0
+    if not 1 <= limit <= history.MAX_PAGE_SIZE:
+        return Response({"detail": f"limit must be between 1 and {history.MAX_PAGE_SIZE}"}, status=400)
+
+    try:
+        after = history.decode_cursor(params["cursor"]) if params.get("cursor") else None
+    except ValueError:
+        return Response({"detail": "Invalid cursor"}, status=400)
+
+    payments = history.payments_for(request.user, status=status_filter, since=since, until=until)
+    results, next_cursor = history.page(payments, after=after, limit=limit)
+    data = {"results": results, "next_cursor": next_cursor}
+    if params.get("summary") == "month":
+        # Totals count money actually taken, unless another status was asked for
+        data["summary"] = history.monthly_totals(payments if status_filter else payments.filter(status="succeeded"))
+    return Response(data)
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def archived_billing(request):
+    """Get the user's payments, usage or subscriptions moved to cold storage, oldest first, a page at a time"""
+    params = request.query_params
+    kind = params.get("kind", "payments")
+    if kind not in ("payments", "usage", "subscriptions"):
+        return Response({"detail": "kind must be payments, usage or subscriptions"}, status=400)
+    try:
+        limit = int(params.get("limit", 50))
+    except ValueError:
+        limit = 0
+    if not 1 <= limit <= history.MAX_PAGE_SIZE:
+        return Response({"detail": f"limit must be between 1 and {history.MAX_PAGE_SIZE}"}, status=400)
+
+    try:
+        after = archive.decode_cursor(params["cursor"]) if params.get("cursor") else None
+    except ValueError:
+        return Response({"detail": "Invalid cursor"}, status=400)
+    results, next_cursor = archive.page(kind, request.user.id, after=after, limit=limit)
+    return Response({"results": results, "next_cursor": next_cursor})
+
+
 @api_view(["POST"])
 @permission_classes([IsAuthenticated])
+@idempotent
 def cancel_subscription(request):
     """Cancel user subscription"""
     user = request.user
@@ -478,14 +840,14 @@ def cancel_subscription(request):
         return Response({"detail": "tool_id is required"}, status=400)
     
     try:
-        subscription = Subscription.objects.get(
-            user=user,
+        subscription = Subscription.objects.for_user(user).get(
             tool_id=tool_id,
-            status="active"
+            status=Subscription.Status.ACTIVE
         )
         
-        subscription.status = "canceled"
+        subscription.status = Subscription.Status.CANCELED
         subscription.save()
+        notify_entitlements_changed([user.id])
         
         return Response({"detail": "Subscription canceled successfully"})
         
@@ -515,45 +877,70 @@ def stripe_webhook(request):
     endpoint_secret = settings.STRIPE_WEBHOOK_SECRET
 
     try:
-        event = stripe.Webhook.construct_event(payload, sig_header, endpoint_secret)
+        with timed("stripe"):
+            event = get_stripe().Webhook.construct_event(payload, sig_header, endpoint_secret)
     except Exception:
         return HttpResponse(status=400)
 
     if event["type"] == "checkout.session.completed":
         session = event["data"]["object"]
-        email = session.get("customer_email")
-        tool_id = session.get("metadata", {}).get("tool_id")
         user_id = session.get("metadata", {}).get("user_id")
-        plan = session.get("metadata", {}).get("plan")
 
         try:
-            user = User.objects.get(id=user_id)
-            tool = Tool.objects.get(id=tool_id)
-            
-            # Find and activate the subscription
-            subscription = Subscription.objects.filter(
-                user=user,
-                tool=tool,
-                status="inactive"
-            ).first()
-            
-            if subscription:
-                subscription.status = "active"
-                subscription.stripe_subscription_id = session.id
-                subscription.save()
-                
-                # Update payment record
-                payment = Payment.objects.filter(
-                    user=user,
-                    subscription=subscription,
+            # Activate everything bought in this session with set-based updates,
+            # on the shard of the user who started the checkout
+            now = timezone.now()
+            shard = shard_for_user(int(user_id)) if user_id else DEFAULT_DB_ALIAS
+            with transaction.atomic(using=shard):
+                activated = Subscription.objects.using(shard).filter(
+                    payment__stripe_payment_intent_id=session.id,
+                    status=Subscription.Status.INACTIVE
+                ).update(status=Subscription.Status.ACTIVE, stripe_subscription_id=session.id, updated_at=now)
+
+                Payment.objects.using(shard).filter(
                     stripe_payment_intent_id=session.id
-                ).first()
-                
-                if payment:
-                    payment.status = "succeeded"
-                    payment.save()
-                    
+                ).update(status="succeeded", updated_at=now)
+
+            if activated and user_id:
+                notify_entitlements_changed([int(user_id)])
+
         except Exception:
-            pass
+            # A non-2xx makes Stripe retry the event, rather than leaving a paid checkout inactive
+            return HttpResponse(status=500)
+
+    elif event["type"] == "checkout.session.expired":
+        session = event["data"]["object"]
+        user_id = session.get("metadata", {}).get("user_id")
+        shard = shard_for_user(int(user_id)) if user_id else DEFAULT_DB_ALIAS
+        try:
+            # Only rows still unpaid and inactive go, so a completed session keeps its own
+            reap_session(shard, session.id)
+        except Exception:
+            pass  # reap_checkouts removes whatever is left behind
+
+    return HttpResponse(status=200)
+
+
+def healthz(request):
+    """Liveness probe: the worker is up and serving requests"""
+    return HttpResponse("ok", content_type="text/plain")
+
+
+def readyz(request):
+    """Readiness probe: every configured database answers"""
+    try:
+        for alias in connections:
+            with connections[alias].cursor() as cursor:
+                cursor.execute("SELECT 1")
+    except Exception as e:
+        return HttpResponse(f"database unavailable: {e}", status=503, content_type="text/plain")
+    return HttpResponse("ok", content_type="text/plain")
+
 
-    return HttpResponse(status=200)
\ No newline at end of file
+def metrics(request):
+    """Prometheus scrape endpoint for the per-view request histograms, summed over all workers"""
+    token = settings.METRICS_TOKEN
+    presented = request.headers.get("Authorization", "").encode()
+    if token and not hmac.compare_digest(presented, f"Bearer {token}".encode()):
+        return HttpResponse(status=403)
+    return HttpResponse(render_prometheus(), content_type="text/plain; version=0.0.4; charset=utf-8")
\ No newline at end of file
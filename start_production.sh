@@ -0,0 +1,11 @@
+#!/bin/bash
+# Start Django backend under gunicorn with uvicorn workers
+echo "Starting Django backend (production)..."
+cd crisp_backend
+# Migrate every database: `default` and each shard in SHARD_DATABASES
+for alias in $(python manage.py shell --no-imports -c "from django.conf import settings; print(*settings.DATABASES)"); do
+    python manage.py migrate --noinput --database "$alias" || exit 1
+done
+# The table behind the shared cache, when CACHES uses DatabaseCache
+python manage.py createcachetable || exit 1
+exec gunicorn crisp_backend.asgi:application -c gunicorn.conf.py